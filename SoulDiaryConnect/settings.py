@@ -145,4 +145,78 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Percorso per i file caricati (media)
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Configurazione Ollama
+OLLAMA_BASE_URL = "http://localhost:11434/api/generate"
+OLLAMA_MODEL = "llama3.1:8b"  # Cambia in "cbt-assistant" se hai creato il modello personalizzato
+
+# Pool di connessioni HTTP verso Ollama (keep-alive)
+OLLAMA_POOL_CONNECTIONS = 4  # Numero di host distinti per cui mantenere un pool
+OLLAMA_POOL_MAXSIZE = 10  # Connessioni keep-alive massime per host
+
+# Timeout (in secondi): la connessione deve essere rapida, la generazione può richiedere tempo
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_READ_TIMEOUT = 300
+
+# Tentativi in caso di connessione rifiutata o resettata, con backoff esponenziale
+OLLAMA_MAX_RETRIES = 3
+OLLAMA_BACKOFF_FACTOR = 0.5
+
+# Analisi combinata: nota clinica, sentiment e contesto sociale in una sola generazione
+# (JSON schema). Se la risposta non è valida si torna alle tre chiamate separate.
+ANALISI_COMBINATA = False
+
+# Coda di analisi delle note (python manage.py run_analysis_workers)
+ANALISI_WORKERS = 2  # Analisi eseguite in parallelo
+ANALISI_JOB_TIMEOUT = 900  # Secondi dopo i quali un job in esecuzione è considerato bloccato
+ANALISI_JOB_MAX_TENTATIVI = 3
+
+# Cache delle risposte LLM (chiave: hash di modello, prompt, temperatura e num_predict)
+LLM_CACHE_ENABLED = True
+LLM_CACHE_BACKEND = 'diskcache'  # 'diskcache' (su disco) oppure 'django' (settings.CACHES)
+LLM_CACHE_DIR = BASE_DIR / 'llm_cache'
+LLM_CACHE_SIZE_LIMIT = 256 * 1024 * 1024  # 256 MB, oltre viene applicata l'eviction LRU
+LLM_CACHE_TTL = 60 * 60 * 24 * 7  # Una settimana
+
+# Frase di supporto al paziente generata in streaming (Server-Sent Events) dopo il salvataggio della nota
+SUPPORTO_STREAMING = True
+
+# Eventi di completamento dell'analisi (long-poll lato medico, vedi eventi.py)
+EVENTI_BROKER = 'postgres'  # 'postgres' (LISTEN/NOTIFY, tra processi) oppure 'locale' (stesso processo)
+EVENTI_LONG_POLL_TIMEOUT = 25  # Secondi massimi di attesa di una richiesta di long-poll
+
+# Riassunti del caso clinico sui periodi lunghi (sintesi settimanali e mensili, vedi riassunti.py)
+RIASSUNTI_MAX_PARALLELO = 4  # Sintesi generate in parallelo durante una rigenerazione
+
+# Budget dei prompt in token (vedi prompt_budget.py)
+OLLAMA_NUM_CTX = 8192  # Finestra di contesto richiesta al modello
+PROMPT_BUDGET_NOTA_CORRENTE = 3000  # Oltre, la nota da analizzare viene troncata
+PROMPT_BUDGET_NOTE_PRECEDENTI = 1500  # Contesto delle note precedenti (si scartano le più vecchie)
+
+# Tempo per cui Ollama tiene il modello in memoria dopo l'ultima richiesta (valore di keep_alive).
+# Va tenuto costante insieme a OLLAMA_NUM_CTX: cambiarli tra una richiesta e l'altra ricarica il modello
+OLLAMA_KEEP_ALIVE = '30m'
+
+# Backend di generazione testo (vedi llm_backends.py)
+LLM_BACKEND = 'ollama'  # 'ollama' (HTTP), 'llama_cpp' (modello nel processo) oppure 'fake' (test e benchmark)
+LLAMA_CPP_MODEL_PATH = None  # Percorso del file GGUF, es. BASE_DIR / 'models' / 'llama-3.1-8b-instruct-q4_k_m.gguf'
+LLAMA_CPP_SLOT = 1  # Generazioni in parallelo (una cache KV per slot, pesi condivisi)
+LLAMA_CPP_THREADS = None  # Thread CPU per generazione (None: scelta automatica)
+LLAMA_CPP_GPU_LAYERS = 0  # Layer da caricare su GPU (-1: tutti)
+LLM_FAKE_LATENZA_MS = 0  # Latenza simulata dal backend fake
+
+# Note passate più simili nei prompt clinici e nei riassunti (vedi embeddings.py).
+# Gli embedding sono calcolati dal backend locale: con Ollama serve "ollama pull nomic-embed-text"
+OLLAMA_EMBEDDING_MODEL = "nomic-embed-text"
+LLAMA_CPP_EMBEDDING_MODEL_PATH = None  # File GGUF del modello di embedding per il backend llama.cpp
+NOTE_SIMILI_K = 3  # Note simili aggiunte al contesto (0: disattivato)
+NOTE_SIMILI_SOGLIA = 0.3  # Similarità del coseno minima
+
+# Generazioni identiche concorrenti tra processi diversi deduplicate con un advisory lock di PostgreSQL
+# (vedi single_flight.py; nello stesso processo la deduplicazione è sempre attiva)
+LLM_SINGLE_FLIGHT_DB = True
+
+# Scheduler delle generazioni LLM (vedi llm_scheduler.py): generazioni contemporanee per processo,
+# da allineare a OLLAMA_NUM_PARALLEL (o a LLAMA_CPP_SLOT con il backend llama.cpp)
+LLM_MAX_PARALLELO = 4
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django import forms
 from django.utils.html import format_html
-from .models import Medico, Paziente, NotaDiario, Messaggio, RiassuntoCasoClinico
+from .models import Medico, Paziente, NotaDiario, Messaggio, RiassuntoCasoClinico, JobAnalisi
 
 
 class MedicoAdminForm(forms.ModelForm):
@@ -44,8 +44,14 @@ class PazienteAdmin(admin.ModelAdmin):
 	password_masked.short_description = 'Password'
 
 
+class JobAnalisiAdmin(admin.ModelAdmin):
+	list_display = ['id', 'nota', 'stato', 'tentativi', 'data_creazione', 'attesa_ms', 'durata_ms', 'worker']
+	list_filter = ['stato']
+
+
 admin.site.register(Medico, MedicoAdmin)
 admin.site.register(Paziente, PazienteAdmin)
 admin.site.register(NotaDiario)
 admin.site.register(Messaggio)
 admin.site.register(RiassuntoCasoClinico)
+admin.site.register(JobAnalisi, JobAnalisiAdmin)
@@ -0,0 +1,145 @@
+"""
+Aggregati giornalieri delle emozioni e dei contesti sociali per paziente.
+
+Ogni nota contribuisce con +1 alla riga (paziente, giorno, emozione, contesto) di
+AggregatoEmotivo e con il punteggio della categoria della sua emozione. Il contributo
+viene aggiunto alla creazione della nota, spostato quando l'analisi assegna emozione
+e contesto, e tolto quando la nota viene eliminata: la pagina di analisi legge così
+poche righe per giorno invece dell'intero storico delle note.
+"""
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, CharField, Count, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce, Lower, Trim, TruncDate
+from django.utils import timezone
+
+from .models import AggregatoEmotivo, NotaDiario
+
+logger = logging.getLogger(__name__)
+
+# Punteggio numerico di ogni categoria di emozione (grafico e medie emotive)
+PUNTEGGI_CATEGORIE = {
+    'positive': 4,
+    'neutral': 3,
+    'anxious': 2,
+    'negative': 1,
+}
+
+
+def _categoria(emozione):
+    # Import locale: views importa questo modulo
+    from .views import get_emotion_category
+
+    return get_emotion_category(emozione) if emozione else ''
+
+
+def chiave_nota(nota):
+    """
+    Restituisce la chiave dell'aggregato a cui contribuisce la nota:
+    (giorno, emozione, categoria, contesto), con emozione e contesto normalizzati.
+    """
+    emozione = (nota.emozione_predominante or '').lower().strip()
+    contesto = (nota.contesto_sociale or '').lower().strip()
+    return timezone.localdate(nota.data_nota), emozione, _categoria(emozione), contesto
+
+
+def _applica(paziente_id, chiave, segno):
+    giorno, emozione, categoria, contesto = chiave
+    punteggio = PUNTEGGI_CATEGORIE.get(categoria, 0)
+    righe = AggregatoEmotivo.objects.filter(paz_id=paziente_id, giorno=giorno, emozione=emozione, contesto=contesto)
+
+    aggiornate = righe.update(
+        num_note=F('num_note') + segno,
+        somma_punteggi=F('somma_punteggi') + segno * punteggio,
+    )
+    if segno < 0:
+        righe.filter(num_note__lte=0).delete()
+        return
+    if aggiornate:
+        return
+
+    try:
+        # Savepoint: su PostgreSQL un IntegrityError invaliderebbe la transazione esterna
+        with transaction.atomic():
+            AggregatoEmotivo.objects.create(
+                paz_id=paziente_id, giorno=giorno, emozione=emozione, categoria=categoria,
+                contesto=contesto, num_note=segno, somma_punteggi=segno * punteggio,
+            )
+    except IntegrityError:
+        # Riga creata nel frattempo da un altro processo
+        righe.update(
+            num_note=F('num_note') + segno,
+            somma_punteggi=F('somma_punteggi') + segno * punteggio,
+        )
+
+
+def registra_nota(nota):
+    """Aggiunge il contributo di una nota appena creata."""
+    _applica(nota.paz_id, chiave_nota(nota), 1)
+
+
+def rimuovi_nota(nota):
+    """Toglie il contributo di una nota che sta per essere eliminata."""
+    _applica(nota.paz_id, chiave_nota(nota), -1)
+
+
+def sposta_nota(paziente_id, chiave_precedente, chiave_nuova):
+    """
+    Sposta il contributo di una nota quando cambiano emozione o contesto
+    (ad esempio al termine dell'analisi). Le chiavi si ottengono con chiave_nota.
+    """
+    if chiave_precedente == chiave_nuova:
+        return
+    with transaction.atomic():
+        _applica(paziente_id, chiave_precedente, -1)
+        _applica(paziente_id, chiave_nuova, 1)
+
+
+def ricostruisci_aggregati(paziente_id=None):
+    """
+    Ricalcola da zero gli aggregati (di un paziente o di tutti) con una GROUP BY
+    sulle note: categoria e punteggio vengono calcolati nel database con un CASE
+    costruito da EMOZIONI_CATEGORIE. Da usare dopo la migrazione o per riallineare i dati.
+
+    Returns:
+        int: Numero di righe di aggregato create
+    """
+    # Import locale: views importa questo modulo
+    from .views import EMOZIONI_CATEGORIE, case_da_dizionario
+
+    note = NotaDiario.objects.all()
+    if paziente_id:
+        note = note.filter(paz_id=paziente_id)
+
+    gruppi = (
+        note.annotate(
+            giorno=TruncDate('data_nota'),
+            emozione=Lower(Trim(Coalesce('emozione_predominante', Value('')))),
+            contesto=Lower(Trim(Coalesce('contesto_sociale', Value('')))),
+        )
+        .annotate(categoria=Case(
+            When(emozione='', then=Value('')),
+            default=case_da_dizionario('emozione', EMOZIONI_CATEGORIE, 'neutral'),
+            output_field=CharField(),
+        ))
+        .annotate(punteggio=Case(
+            *[When(categoria=categoria, then=Value(punteggio)) for categoria, punteggio in PUNTEGGI_CATEGORIE.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        ))
+        .values('paz_id', 'giorno', 'emozione', 'categoria', 'contesto')
+        .annotate(num_note=Count('id'), somma_punteggi=Sum('punteggio'))
+        .order_by()
+    )
+    aggregati = [AggregatoEmotivo(**gruppo) for gruppo in gruppi]
+
+    with transaction.atomic():
+        esistenti = AggregatoEmotivo.objects.all()
+        if paziente_id:
+            esistenti = esistenti.filter(paz_id=paziente_id)
+        esistenti.delete()
+        AggregatoEmotivo.objects.bulk_create(aggregati, batch_size=1000)
+
+    logger.info(f"Aggregati emotivi ricostruiti: {len(aggregati)} righe")
+    return len(aggregati)
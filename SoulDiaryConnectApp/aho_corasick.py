@@ -0,0 +1,104 @@
+"""
+Automa di Aho-Corasick per la ricerca simultanea di più parole chiave in un testo.
+
+L'automa viene costruito una volta sola e trova tutte le occorrenze di tutte le
+parole chiave con una singola scansione del testo, in tempo O(len(testo) + occorrenze)
+indipendentemente dal numero di parole chiave. I link di fallimento vengono risolti
+in fase di costruzione (automa deterministico), quindi la scansione esegue una sola
+transizione per carattere.
+"""
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    Automa multi-pattern. Ogni parola chiave è associata a un'etichetta
+    (ad esempio la categoria di emergenza a cui appartiene).
+
+    Uso:
+        automa = AhoCorasick()
+        automa.aggiungi('farla finita', 'suicidio')
+        automa.costruisci()
+        for inizio, fine, parola, etichetta in automa.trova(testo):
+            ...
+    """
+
+    def __init__(self):
+        # Nodo 0 = radice. Per ogni nodo: transizioni, link di fallimento, uscite
+        self._transizioni = [{}]
+        self._fallimento = [0]
+        self._uscite = [[]]
+        self._delta = [{}]
+        self._costruito = False
+
+    def aggiungi(self, parola, etichetta=None):
+        """Aggiunge una parola chiave all'automa (prima di costruisci())."""
+        if not parola:
+            return
+        nodo = 0
+        for carattere in parola:
+            successivo = self._transizioni[nodo].get(carattere)
+            if successivo is None:
+                successivo = len(self._transizioni)
+                self._transizioni[nodo][carattere] = successivo
+                self._transizioni.append({})
+                self._fallimento.append(0)
+                self._uscite.append([])
+            nodo = successivo
+        uscita = (parola, etichetta)
+        if uscita not in self._uscite[nodo]:
+            self._uscite[nodo].append(uscita)
+        self._costruito = False
+
+    def costruisci(self):
+        """
+        Calcola i link di fallimento con una visita in ampiezza del trie e, da questi,
+        la tabella di transizione completa: per ogni nodo, lo stato di arrivo per ogni
+        carattere che non riporta alla radice.
+        """
+        transizioni = self._transizioni
+        delta = [dict(t) for t in transizioni]
+        coda = deque()
+        for successivo in transizioni[0].values():
+            self._fallimento[successivo] = 0
+            coda.append(successivo)
+
+        while coda:
+            nodo = coda.popleft()
+            fallimento_nodo = self._fallimento[nodo]
+            # Le transizioni mancanti seguono quelle del nodo di fallimento (già completo,
+            # perché più vicino alla radice nella visita in ampiezza)
+            if nodo:
+                for carattere, arrivo in delta[fallimento_nodo].items():
+                    delta[nodo].setdefault(carattere, arrivo)
+            for carattere, successivo in transizioni[nodo].items():
+                coda.append(successivo)
+                self._fallimento[successivo] = delta[fallimento_nodo].get(carattere, 0) if nodo else 0
+                # Eredita le uscite dei suffissi (parole chiave contenute in altre)
+                self._uscite[successivo] = self._uscite[successivo] + self._uscite[self._fallimento[successivo]]
+
+        self._delta = delta
+        self._costruito = True
+        return self
+
+    def trova(self, testo):
+        """
+        Restituisce tutte le occorrenze delle parole chiave nel testo, anche sovrapposte.
+
+        Returns:
+            list: tuple (inizio, fine, parola, etichetta) ordinate per posizione di fine
+        """
+        if not self._costruito:
+            self.costruisci()
+
+        delta = self._delta
+        uscite = self._uscite
+
+        occorrenze = []
+        nodo = 0
+        for posizione, carattere in enumerate(testo):
+            nodo = delta[nodo].get(carattere, 0)
+            if uscite[nodo]:
+                for parola, etichetta in uscite[nodo]:
+                    occorrenze.append((posizione - len(parola) + 1, posizione + 1, parola, etichetta))
+        return occorrenze
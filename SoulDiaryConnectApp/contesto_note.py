@@ -0,0 +1,243 @@
+"""
+Riepilogo delle ultime note di ogni paziente, pronto da inserire nei prompt clinici.
+
+Il riepilogo è salvato nella riga del paziente (Paziente.contesto_note) come
+lista delle ultime DIMENSIONE_CONTESTO note in ordine cronologico, ciascuna con
+la voce già formattata per il prompt. Viene aggiornato quando una nota viene
+creata, analizzata (cambia l'emozione) o eliminata: la generazione e la
+rigenerazione della nota clinica, che caricano già il paziente, leggono il
+contesto senza query aggiuntive.
+
+Il riepilogo contiene più note del contesto usato dal prompt, così anche la
+rigenerazione di una delle note recenti trova le note che la precedono. Per le
+note più vecchie, o per i pazienti senza riepilogo, il contesto viene letto
+dal database come prima (vedi views._recupera_voci_note_precedenti).
+
+Ogni voce conserva anche le note passate più simili alla nota (vedi
+embeddings.py), salvate alla prima generazione insieme ai parametri della
+ricerca: la rigenerazione le riusa senza ripetere la ricerca.
+"""
+import logging
+from datetime import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import NotaDiario, Paziente
+
+logger = logging.getLogger(__name__)
+
+# Note conservate nel riepilogo di ogni paziente
+DIMENSIONE_CONTESTO = 10
+
+# Caratteri del testo del paziente riportati in ogni voce
+LUNGHEZZA_TESTO = 150
+
+
+def formatta_voce(data_nota, emozione, testo):
+    """Voce di contesto di una nota, nel formato usato dal prompt clinico."""
+    # Converti al timezone locale per la formattazione
+    data_ora_formattata = timezone.localtime(data_nota).strftime('%d/%m/%Y alle %H:%M')
+    emozione = emozione or "non specificata"
+    testo_breve = testo[:LUNGHEZZA_TESTO] + "..." if len(testo) > LUNGHEZZA_TESTO else testo
+    return f"[{data_ora_formattata}] - Emozione: {emozione}\nTesto: {testo_breve}"
+
+
+def _elemento(nota_id, data_nota, emozione, testo):
+    return {'id': nota_id, 'data': data_nota.isoformat(), 'voce': formatta_voce(data_nota, emozione, testo)}
+
+
+def _ordina(elementi):
+    elementi.sort(key=lambda elemento: (datetime.fromisoformat(elemento['data']), elemento['id']))
+    return elementi
+
+
+def voci_precedenti(paziente, limite=5, escludi_nota_id=None):
+    """
+    Restituisce le voci delle ultime 'limite' note precedenti alla nota indicata
+    (o le ultime in assoluto), lette dal riepilogo del paziente senza query.
+
+    Returns:
+        Lista delle voci in ordine cronologico, oppure None se il riepilogo non
+        basta (paziente senza riepilogo o nota più vecchia di quelle conservate)
+    """
+    contesto = paziente.contesto_note or {}
+    elementi = contesto.get('note')
+    if elementi is None:
+        return None
+
+    if escludi_nota_id is not None:
+        corrente = next((elemento for elemento in elementi if elemento['id'] == escludi_nota_id), None)
+        if corrente is None:
+            return None
+        # Solo le note con data PRECEDENTE alla nota corrente
+        data_corrente = datetime.fromisoformat(corrente['data'])
+        elementi = [elemento for elemento in elementi if datetime.fromisoformat(elemento['data']) < data_corrente]
+
+    # Con meno note del limite il riepilogo basta solo se contiene tutte quelle del paziente
+    if len(elementi) < limite and not contesto.get('completo'):
+        return None
+    return [elemento['voce'] for elemento in elementi[-limite:]]
+
+
+def voci_simili(paziente, nota_id, parametri):
+    """
+    Restituisce le voci delle note simili alla nota salvate nel riepilogo, senza query.
+
+    Args:
+        parametri: Parametri della ricerca (modello, k, ...): le note salvate
+                   con parametri diversi non vengono usate
+
+    Returns:
+        Lista delle voci in ordine cronologico, oppure None se non salvate
+    """
+    for elemento in (paziente.contesto_note or {}).get('note') or []:
+        if elemento['id'] == nota_id:
+            simili = elemento.get('simili')
+            if simili is None or simili['parametri'] != list(parametri):
+                return None
+            return [simile['voce'] for simile in simili['note']]
+    return None
+
+
+def salva_simili(paziente, nota_id, parametri, note):
+    """
+    Salva nella voce della nota le note simili trovate (oggetti NotaDiario letti
+    con per_contesto, in ordine cronologico). Se la nota non è nel riepilogo non
+    salva nulla. Aggiorna anche la copia in memoria del paziente.
+    """
+    if not any(elemento['id'] == nota_id for elemento in (paziente.contesto_note or {}).get('note') or []):
+        return
+    simili = {
+        'parametri': list(parametri),
+        'note': [
+            {'id': nota.id, 'voce': formatta_voce(nota.data_nota, nota.emozione_predominante, nota.inizio_testo)}
+            for nota in note
+        ],
+    }
+
+    def modifica(contesto):
+        for elemento in contesto['note']:
+            if elemento['id'] == nota_id:
+                elemento['simili'] = simili
+
+    paziente.contesto_note = _salva(paziente.pk, modifica)
+
+
+def _salva(paziente_id, modifica):
+    """Applica modifica(contesto) al riepilogo del paziente, con la riga bloccata."""
+    with transaction.atomic():
+        paziente = Paziente.objects.select_for_update().only('codice_fiscale', 'contesto_note').get(pk=paziente_id)
+        contesto = paziente.contesto_note or {}
+        if contesto.get('note') is None:
+            # Riepilogo mai costruito: si parte dalle note nel database
+            contesto = _leggi_contesto(paziente_id)
+        modifica(contesto)
+        paziente.contesto_note = contesto
+        paziente.save(update_fields=['contesto_note'])
+    return contesto
+
+
+def _leggi_contesto(paziente_id, escludi_nota_id=None):
+    note = NotaDiario.objects.filter(paz_id=paziente_id)
+    if escludi_nota_id is not None:
+        note = note.exclude(id=escludi_nota_id)
+    note = list(
+        note.per_contesto(LUNGHEZZA_TESTO)
+        .order_by('-data_nota', '-id')[:DIMENSIONE_CONTESTO + 1]
+    )
+    elementi = [
+        _elemento(nota.id, nota.data_nota, nota.emozione_predominante, nota.inizio_testo)
+        for nota in note[:DIMENSIONE_CONTESTO]
+    ]
+    return {'note': _ordina(elementi), 'completo': len(note) <= DIMENSIONE_CONTESTO}
+
+
+def aggiorna_nota(nota, paziente=None):
+    """
+    Inserisce o aggiorna la voce di una nota creata o modificata (testo,
+    emozione). Se viene passato il paziente della nota, aggiorna anche la sua
+    copia in memoria.
+    """
+    elemento = _elemento(nota.id, nota.data_nota, nota.emozione_predominante, nota.testo_paziente)
+
+    def modifica(contesto):
+        elementi = []
+        for e in contesto['note']:
+            if e['id'] == nota.id:
+                # Le note simili salvate restano valide: precedono la nota
+                if 'simili' in e:
+                    elemento['simili'] = e['simili']
+                continue
+            for simile in (e.get('simili') or {}).get('note', []):
+                if simile['id'] == nota.id:
+                    simile['voce'] = elemento['voce']
+            elementi.append(e)
+        elementi = _ordina(elementi + [elemento])
+        if len(elementi) > DIMENSIONE_CONTESTO:
+            # Le note più vecchie escono dal riepilogo, che non è più completo
+            elementi = elementi[-DIMENSIONE_CONTESTO:]
+            contesto['completo'] = False
+        contesto['note'] = elementi
+
+    contesto = _salva(nota.paz_id, modifica)
+    if paziente is not None:
+        paziente.contesto_note = contesto
+
+
+def rimuovi_nota(nota):
+    """
+    Toglie la voce di una nota che sta per essere eliminata. Se la nota era nel
+    riepilogo e le note più vecchie non vi sono conservate, il riepilogo viene
+    riletto dal database.
+    """
+    def modifica(contesto):
+        elementi = [e for e in contesto['note'] if e['id'] != nota.id]
+        for e in elementi:
+            if any(simile['id'] == nota.id for simile in (e.get('simili') or {}).get('note', [])):
+                # La ricerca verrà ripetuta alla prossima generazione
+                del e['simili']
+        if len(elementi) != len(contesto['note']) and not contesto.get('completo'):
+            contesto.update(_leggi_contesto(nota.paz_id, escludi_nota_id=nota.id))
+        else:
+            contesto['note'] = elementi
+
+    _salva(nota.paz_id, modifica)
+
+
+def svuota_simili(paziente_id=None):
+    """
+    Elimina le note simili salvate nel riepilogo (di un paziente o di tutti),
+    ad esempio dopo aver indicizzato note che prima non lo erano.
+    """
+    pazienti = Paziente.objects.all()
+    if paziente_id:
+        pazienti = pazienti.filter(pk=paziente_id)
+
+    def modifica(contesto):
+        for elemento in contesto['note']:
+            elemento.pop('simili', None)
+
+    for codice_fiscale in pazienti.values_list('codice_fiscale', flat=True).iterator():
+        _salva(codice_fiscale, modifica)
+
+
+def ricostruisci_contesto(paziente_id=None):
+    """
+    Ricalcola da zero il riepilogo (di un paziente o di tutti). Da usare dopo
+    la migrazione o per riallineare i dati.
+
+    Returns:
+        int: Numero di pazienti aggiornati
+    """
+    pazienti = Paziente.objects.all()
+    if paziente_id:
+        pazienti = pazienti.filter(pk=paziente_id)
+
+    aggiornati = 0
+    for codice_fiscale in pazienti.values_list('codice_fiscale', flat=True).iterator():
+        Paziente.objects.filter(pk=codice_fiscale).update(contesto_note=_leggi_contesto(codice_fiscale))
+        aggiornati += 1
+
+    logger.info(f"Contesto delle note ricostruito per {aggiornati} pazienti")
+    return aggiornati
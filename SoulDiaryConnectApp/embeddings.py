@@ -0,0 +1,250 @@
+"""
+Embedding delle note e ricerca delle note più simili di un paziente.
+
+Il testo di ogni nota viene trasformato in embedding una sola volta, con il
+backend locale configurato (vedi llm_backends: /api/embed di Ollama, il modello
+di embedding di llama.cpp o il backend fake), e salvato in EmbeddingNota come
+array float32 normalizzato. L'indicizzazione avviene nei worker, prima
+dell'analisi della nota; le note esistenti si indicizzano con
+``python manage.py indicizza_note``.
+
+La ricerca carica gli embedding di un paziente in una matrice NumPy, tenuta in
+una cache del processo e invalidata quando cambiano le note indicizzate (una
+query di conteggio sull'indice). La similarità del coseno è un prodotto
+matrice-vettore e i k risultati migliori si estraggono con argpartition: con
+10^4 note e vettori di 768 dimensioni la ricerca richiede pochi millisecondi.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .llm_backends import get_backend
+from .models import EmbeddingNota, NotaDiario
+
+logger = logging.getLogger(__name__)
+
+# Pazienti di cui si tengono in memoria gli embedding (per processo)
+DIMENSIONE_CACHE = 64
+
+# Note indicizzate con una sola richiesta al backend
+DIMENSIONE_LOTTO = 32
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _config(nome, default):
+    return getattr(settings, nome, default)
+
+
+def modello_embedding():
+    """Nome del modello di embedding del backend in uso (salvato con ogni vettore)."""
+    backend = get_backend()
+    return getattr(backend, 'modello_embedding', None) or backend.modello
+
+
+def calcola_embedding(testi):
+    """
+    Calcola gli embedding dei testi con il backend locale.
+
+    Returns:
+        numpy.ndarray: Matrice float32 (testi x dimensioni) con righe di norma 1
+    """
+    vettori = np.asarray(get_backend().embedding(list(testi)), dtype=np.float32)
+    norme = np.linalg.norm(vettori, axis=1, keepdims=True)
+    norme[norme == 0] = 1.0
+    return vettori / norme
+
+
+def indicizza_note(note):
+    """
+    Calcola e salva gli embedding delle note (sostituendo quelli esistenti).
+    Gli errori del backend vengono propagati.
+
+    Returns:
+        int: Numero di note indicizzate
+    """
+    note = list(note)
+    if not note:
+        return 0
+    modello = modello_embedding()
+    vettori = calcola_embedding(nota.testo_paziente for nota in note)
+
+    EmbeddingNota.objects.filter(nota__in=note).delete()
+    EmbeddingNota.objects.bulk_create([
+        EmbeddingNota(
+            nota_id=nota.id, paz_id=nota.paz_id, data_nota=nota.data_nota,
+            modello=modello, vettore=vettore.tobytes(),
+        )
+        for nota, vettore in zip(note, vettori)
+    ])
+    return len(note)
+
+
+def indicizza_nota(nota):
+    """
+    Indicizza una nota appena creata. Le note correlate sono un di più per il
+    prompt: se il backend non è disponibile l'errore viene solo registrato.
+
+    Returns:
+        bool: True se l'embedding è stato salvato
+    """
+    try:
+        indicizza_note([nota])
+        return True
+    except Exception as e:
+        logger.warning(f"Embedding della nota {nota.id} non calcolato: {e}")
+        return False
+
+
+class IndicePaziente:
+    """Embedding di un paziente in ordine cronologico: id delle note, date (timestamp) e matrice."""
+
+    def __init__(self, ids, date, matrice):
+        self.ids = ids
+        self.date = date
+        self.matrice = matrice
+        self._posizioni = None
+
+    def posizione(self, nota_id):
+        """Indice della riga della nota, o None se la nota non è indicizzata."""
+        if self._posizioni is None:
+            self._posizioni = {nota_id: i for i, nota_id in enumerate(self.ids.tolist())}
+        return self._posizioni.get(nota_id)
+
+    def cerca(self, vettore, k, prima_di=None, escludi_ultime=0, soglia=None):
+        """
+        Restituisce le k note più simili al vettore, come lista di (nota_id, punteggio)
+        in ordine di similarità decrescente.
+
+        Args:
+            vettore: Embedding normalizzato della ricerca
+            k: Numero massimo di risultati
+            prima_di: Timestamp: si cercano solo le note precedenti
+            escludi_ultime: Esclude le ultime N note tra quelle candidate
+                            (ad esempio quelle già presenti nel contesto recente)
+            soglia: Similarità minima dei risultati
+        """
+        # Le righe sono in ordine di data: le candidate sono un prefisso della matrice
+        fine = len(self.ids) if prima_di is None else int(np.searchsorted(self.date, prima_di, side='left'))
+        fine = max(0, fine - escludi_ultime)
+        if fine == 0 or k <= 0:
+            return []
+
+        punteggi = self.matrice[:fine] @ vettore
+        if k < fine:
+            migliori = np.argpartition(punteggi, -k)[-k:]
+        else:
+            migliori = np.arange(fine)
+        migliori = migliori[np.argsort(punteggi[migliori])[::-1]]
+        if soglia is not None:
+            migliori = migliori[punteggi[migliori] >= soglia]
+        return [(int(self.ids[i]), float(punteggi[i])) for i in migliori]
+
+
+def _carica_indice(righe):
+    righe = list(righe)
+    if not righe:
+        return IndicePaziente(np.empty(0, dtype=np.int64), np.empty(0), np.empty((0, 0), dtype=np.float32))
+    ids = np.fromiter((riga[0] for riga in righe), dtype=np.int64, count=len(righe))
+    date = np.fromiter((riga[1].timestamp() for riga in righe), dtype=np.float64, count=len(righe))
+    matrice = np.frombuffer(b''.join(bytes(riga[2]) for riga in righe), dtype=np.float32).reshape(len(righe), -1)
+    return IndicePaziente(ids, date, matrice)
+
+
+def indice_paziente(paziente_id):
+    """
+    Restituisce l'indice degli embedding del paziente per il modello in uso,
+    dalla cache del processo se le note indicizzate non sono cambiate.
+    """
+    modello = modello_embedding()
+    embedding = EmbeddingNota.objects.filter(paz_id=paziente_id, modello=modello)
+    versione = tuple(embedding.aggregate(numero=Count('id'), ultimo=Max('id')).values())
+    chiave = (paziente_id, modello)
+
+    with _cache_lock:
+        valore = _cache.get(chiave)
+        if valore is not None and valore[0] == versione:
+            _cache.move_to_end(chiave)
+            return valore[1]
+
+    indice = _carica_indice(embedding.order_by('data_nota', 'nota_id').values_list('nota_id', 'data_nota', 'vettore'))
+    with _cache_lock:
+        _cache[chiave] = (versione, indice)
+        _cache.move_to_end(chiave)
+        while len(_cache) > DIMENSIONE_CACHE:
+            _cache.popitem(last=False)
+    return indice
+
+
+def svuota_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def note_simili(paziente_id, testo=None, nota_id=None, k=None, prima_di=None, escludi_ultime=0):
+    """
+    Cerca le note del paziente più simili a una nota indicizzata (nota_id) o a un testo.
+    Con nota_id si cercano solo le note precedenti a quella nota, esclusa la nota stessa.
+
+    Args:
+        paziente_id: Codice fiscale del paziente
+        testo: Testo da confrontare, se la nota non è indicizzata
+        nota_id: Nota da confrontare (opzionale)
+        k: Numero di risultati (default: settings.NOTE_SIMILI_K)
+        prima_di: datetime: si cercano solo le note precedenti (opzionale)
+        escludi_ultime: Esclude le ultime N note tra quelle candidate
+
+    Returns:
+        Lista di (nota_id, punteggio) in ordine di similarità decrescente
+    """
+    k = _config('NOTE_SIMILI_K', 3) if k is None else k
+    indice = indice_paziente(paziente_id)
+    if not len(indice.ids):
+        # Nessuna nota indicizzata: non serve calcolare l'embedding della ricerca
+        return []
+    prima_di = prima_di.timestamp() if prima_di is not None else None
+
+    posizione = indice.posizione(nota_id) if nota_id is not None else None
+    if posizione is not None:
+        vettore = indice.matrice[posizione]
+        prima_di = indice.date[posizione] if prima_di is None else min(prima_di, indice.date[posizione])
+    elif testo:
+        vettore = calcola_embedding([testo])[0]
+        if nota_id is not None and prima_di is None:
+            # Nota non ancora indicizzata: la sua data si legge dal database
+            data_nota = NotaDiario.objects.filter(id=nota_id).values_list('data_nota', flat=True).first()
+            prima_di = data_nota.timestamp() if data_nota is not None else None
+    else:
+        return []
+
+    if vettore.shape[0] != indice.matrice.shape[1]:
+        logger.warning(f"Dimensione degli embedding del paziente {paziente_id} diversa da quella del modello")
+        return []
+    return indice.cerca(vettore, k, prima_di=prima_di, escludi_ultime=escludi_ultime,
+                        soglia=_config('NOTE_SIMILI_SOGLIA', 0.3))
+
+
+def note_simili_al_periodo(paziente_id, dal, k=None):
+    """
+    Cerca le note precedenti a 'dal' più simili, nel complesso, alle note del
+    periodo che inizia in quella data (confrontate con il loro embedding medio).
+
+    Returns:
+        Lista di (nota_id, punteggio) in ordine di similarità decrescente
+    """
+    k = _config('NOTE_SIMILI_K', 3) if k is None else k
+    indice = indice_paziente(paziente_id)
+    inizio = int(np.searchsorted(indice.date, dal.timestamp(), side='left'))
+    if inizio == 0 or inizio == len(indice.ids):
+        return []
+
+    centroide = indice.matrice[inizio:].mean(axis=0)
+    norma = np.linalg.norm(centroide)
+    if norma == 0:
+        return []
+    return indice.cerca(centroide / norma, k, prima_di=dal.timestamp(), soglia=_config('NOTE_SIMILI_SOGLIA', 0.3))
@@ -0,0 +1,232 @@
+"""
+Pub/sub degli eventi dell'applicazione (ad esempio "analisi della nota completata").
+
+I worker pubblicano un evento su un canale (uno per medico) appena salvano l'analisi
+di una nota; le view di long-poll restano in attesa sul canale e rispondono subito,
+senza che il browser debba interrogare il server a intervalli fissi.
+
+Broker disponibili (settings.EVENTI_BROKER):
+    'locale':   in memoria, solo all'interno dello stesso processo (usato nei test
+                e quando analisi e server web girano nello stesso processo)
+    'postgres': LISTEN/NOTIFY di PostgreSQL, per consegnare gli eventi pubblicati
+                dai worker (run_analysis_workers) al processo del server ASGI
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Canale PostgreSQL su cui vengono inoltrati tutti gli eventi
+CANALE_POSTGRES = 'souldiary_eventi'
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def canale_medico(medico_id):
+    """Restituisce il nome del canale degli eventi destinati a un medico."""
+    return f"medico:{medico_id}"
+
+
+def connessione_dedicata():
+    """
+    Apre una connessione psycopg2 in autocommit al database di default, fuori dal
+    pool di Django: può restare aperta a lungo e non è legata a un thread.
+    """
+    import psycopg2
+
+    db = settings.DATABASES['default']
+    conn = psycopg2.connect(
+        dbname=db['NAME'],
+        user=db.get('USER') or None,
+        password=db.get('PASSWORD') or None,
+        host=db.get('HOST') or None,
+        port=db.get('PORT') or None,
+    )
+    conn.autocommit = True
+    return conn
+
+
+class Iscrizione:
+    """
+    Iscrizione di una coroutine a un canale. Va creata prima di leggere lo stato dal
+    database, così che un evento pubblicato nel frattempo non vada perso.
+    """
+
+    def __init__(self, broker, canale):
+        self.broker = broker
+        self.canale = canale
+        self.loop = asyncio.get_running_loop()
+        self.evento = asyncio.Event()
+        self.dati = []
+
+    def notifica(self, dati):
+        # Chiamato dal thread che pubblica: l'evento va impostato nel thread del loop
+        try:
+            self.loop.call_soon_threadsafe(self._ricevi, dati)
+        except RuntimeError:
+            # Loop già chiuso (richiesta terminata)
+            pass
+
+    def _ricevi(self, dati):
+        self.dati.append(dati)
+        self.evento.set()
+
+    async def attendi(self, timeout):
+        """
+        Attende il primo evento sul canale per al più timeout secondi. Gli eventi
+        restituiti vengono consumati: un'attesa successiva attende eventi nuovi.
+
+        Returns:
+            list: Gli eventi ricevuti (vuota se scade il timeout)
+        """
+        try:
+            await asyncio.wait_for(self.evento.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        dati, self.dati = self.dati, []
+        self.evento.clear()
+        return dati
+
+    def chiudi(self):
+        self.broker.disiscrivi(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.chiudi()
+
+
+class BrokerLocale:
+    """Broker in memoria: consegna gli eventi alle iscrizioni dello stesso processo."""
+
+    def __init__(self):
+        self._iscrizioni = {}
+        self._lock = threading.Lock()
+
+    def iscrivi(self, canale):
+        """Crea un'iscrizione al canale (da chiamare dentro una coroutine)."""
+        iscrizione = Iscrizione(self, canale)
+        with self._lock:
+            self._iscrizioni.setdefault(canale, set()).add(iscrizione)
+        return iscrizione
+
+    def disiscrivi(self, iscrizione):
+        with self._lock:
+            iscritti = self._iscrizioni.get(iscrizione.canale)
+            if iscritti is not None:
+                iscritti.discard(iscrizione)
+                if not iscritti:
+                    del self._iscrizioni[iscrizione.canale]
+
+    def consegna(self, canale, dati):
+        """Consegna l'evento alle iscrizioni locali del canale."""
+        with self._lock:
+            iscritti = list(self._iscrizioni.get(canale, ()))
+        for iscrizione in iscritti:
+            iscrizione.notifica(dati)
+        return len(iscritti)
+
+    def pubblica(self, canale, dati):
+        """Pubblica un evento sul canale. Può essere chiamato da qualsiasi thread."""
+        self.consegna(canale, dati)
+
+
+class BrokerPostgres(BrokerLocale):
+    """
+    Broker basato su LISTEN/NOTIFY: gli eventi vengono inviati con pg_notify sulla
+    connessione del processo che pubblica, e un thread in ascolto in ogni processo
+    web li consegna alle iscrizioni locali.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._ascolto = None
+        self._ascolto_lock = threading.Lock()
+
+    def iscrivi(self, canale):
+        self._avvia_ascolto()
+        return super().iscrivi(canale)
+
+    def pubblica(self, canale, dati):
+        messaggio = json.dumps({'canale': canale, 'dati': dati})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [CANALE_POSTGRES, messaggio])
+
+    def _avvia_ascolto(self):
+        with self._ascolto_lock:
+            if self._ascolto is None or not self._ascolto.is_alive():
+                self._ascolto = threading.Thread(target=self._ciclo_ascolto, name='eventi-postgres', daemon=True)
+                self._ascolto.start()
+
+    def _connetti(self):
+        conn = connessione_dedicata()
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CANALE_POSTGRES}")
+        return conn
+
+    def _ciclo_ascolto(self):
+        conn = None
+        try:
+            conn = self._connetti()
+            logger.info(f"In ascolto degli eventi sul canale PostgreSQL {CANALE_POSTGRES}")
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notifica = conn.notifies.pop(0)
+                    try:
+                        messaggio = json.loads(notifica.payload)
+                        self.consegna(messaggio['canale'], messaggio['dati'])
+                    except (ValueError, KeyError) as e:
+                        logger.error(f"Evento non valido ricevuto da PostgreSQL: {e}")
+        except Exception as e:
+            # Il thread verrà riavviato alla prossima iscrizione
+            logger.error(f"Ascolto degli eventi PostgreSQL interrotto: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def get_broker():
+    """Restituisce il broker configurato in settings.EVENTI_BROKER."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                if getattr(settings, 'EVENTI_BROKER', 'locale') == 'postgres':
+                    _broker = BrokerPostgres()
+                else:
+                    _broker = BrokerLocale()
+    return _broker
+
+
+def imposta_broker(broker):
+    """Sostituisce il broker in uso (ad esempio con un BrokerLocale nei test)."""
+    global _broker
+    with _broker_lock:
+        _broker = broker
+
+
+def pubblica_nota_aggiornata(nota_id, paziente_id, medico_id):
+    """
+    Pubblica l'evento di analisi completata di una nota sul canale del medico.
+    Gli errori vengono solo registrati: la consegna degli eventi non deve mai
+    far fallire il salvataggio dell'analisi.
+    """
+    try:
+        get_broker().pubblica(canale_medico(medico_id), {
+            'tipo': 'nota_aggiornata',
+            'nota_id': nota_id,
+            'paziente_id': paziente_id,
+        })
+    except Exception as e:
+        logger.error(f"Errore nella pubblicazione dell'evento per la nota {nota_id}: {e}")
@@ -0,0 +1,235 @@
+"""
+Coda persistente dei job di analisi delle note, salvata nel database.
+
+I job vengono creati da paziente_home ed eseguiti dai worker avviati con
+``python manage.py run_analysis_workers``. Non serve un broker esterno:
+basta il database dell'applicazione (PostgreSQL o SQLite).
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from . import embeddings, eventi, llm_scheduler
+from .models import JobAnalisi, NotaDiario
+
+logger = logging.getLogger(__name__)
+
+STATI_ATTIVI = ('in_coda', 'in_esecuzione')
+
+
+def accoda_analisi(nota):
+    """
+    Accoda l'analisi clinica, sentiment e contesto sociale di una nota.
+
+    Args:
+        nota: Oggetto NotaDiario (deve avere generazione_in_corso=True)
+
+    Returns:
+        JobAnalisi: Il job creato
+    """
+    return JobAnalisi.objects.create(nota=nota, data_creazione=timezone.now())
+
+
+def assegna_job(note, worker):
+    """
+    Crea per ogni nota un job già in esecuzione, assegnato a chi elabora le note
+    fuori dalla coda (es. il comando reanalyze_notes). Così il recupero delle
+    note orfane non le riaccoda mentre sono in analisi.
+
+    Args:
+        note: Oggetti NotaDiario da elaborare
+        worker: Identificativo di chi esegue i job
+
+    Returns:
+        list: I JobAnalisi creati, nello stesso ordine delle note
+    """
+    adesso = timezone.now()
+    return JobAnalisi.objects.bulk_create([
+        JobAnalisi(
+            nota=nota, stato='in_esecuzione', worker=worker, tentativi=1,
+            data_creazione=adesso, data_inizio=adesso,
+        )
+        for nota in note
+    ])
+
+
+def preleva_job(worker):
+    """
+    Preleva il job in coda più vecchio e lo marca come in esecuzione.
+
+    Il passaggio di stato avviene con un UPDATE condizionato su stato='in_coda',
+    quindi due worker non possono prelevare lo stesso job anche senza
+    SELECT ... FOR UPDATE (non disponibile su SQLite).
+
+    Args:
+        worker: Identificativo del worker che preleva il job
+
+    Returns:
+        JobAnalisi o None se la coda è vuota
+    """
+    candidati = list(
+        JobAnalisi.objects.filter(stato='in_coda')
+        .order_by('data_creazione', 'id')
+        .values_list('id', flat=True)[:10]
+    )
+
+    for job_id in candidati:
+        prelevato = JobAnalisi.objects.filter(id=job_id, stato='in_coda').update(
+            stato='in_esecuzione',
+            worker=worker,
+            data_inizio=timezone.now(),
+            tentativi=F('tentativi') + 1,
+        )
+        if prelevato:
+            return JobAnalisi.objects.select_related('nota__paz__med').get(id=job_id)
+
+    return None
+
+
+def esegui_job(job):
+    """
+    Esegue l'analisi della nota associata al job e ne registra esito e tempi.
+
+    Args:
+        job: JobAnalisi prelevato con preleva_job
+
+    Returns:
+        bool: True se l'analisi è stata completata
+    """
+    # Import locale: views importa questo modulo
+    from .views import genera_analisi_in_background
+
+    nota = job.nota
+    inizio = timezone.now()
+    attesa_ms = int((inizio - job.data_creazione).total_seconds() * 1000)
+
+    # L'embedding serve al prompt clinico per cercare le note passate simili
+    if getattr(settings, 'NOTE_SIMILI_K', 3) > 0:
+        embeddings.indicizza_nota(nota)
+
+    with llm_scheduler.priorita('analisi', nota.paz.med_id):
+        completato = genera_analisi_in_background(nota.id, nota.testo_paziente, nota.paz.med, nota.paz)
+
+    fine = timezone.now()
+    durata_ms = int((fine - inizio).total_seconds() * 1000)
+    JobAnalisi.objects.filter(id=job.id).update(
+        stato='completato' if completato else 'fallito',
+        errore=None if completato else "Errore durante la generazione dell'analisi clinica.",
+        data_fine=fine,
+        attesa_ms=attesa_ms,
+        durata_ms=durata_ms,
+    )
+
+    logger.info(
+        f"Job {job.id} (nota {nota.id}) {'completato' if completato else 'fallito'} "
+        f"- attesa {attesa_ms} ms, esecuzione {durata_ms} ms, tentativo {job.tentativi}"
+    )
+    return completato
+
+
+def segna_job_fallito(job, errore):
+    """
+    Marca come fallito un job interrotto da un errore imprevisto e sblocca la
+    nota, che altrimenti resterebbe in generazione e verrebbe riaccodata dal
+    recupero delle note orfane a ogni avvio dei worker.
+    """
+    JobAnalisi.objects.filter(id=job.id).update(
+        stato='fallito',
+        errore=errore,
+        data_fine=timezone.now(),
+    )
+    NotaDiario.objects.filter(id=job.nota_id).update(
+        generazione_in_corso=False,
+        stato_analisi='fallita',
+        errore_analisi=errore,
+        data_modifica=timezone.now(),
+    )
+    eventi.pubblica_nota_aggiornata(job.nota_id, job.nota.paz_id, job.nota.paz.med_id)
+
+
+def recupera_job_bloccati(timeout_secondi, max_tentativi):
+    """
+    Recupera i job rimasti in esecuzione dopo un crash del worker e le note
+    rimaste con generazione_in_corso=True senza un job attivo.
+
+    I job bloccati da più di timeout_secondi vengono rimessi in coda; se hanno
+    esaurito i tentativi vengono marcati come falliti e la nota viene sbloccata.
+
+    Returns:
+        tuple: (job rimessi in coda, job falliti, note riaccodate)
+    """
+    limite = timezone.now() - timedelta(seconds=timeout_secondi)
+    bloccati = JobAnalisi.objects.filter(stato='in_esecuzione', data_inizio__lt=limite)
+
+    riaccodati = bloccati.filter(tentativi__lt=max_tentativi).update(
+        stato='in_coda',
+        worker=None,
+        data_inizio=None,
+    )
+
+    esauriti = list(bloccati.filter(tentativi__gte=max_tentativi).values_list('id', 'nota_id'))
+    if esauriti:
+        JobAnalisi.objects.filter(id__in=[job_id for job_id, _ in esauriti]).update(
+            stato='fallito',
+            errore='Job interrotto: numero massimo di tentativi raggiunto.',
+            data_fine=timezone.now(),
+        )
+        NotaDiario.objects.filter(id__in=[nota_id for _, nota_id in esauriti]).update(
+            generazione_in_corso=False,
+            stato_analisi='fallita',
+            errore_analisi='Job interrotto: numero massimo di tentativi raggiunto.',
+            data_modifica=timezone.now(),
+        )
+
+    # Note in generazione senza alcun job attivo (es. create prima della coda o job persi)
+    orfane = (
+        NotaDiario.objects.filter(generazione_in_corso=True)
+        .exclude(jobanalisi__stato__in=STATI_ATTIVI)
+        .exclude(id__in=[nota_id for _, nota_id in esauriti])
+    )
+    note_riaccodate = 0
+    for nota in orfane.only('id'):
+        accoda_analisi(nota)
+        note_riaccodate += 1
+
+    if riaccodati or esauriti or note_riaccodate:
+        logger.warning(
+            f"Recupero job: {riaccodati} rimessi in coda, {len(esauriti)} falliti, "
+            f"{note_riaccodate} note riaccodate"
+        )
+    return riaccodati, len(esauriti), note_riaccodate
+
+
+def ciclo_worker(worker, stop_event, intervallo_polling):
+    """
+    Ciclo principale di un worker: preleva ed esegue job finché stop_event non viene impostato.
+    """
+    try:
+        while not stop_event.is_set():
+            try:
+                job = preleva_job(worker)
+            except Exception as e:
+                logger.error(f"Worker {worker}: errore nel prelievo dei job: {e}")
+                connection.close()
+                stop_event.wait(intervallo_polling)
+                continue
+
+            if job is None:
+                stop_event.wait(intervallo_polling)
+                continue
+
+            try:
+                esegui_job(job)
+            except Exception as e:
+                logger.error(f"Worker {worker}: errore imprevisto nel job {job.id}: {e}")
+                try:
+                    segna_job_fallito(job, str(e))
+                except Exception as errore:
+                    logger.error(f"Worker {worker}: job {job.id} non marcato come fallito: {errore}")
+                    connection.close()
+    finally:
+        connection.close()
@@ -0,0 +1,354 @@
+"""
+Backend di generazione testo usati da genera_con_ollama e dalle sue varianti.
+
+Tutti i backend ricevono lo stesso payload (nel formato dell'API generate di
+Ollama: model, prompt, options.temperature, options.num_predict, format) e
+restituiscono risposte nello stesso formato (response, done e, se disponibili,
+le durate usate da llm_client.registra_metriche). Con embedding(testi) i
+backend calcolano anche gli embedding dei testi, con un modello locale
+(vedi embeddings.py).
+
+Backend disponibili (settings.LLM_BACKEND):
+    'ollama':    API HTTP di Ollama (predefinito)
+    'llama_cpp': modello GGUF caricato nel processo con llama_cpp_python, senza
+                 passaggio HTTP; adatto a installazioni su una sola macchina
+    'fake':      risposte deterministiche senza modello, per test e benchmark
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import queue
+import re
+import threading
+import time
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import llm_client
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _config(nome, default):
+    return getattr(settings, nome, default)
+
+
+class ErroreGenerazione(Exception):
+    """Errore generico durante la generazione."""
+
+
+class BackendNonRaggiungibile(ErroreGenerazione):
+    """Il servizio di generazione non è raggiungibile (connessione rifiutata o assente)."""
+
+
+class TimeoutGenerazione(ErroreGenerazione):
+    """La generazione non si è conclusa entro il timeout."""
+
+
+class BackendNonDisponibile(ErroreGenerazione):
+    """Il servizio ha risposto, ma con un errore (ad esempio modello mancante)."""
+
+
+class BackendOllama:
+    """Generazione tramite l'API HTTP di Ollama (vedi llm_client)."""
+
+    def __init__(self):
+        self.url = _config('OLLAMA_BASE_URL', "http://localhost:11434/api/generate")
+        self.modello = _config('OLLAMA_MODEL', "llama3.1:8b")
+        self.url_embedding = _config('OLLAMA_EMBED_URL', self.url.rsplit('/api/', 1)[0] + '/api/embed')
+        self.modello_embedding = _config('OLLAMA_EMBEDDING_MODEL', "nomic-embed-text")
+
+    def precarica(self):
+        pass
+
+    def _verifica(self, response):
+        if response.status_code != 200:
+            logger.error(f"Ollama ha restituito status code {response.status_code}")
+            logger.error(f"Risposta: {response.text}")
+            raise BackendNonDisponibile(f"status code {response.status_code}")
+
+    def genera(self, payload):
+        try:
+            response = llm_client.post_generate(dict(payload, model=self.modello), self.url)
+        except requests.exceptions.ConnectionError as e:
+            raise BackendNonRaggiungibile(str(e)) from e
+        except requests.exceptions.Timeout as e:
+            raise TimeoutGenerazione(str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise ErroreGenerazione(str(e)) from e
+        self._verifica(response)
+        return response.json()
+
+    async def agenera(self, payload):
+        try:
+            response = await llm_client.apost_generate(dict(payload, model=self.modello), self.url)
+        except httpx.ConnectError as e:
+            raise BackendNonRaggiungibile(str(e)) from e
+        except httpx.TimeoutException as e:
+            raise TimeoutGenerazione(str(e)) from e
+        except httpx.HTTPError as e:
+            raise ErroreGenerazione(str(e)) from e
+        self._verifica(response)
+        return response.json()
+
+    def stream(self, payload):
+        try:
+            yield from llm_client.stream_generate(dict(payload, model=self.modello), self.url)
+        except requests.exceptions.ConnectionError as e:
+            raise BackendNonRaggiungibile(str(e)) from e
+        except requests.exceptions.Timeout as e:
+            raise TimeoutGenerazione(str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise ErroreGenerazione(str(e)) from e
+
+    def embedding(self, testi):
+        """Embedding dei testi con l'endpoint /api/embed di Ollama (una richiesta per tutti i testi)."""
+        payload = {'model': self.modello_embedding, 'input': list(testi)}
+        try:
+            response = llm_client.post_generate(payload, self.url_embedding)
+        except requests.exceptions.ConnectionError as e:
+            raise BackendNonRaggiungibile(str(e)) from e
+        except requests.exceptions.Timeout as e:
+            raise TimeoutGenerazione(str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise ErroreGenerazione(str(e)) from e
+        self._verifica(response)
+        return response.json()['embeddings']
+
+
+class BackendLlamaCpp:
+    """
+    Generazione nel processo con llama_cpp_python.
+
+    Il modello viene caricato una sola volta e condiviso da tutti i thread. Ogni
+    istanza Llama ha una propria cache KV e può eseguire una generazione alla
+    volta: LLAMA_CPP_SLOT istanze formano un pool, e le richieste in eccesso
+    attendono uno slot libero. I pesi sono mappati in memoria (mmap), quindi
+    ogni slot aggiuntivo occupa in pratica solo la propria cache KV.
+    """
+
+    def __init__(self):
+        self.percorso = _config('LLAMA_CPP_MODEL_PATH', None)
+        if not self.percorso:
+            raise ImproperlyConfigured("LLM_BACKEND = 'llama_cpp' richiede LLAMA_CPP_MODEL_PATH")
+        self.modello = _config('LLAMA_CPP_MODEL_NAME', self.percorso)
+        self._slot = None
+        self._slot_lock = threading.Lock()
+        # Modello di embedding: un file GGUF separato, caricato alla prima richiesta
+        self.percorso_embedding = _config('LLAMA_CPP_EMBEDDING_MODEL_PATH', None)
+        self.modello_embedding = self.percorso_embedding
+        self._llm_embedding = None
+        self._embedding_lock = threading.Lock()
+
+    def _carica(self):
+        from llama_cpp import Llama
+
+        num_slot = max(1, _config('LLAMA_CPP_SLOT', 1))
+        slot = queue.Queue()
+        for _ in range(num_slot):
+            slot.put(Llama(
+                model_path=self.percorso,
+                n_ctx=_config('OLLAMA_NUM_CTX', 8192),
+                n_threads=_config('LLAMA_CPP_THREADS', None),
+                n_gpu_layers=_config('LLAMA_CPP_GPU_LAYERS', 0),
+                verbose=False,
+            ))
+        logger.info(f"Modello {self.percorso} caricato in {num_slot} slot")
+        return slot
+
+    def precarica(self):
+        """Carica il modello subito (ad esempio all'avvio dei worker) invece che alla prima richiesta."""
+        if self._slot is None:
+            with self._slot_lock:
+                if self._slot is None:
+                    self._slot = self._carica()
+        return self._slot
+
+    def stream(self, payload):
+        slot = self.precarica()
+        opzioni = payload.get('options', {})
+        argomenti = {
+            'messages': [{'role': 'user', 'content': payload['prompt']}],
+            'temperature': opzioni.get('temperature', 0.7),
+            'max_tokens': opzioni.get('num_predict', 500),
+            'stream': True,
+        }
+        if payload.get('format'):
+            argomenti['response_format'] = {'type': 'json_object', 'schema': payload['format']}
+
+        llm = slot.get()
+        try:
+            inizio = time.perf_counter_ns()
+            primo_token = None
+            frammenti = 0
+            for chunk in llm.create_chat_completion(**argomenti):
+                testo = chunk['choices'][0].get('delta', {}).get('content')
+                if testo:
+                    if primo_token is None:
+                        primo_token = time.perf_counter_ns()
+                    frammenti += 1
+                    yield {'response': testo, 'done': False}
+            fine = time.perf_counter_ns()
+            primo_token = primo_token or fine
+            # Stesse chiavi di Ollama: il tempo fino al primo token approssima la valutazione del prompt
+            yield {
+                'response': '',
+                'done': True,
+                'prompt_eval_count': len(llm.tokenize(payload['prompt'].encode('utf-8'))),
+                'prompt_eval_duration': primo_token - inizio,
+                'eval_count': frammenti,
+                'eval_duration': fine - primo_token,
+                'load_duration': 0,
+            }
+        except Exception as e:
+            raise ErroreGenerazione(str(e)) from e
+        finally:
+            slot.put(llm)
+
+    def genera(self, payload):
+        parti = []
+        risultato = {}
+        for frammento in self.stream(payload):
+            parti.append(frammento['response'])
+            if frammento.get('done'):
+                risultato = frammento
+        return dict(risultato, response=''.join(parti))
+
+    async def agenera(self, payload):
+        # La generazione occupa la CPU: gira in un thread, fuori dall'event loop
+        return await sync_to_async(self.genera, thread_sensitive=False)(payload)
+
+    def embedding(self, testi):
+        """Embedding dei testi con il modello LLAMA_CPP_EMBEDDING_MODEL_PATH, un testo alla volta."""
+        if not self.percorso_embedding:
+            raise BackendNonDisponibile("LLAMA_CPP_EMBEDDING_MODEL_PATH non configurato")
+        from llama_cpp import Llama
+
+        with self._embedding_lock:
+            if self._llm_embedding is None:
+                self._llm_embedding = Llama(
+                    model_path=self.percorso_embedding,
+                    embedding=True,
+                    n_threads=_config('LLAMA_CPP_THREADS', None),
+                    n_gpu_layers=_config('LLAMA_CPP_GPU_LAYERS', 0),
+                    verbose=False,
+                )
+            try:
+                return self._llm_embedding.embed(list(testi))
+            except Exception as e:
+                raise ErroreGenerazione(str(e)) from e
+
+
+def risposta_fake(payload):
+    """Risposta deterministica: dipende solo dal prompt (e dallo schema, se presente)."""
+    impronta = hashlib.sha256(payload['prompt'].encode('utf-8')).hexdigest()[:8]
+    schema = payload.get('format')
+    if not schema:
+        return f"Testo simulato {impronta}."
+
+    valori = {}
+    for nome, proprieta in schema.get('properties', {}).items():
+        if proprieta.get('enum'):
+            valori[nome] = proprieta['enum'][int(impronta, 16) % len(proprieta['enum'])]
+        else:
+            valori[nome] = f"Testo simulato {impronta} per {nome}."
+    return json.dumps(valori, ensure_ascii=False)
+
+
+def embedding_fake(testo, dimensione=64):
+    """
+    Embedding deterministico senza modello: ogni parola incrementa una
+    componente scelta dal suo hash, quindi testi con parole in comune sono simili.
+    """
+    vettore = [0.0] * dimensione
+    for parola in re.findall(r"\w+", testo.lower()):
+        impronta = int(hashlib.md5(parola.encode('utf-8')).hexdigest()[:8], 16)
+        vettore[impronta % dimensione] += 1.0
+    return vettore
+
+
+class BackendFake:
+    """
+    Backend senza modello per test e benchmark. La risposta è calcolata da
+    genera_risposta(payload) (predefinita: deterministica sul prompt) dopo una
+    latenza simulata di LLM_FAKE_LATENZA_MS millisecondi.
+    """
+
+    modello = 'fake'
+    modello_embedding = 'fake'
+
+    def __init__(self, genera_risposta=None, latenza_ms=None):
+        self.genera_risposta = genera_risposta or risposta_fake
+        self.latenza_ms = _config('LLM_FAKE_LATENZA_MS', 0) if latenza_ms is None else latenza_ms
+        self.richieste = []
+
+    def precarica(self):
+        pass
+
+    def _risultato(self, payload, testo):
+        self.richieste.append(payload)
+        return {
+            'response': testo,
+            'done': True,
+            'prompt_eval_count': len(payload['prompt'].split()),
+            'prompt_eval_duration': int(self.latenza_ms * 1e6),
+            'eval_count': len(testo.split()),
+            'eval_duration': 0,
+            'load_duration': 0,
+        }
+
+    def genera(self, payload):
+        testo = self.genera_risposta(payload)
+        if self.latenza_ms:
+            time.sleep(self.latenza_ms / 1000)
+        return self._risultato(payload, testo)
+
+    async def agenera(self, payload):
+        testo = self.genera_risposta(payload)
+        if self.latenza_ms:
+            await asyncio.sleep(self.latenza_ms / 1000)
+        return self._risultato(payload, testo)
+
+    def stream(self, payload):
+        risultato = self.genera(payload)
+        for parola in risultato['response'].split(' '):
+            yield {'response': parola + ' ', 'done': False}
+        yield dict(risultato, response='')
+
+    def embedding(self, testi):
+        return [embedding_fake(testo) for testo in testi]
+
+
+BACKENDS = {
+    'ollama': BackendOllama,
+    'llama_cpp': BackendLlamaCpp,
+    'fake': BackendFake,
+}
+
+
+def get_backend():
+    """Restituisce il backend configurato in settings.LLM_BACKEND, creandolo alla prima chiamata."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                nome = _config('LLM_BACKEND', 'ollama')
+                if nome not in BACKENDS:
+                    raise ImproperlyConfigured(f"LLM_BACKEND non valido: {nome!r} (valori ammessi: {', '.join(BACKENDS)})")
+                _backend = BACKENDS[nome]()
+    return _backend
+
+
+def imposta_backend(backend):
+    """Sostituisce il backend in uso (ad esempio con un BackendFake nei test)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,137 @@
+"""
+Cache persistente delle risposte LLM, indirizzata dal contenuto della richiesta.
+
+La chiave è l'hash SHA-256 di (modello, prompt, temperatura, num_predict, formato,
+num_ctx):
+due richieste identiche restituiscono la stessa risposta senza una nuova generazione.
+Il backend predefinito è diskcache (su disco, limitato in dimensione, eviction LRU);
+in alternativa si può usare la cache di Django (LLM_CACHE_BACKEND = 'django').
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _config(nome, default):
+    return getattr(settings, nome, default)
+
+
+def calcola_chiave(model, prompt, temperature, num_predict, formato=None, num_ctx=None):
+    """
+    Restituisce la chiave di cache (hash esadecimale) per i parametri di generazione.
+    num_ctx fa parte della chiave: una risposta troncata con una finestra di contesto
+    più piccola non va servita con una configurazione diversa.
+    """
+    contenuto = json.dumps(
+        [model, prompt, temperature, num_predict, formato, num_ctx],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(contenuto.encode('utf-8')).hexdigest()
+
+
+class _BackendDiskCache:
+    """Backend su disco basato su diskcache, condiviso tra processi."""
+
+    def __init__(self):
+        import diskcache
+
+        self.cache = diskcache.Cache(
+            directory=str(_config('LLM_CACHE_DIR', settings.BASE_DIR / 'llm_cache')),
+            size_limit=_config('LLM_CACHE_SIZE_LIMIT', 256 * 1024 * 1024),
+            eviction_policy='least-recently-used',
+            statistics=True,
+        )
+
+    def get(self, chiave):
+        return self.cache.get(chiave)
+
+    def set(self, chiave, valore, ttl):
+        self.cache.set(chiave, valore, expire=ttl)
+
+    def statistiche(self):
+        hits, misses = self.cache.stats()
+        return {'hits': hits, 'misses': misses, 'voci': len(self.cache), 'bytes': self.cache.volume()}
+
+
+class _BackendDjango:
+    """Backend basato sulla cache configurata in Django (settings.CACHES)."""
+
+    PREFISSO = 'llm:'
+
+    def _incrementa(self, contatore):
+        nome = f"{self.PREFISSO}stat:{contatore}"
+        django_cache.add(nome, 0, timeout=None)
+        try:
+            django_cache.incr(nome)
+        except ValueError:
+            pass
+
+    def get(self, chiave):
+        valore = django_cache.get(self.PREFISSO + chiave)
+        self._incrementa('hits' if valore is not None else 'misses')
+        return valore
+
+    def set(self, chiave, valore, ttl):
+        django_cache.set(self.PREFISSO + chiave, valore, timeout=ttl)
+
+    def statistiche(self):
+        return {
+            'hits': django_cache.get(f"{self.PREFISSO}stat:hits", 0),
+            'misses': django_cache.get(f"{self.PREFISSO}stat:misses", 0),
+        }
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if _config('LLM_CACHE_BACKEND', 'diskcache') == 'diskcache':
+                    try:
+                        _backend = _BackendDiskCache()
+                    except ImportError:
+                        logger.warning("diskcache non installato: uso la cache di Django per le risposte LLM")
+                        _backend = _BackendDjango()
+                else:
+                    _backend = _BackendDjango()
+    return _backend
+
+
+def abilitata():
+    return _config('LLM_CACHE_ENABLED', True)
+
+
+def leggi(chiave):
+    """Restituisce la risposta in cache per la chiave, o None."""
+    if not abilitata():
+        return None
+    try:
+        return _get_backend().get(chiave)
+    except Exception as e:
+        logger.error(f"Errore nella lettura della cache LLM: {e}")
+        return None
+
+
+def salva(chiave, testo):
+    """Salva una risposta generata con successo."""
+    if not abilitata() or not testo:
+        return
+    try:
+        _get_backend().set(chiave, testo, _config('LLM_CACHE_TTL', 60 * 60 * 24 * 7))
+    except Exception as e:
+        logger.error(f"Errore nel salvataggio della cache LLM: {e}")
+
+
+def statistiche():
+    """Restituisce i contatori di hit/miss della cache."""
+    return _get_backend().statistiche()
@@ -0,0 +1,224 @@
+"""
+Client HTTP condiviso per le chiamate a Ollama.
+
+Mantiene una sessione requests con pool di connessioni keep-alive, così che le
+chiamate generate per ogni nota (supporto, sentiment, contesto, nota clinica)
+riutilizzino le stesse connessioni TCP invece di aprirne una nuova ogni volta.
+Per le view asincrone è disponibile un client httpx.AsyncClient (apost_generate).
+
+Registra inoltre i tempi restituiti da Ollama per ogni generazione (valutazione
+del prompt, caricamento del modello, generazione della risposta), consultabili
+con metriche().
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+_metriche = {}
+_metriche_lock = threading.Lock()
+
+# Un client asincrono per event loop: un AsyncClient non può essere usato da loop diversi
+# (sotto WSGI ogni view async gira in un loop proprio, sotto ASGI il loop è unico)
+_client_async = weakref.WeakKeyDictionary()
+
+
+def _config(nome, default):
+    return getattr(settings, nome, default)
+
+
+def get_session():
+    """
+    Restituisce la sessione HTTP condivisa, creandola alla prima chiamata.
+    La sessione è thread-safe per l'uso concorrente da parte di più richieste.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=_config('OLLAMA_POOL_CONNECTIONS', 4),
+                    pool_maxsize=_config('OLLAMA_POOL_MAXSIZE', 10),
+                    max_retries=0,  # I tentativi sono gestiti in post_generate
+                )
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def chiudi_session():
+    """Chiude la sessione condivisa e rilascia le connessioni del pool."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_timeout():
+    """Restituisce la tupla (connect, read) dei timeout configurati."""
+    return (
+        _config('OLLAMA_CONNECT_TIMEOUT', 5),
+        _config('OLLAMA_READ_TIMEOUT', 300),
+    )
+
+
+def post_generate(payload, url=None, stream=False):
+    """
+    Invia il payload all'endpoint di generazione di Ollama usando la sessione condivisa.
+
+    Le connessioni rifiutate o resettate (ad esempio una connessione keep-alive chiusa
+    dal server) vengono ritentate con backoff esponenziale. I timeout di lettura non
+    vengono ritentati, per non duplicare generazioni lunghe.
+
+    Args:
+        payload: Dizionario JSON da inviare
+        url: Endpoint da chiamare (default: settings.OLLAMA_BASE_URL)
+        stream: Se True il corpo della risposta non viene scaricato subito (vedi stream_generate)
+
+    Returns:
+        requests.Response: La risposta di Ollama
+    """
+    url = url or _config('OLLAMA_BASE_URL', "http://localhost:11434/api/generate")
+    max_retries = _config('OLLAMA_MAX_RETRIES', 3)
+    backoff = _config('OLLAMA_BACKOFF_FACTOR', 0.5)
+
+    tentativo = 0
+    while True:
+        try:
+            return get_session().post(url, json=payload, timeout=get_timeout(), stream=stream)
+        except requests.exceptions.ConnectionError as e:
+            # ConnectTimeout è anche un ConnectionError: va ritentato come gli altri
+            if tentativo >= max_retries:
+                raise
+            attesa = backoff * (2 ** tentativo)
+            tentativo += 1
+            logger.warning(f"Connessione a Ollama fallita ({e}), tentativo {tentativo}/{max_retries} tra {attesa:.1f}s")
+            time.sleep(attesa)
+
+
+def stream_generate(payload, url=None):
+    """
+    Invia il payload con "stream": true e restituisce i frammenti JSON della risposta
+    NDJSON di Ollama man mano che arrivano.
+
+    Yields:
+        dict: Un frammento per riga (chiavi "response", "done", ...)
+    """
+    payload = dict(payload, stream=True)
+    response = post_generate(payload, url, stream=True)
+    try:
+        response.raise_for_status()
+        for riga in response.iter_lines():
+            if riga:
+                yield json.loads(riga)
+    finally:
+        # Restituisce la connessione al pool anche se il client interrompe lo streaming
+        response.close()
+
+
+def get_client_async():
+    """
+    Restituisce il client httpx asincrono associato all'event loop corrente,
+    creandolo alla prima chiamata. Le richieste oltre il limite di connessioni
+    attendono un posto libero nel pool senza timeout.
+    """
+    loop = asyncio.get_running_loop()
+    client = _client_async.get(loop)
+    if client is None:
+        connect, read = get_timeout()
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=_config('OLLAMA_POOL_MAXSIZE', 10),
+                max_keepalive_connections=_config('OLLAMA_POOL_MAXSIZE', 10),
+            ),
+            timeout=httpx.Timeout(connect=connect, read=read, write=connect, pool=None),
+        )
+        _client_async[loop] = client
+    return client
+
+
+async def apost_generate(payload, url=None):
+    """
+    Versione asincrona di post_generate: stessa politica di retry con backoff
+    esponenziale sulle connessioni fallite, senza occupare un thread durante l'attesa.
+
+    Returns:
+        httpx.Response: La risposta di Ollama
+    """
+    url = url or _config('OLLAMA_BASE_URL', "http://localhost:11434/api/generate")
+    max_retries = _config('OLLAMA_MAX_RETRIES', 3)
+    backoff = _config('OLLAMA_BACKOFF_FACTOR', 0.5)
+
+    tentativo = 0
+    while True:
+        try:
+            return await get_client_async().post(url, json=payload)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+            if tentativo >= max_retries:
+                raise
+            attesa = backoff * (2 ** tentativo)
+            tentativo += 1
+            logger.warning(f"Connessione a Ollama fallita ({e}), tentativo {tentativo}/{max_retries} tra {attesa:.1f}s")
+            await asyncio.sleep(attesa)
+
+
+def registra_metriche(risultato):
+    """
+    Registra i tempi di una generazione dalla risposta di Ollama (durate in
+    nanosecondi). Con la cache del prefisso attiva prompt_eval_count conta solo
+    i token del prompt effettivamente rivalutati.
+    """
+    if not isinstance(risultato, dict) or 'prompt_eval_duration' not in risultato:
+        return
+
+    prompt_token = risultato.get('prompt_eval_count', 0)
+    prompt_ms = risultato.get('prompt_eval_duration', 0) / 1e6
+    caricamento_ms = risultato.get('load_duration', 0) / 1e6
+    risposta_token = risultato.get('eval_count', 0)
+    risposta_ms = risultato.get('eval_duration', 0) / 1e6
+
+    with _metriche_lock:
+        _metriche['richieste'] = _metriche.get('richieste', 0) + 1
+        _metriche['prompt_token'] = _metriche.get('prompt_token', 0) + prompt_token
+        _metriche['prompt_ms'] = _metriche.get('prompt_ms', 0) + prompt_ms
+        _metriche['caricamento_ms'] = _metriche.get('caricamento_ms', 0) + caricamento_ms
+        _metriche['risposta_token'] = _metriche.get('risposta_token', 0) + risposta_token
+        _metriche['risposta_ms'] = _metriche.get('risposta_ms', 0) + risposta_ms
+
+    logger.info(
+        f"Ollama: prompt {prompt_token} token in {prompt_ms:.0f} ms, caricamento {caricamento_ms:.0f} ms, "
+        f"risposta {risposta_token} token in {risposta_ms:.0f} ms"
+    )
+
+
+def metriche():
+    """
+    Restituisce i totali delle generazioni registrate dall'avvio (o dall'ultimo
+    azzeramento) e le medie per richiesta in millisecondi.
+    """
+    with _metriche_lock:
+        totali = dict(_metriche)
+    richieste = totali.get('richieste', 0)
+    for chiave in ('prompt_ms', 'caricamento_ms', 'risposta_ms'):
+        totali[f"{chiave}_medio"] = totali.get(chiave, 0) / richieste if richieste else 0
+    return totali
+
+
+def azzera_metriche():
+    with _metriche_lock:
+        _metriche.clear()
@@ -0,0 +1,260 @@
+"""
+Scheduler locale delle generazioni LLM, davanti al backend (vedi llm_backends).
+
+Ollama esegue al più OLLAMA_NUM_PARALLEL generazioni alla volta e mette in coda
+le altre senza alcun ordine: una frase di supporto attesa dal paziente può
+finire dietro a un riassunto annuale. Lo scheduler limita le generazioni
+contemporanee del processo a LLM_MAX_PARALLELO (da allineare agli slot di
+Ollama) e assegna gli slot liberi per classe di priorità:
+
+    1. 'supporto':       frasi di supporto attese dal paziente
+    2. 'rigenerazione':  rigenerazioni richieste dal medico
+    3. 'analisi':        analisi delle note in background (predefinita)
+    4. 'riassunto':      riassunti del caso clinico e sintesi periodiche
+
+All'interno di una classe le richieste sono servite a turno per medico, così un
+medico che rigenera molte note non blocca gli altri. La classe si imposta per
+il codice chiamante con il context manager priorita(), che vale anche per le
+coroutine e i thread di sync_to_async avviati al suo interno.
+
+Il limite è per processo: con più processi (server web e worker) la somma dei
+loro LLM_MAX_PARALLELO non dovrebbe superare gli slot di Ollama.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Classi in ordine di priorità decrescente
+CLASSI = ('supporto', 'rigenerazione', 'analisi', 'riassunto')
+CLASSE_PREDEFINITA = 'analisi'
+
+# Attese oltre questa soglia vengono registrate nel log
+SOGLIA_ATTESA_LOG_MS = 5000
+
+_priorita = contextvars.ContextVar('llm_priorita', default=(CLASSE_PREDEFINITA, None))
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+@contextmanager
+def priorita(classe, medico_id=None):
+    """
+    Imposta la classe di priorità (e il medico, per il turno equo) delle
+    generazioni eseguite all'interno del blocco.
+    """
+    if classe not in CLASSI:
+        raise ValueError(f"Classe di priorità non valida: {classe!r}")
+    token = _priorita.set((classe, medico_id))
+    try:
+        yield
+    finally:
+        _priorita.reset(token)
+
+
+class _Attesa:
+    """Richiesta in coda: svegliata con un threading.Event o con un future del suo event loop."""
+
+    def __init__(self, classe, medico_id, loop=None):
+        self.classe = classe
+        self.medico_id = medico_id
+        self.inizio = time.perf_counter()
+        self.concessa = False
+        self.evento = threading.Event() if loop is None else None
+        self.loop = loop
+        self.futuro = loop.create_future() if loop is not None else None
+
+    def sveglia(self):
+        """Restituisce False se il destinatario non può più essere svegliato (loop chiuso)."""
+        if self.evento is not None:
+            self.evento.set()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(_completa_futuro, self.futuro)
+            return True
+        except RuntimeError:
+            return False
+
+
+def _completa_futuro(futuro):
+    if not futuro.done():
+        futuro.set_result(None)
+
+
+class Scheduler:
+    """Semaforo con code per classe di priorità e turni per medico."""
+
+    def __init__(self, slot):
+        self.slot = max(1, slot)
+        self.occupati = 0
+        self._lock = threading.Lock()
+        # Per ogni classe: medico -> coda delle sue richieste, nell'ordine dei turni
+        self._code = {classe: OrderedDict() for classe in CLASSI}
+        self._metriche = {}
+        self.azzera_metriche()
+
+    def azzera_metriche(self):
+        with self._lock:
+            self._metriche = {classe: {'servite': 0, 'attesa_ms': 0.0, 'attesa_max_ms': 0.0} for classe in CLASSI}
+
+    def _in_coda(self):
+        return any(self._code.values())
+
+    def _accoda(self, attesa):
+        self._code[attesa.classe].setdefault(attesa.medico_id, deque()).append(attesa)
+
+    def _rimuovi(self, attesa):
+        code = self._code[attesa.classe]
+        richieste = code.get(attesa.medico_id)
+        if richieste and attesa in richieste:
+            richieste.remove(attesa)
+            if not richieste:
+                del code[attesa.medico_id]
+
+    def _prossima(self):
+        for classe in CLASSI:
+            code = self._code[classe]
+            if code:
+                medico_id, richieste = code.popitem(last=False)
+                attesa = richieste.popleft()
+                if richieste:
+                    # Il medico torna in fondo al turno della sua classe
+                    code[medico_id] = richieste
+                return attesa
+        return None
+
+    def _registra_attesa(self, classe, inizio):
+        attesa_ms = (time.perf_counter() - inizio) * 1000
+        metriche = self._metriche[classe]
+        metriche['servite'] += 1
+        metriche['attesa_ms'] += attesa_ms
+        metriche['attesa_max_ms'] = max(metriche['attesa_max_ms'], attesa_ms)
+        if attesa_ms > SOGLIA_ATTESA_LOG_MS:
+            logger.info(f"Generazione '{classe}' rimasta in coda {attesa_ms:.0f} ms")
+
+    def _prova(self, classe, medico_id, loop=None):
+        """Occupa uno slot se libero e nessuno è in coda, altrimenti accoda e restituisce l'attesa."""
+        with self._lock:
+            if self.occupati < self.slot and not self._in_coda():
+                self.occupati += 1
+                self._registra_attesa(classe, time.perf_counter())
+                return None
+            attesa = _Attesa(classe, medico_id, loop)
+            self._accoda(attesa)
+            return attesa
+
+    def acquisisci(self, classe, medico_id=None):
+        attesa = self._prova(classe, medico_id)
+        if attesa is not None:
+            attesa.evento.wait()
+
+    async def aacquisisci(self, classe, medico_id=None):
+        attesa = self._prova(classe, medico_id, asyncio.get_running_loop())
+        if attesa is None:
+            return
+        try:
+            await attesa.futuro
+        except asyncio.CancelledError:
+            with self._lock:
+                concessa = attesa.concessa
+                if not concessa:
+                    self._rimuovi(attesa)
+            if concessa:
+                # Lo slot è stato assegnato mentre la richiesta veniva annullata
+                self.rilascia()
+            raise
+
+    def rilascia(self):
+        """Libera uno slot e lo assegna direttamente alla prossima richiesta in coda."""
+        while True:
+            with self._lock:
+                attesa = self._prossima()
+                if attesa is None:
+                    self.occupati -= 1
+                    return
+                # Lo slot passa alla richiesta senza tornare libero: nessuno può sorpassarla
+                attesa.concessa = True
+                self._registra_attesa(attesa.classe, attesa.inizio)
+            if attesa.sveglia():
+                return
+
+    def metriche(self):
+        """
+        Restituisce slot occupati, richieste in coda e tempi di attesa per classe.
+
+        Returns:
+            dict: {'slot', 'occupati', 'classi': {classe: {'in_coda', 'servite',
+                   'attesa_media_ms', 'attesa_max_ms'}}}
+        """
+        with self._lock:
+            classi = {}
+            for classe in CLASSI:
+                metriche = self._metriche[classe]
+                classi[classe] = {
+                    'in_coda': sum(len(richieste) for richieste in self._code[classe].values()),
+                    'servite': metriche['servite'],
+                    'attesa_media_ms': metriche['attesa_ms'] / metriche['servite'] if metriche['servite'] else 0.0,
+                    'attesa_max_ms': metriche['attesa_max_ms'],
+                }
+            return {'slot': self.slot, 'occupati': self.occupati, 'classi': classi}
+
+
+def get_scheduler():
+    """Restituisce lo scheduler del processo, creato alla prima chiamata con LLM_MAX_PARALLELO slot."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler(getattr(settings, 'LLM_MAX_PARALLELO', 4))
+    return _scheduler
+
+
+def imposta_scheduler(scheduler):
+    """Sostituisce lo scheduler in uso (ad esempio nei test, con un numero di slot diverso)."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+@contextmanager
+def slot(classe=None, medico_id=None):
+    """
+    Occupa uno slot di generazione per la durata del blocco, con la priorità
+    del contesto o con quella indicata.
+    """
+    if classe is None:
+        classe, medico_id = _priorita.get()
+    scheduler = get_scheduler()
+    scheduler.acquisisci(classe, medico_id)
+    try:
+        yield
+    finally:
+        scheduler.rilascia()
+
+
+@asynccontextmanager
+async def aslot():
+    """Versione asincrona di slot(): l'attesa in coda non occupa un thread."""
+    scheduler = get_scheduler()
+    await scheduler.aacquisisci(*_priorita.get())
+    try:
+        yield
+    finally:
+        scheduler.rilascia()
+
+
+def metriche():
+    """Metriche dello scheduler del processo (vedi Scheduler.metriche)."""
+    return get_scheduler().metriche()
+
+
+def azzera_metriche():
+    get_scheduler().azzera_metriche()
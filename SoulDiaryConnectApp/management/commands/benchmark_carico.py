@@ -0,0 +1,319 @@
+import json
+import math
+import platform
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from SoulDiaryConnectApp import llm_backends
+from SoulDiaryConnectApp.aggregati import ricostruisci_aggregati
+from SoulDiaryConnectApp.models import Medico, NotaDiario, Paziente
+from SoulDiaryConnectApp.ollama_simulato import OllamaSimulato
+from SoulDiaryConnectApp.views import CONTESTI_EMOJI, EMOZIONI_EMOJI
+
+# Prefisso degli identificativi dei dati generati: riconosciuti, riusati e rimossi con --pulisci
+PREFISSO = 'BENCH'
+
+# Versione del formato JSON dei risultati (da incrementare se cambia la struttura)
+VERSIONE_RISULTATI = 1
+
+TESTI = [
+    "Oggi al lavoro il mio capo mi ha criticato davanti a tutti e mi sono sentito umiliato.",
+    "Ho passato la serata con mia sorella, abbiamo riso molto e mi sento più leggero.",
+    "Non riesco a dormire, continuo a pensare all'esame di domani e ho il cuore che batte forte.",
+    "Sono andato in palestra dopo settimane e alla fine dell'allenamento ero soddisfatto.",
+    "Ho litigato con il mio compagno per una sciocchezza e poi non ci siamo parlati per ore.",
+]
+
+PERIODI_ANALISI = ['7days', '30days', '3months', 'year']
+
+
+def _percentile(valori_ordinati, percentuale):
+    """Percentile nearest-rank di una lista già ordinata."""
+    if not valori_ordinati:
+        return 0.0
+    posizione = max(1, math.ceil(percentuale / 100 * len(valori_ordinati)))
+    return valori_ordinati[posizione - 1]
+
+
+def _scenario_paziente_post(paziente, casuale, periodo_riassunto):
+    return 'paziente', paziente, 'post', '/paziente/home/', {'desc': casuale.choice(TESTI), 'generateResponse': 'on'}
+
+
+def _scenario_medico_home(paziente, casuale, periodo_riassunto):
+    return 'medico', paziente, 'get', '/medico/home/', {'paziente_id': paziente.codice_fiscale}
+
+
+def _scenario_analisi(paziente, casuale, periodo_riassunto):
+    return 'medico', paziente, 'get', '/medico/analisi/', {
+        'paziente_id': paziente.codice_fiscale, 'periodo': casuale.choice(PERIODI_ANALISI),
+    }
+
+
+def _scenario_riassunto(paziente, casuale, periodo_riassunto):
+    return 'medico', paziente, 'get', '/medico/riassunto/', {
+        'paziente_id': paziente.codice_fiscale, 'periodo': periodo_riassunto, 'genera': '1',
+    }
+
+
+# Ogni scenario restituisce (ruolo, paziente, metodo, url, dati) di una richiesta
+SCENARI = {
+    'paziente_post': _scenario_paziente_post,
+    'medico_home': _scenario_medico_home,
+    'analisi': _scenario_analisi,
+    'riassunto': _scenario_riassunto,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark di carico: genera pazienti e note (fino a milioni), avvia un Ollama simulato "
+        "e misura latenza (p50/p95/p99), query per richiesta e throughput delle pagine principali. "
+        "Con --json i risultati vengono salvati in un formato confrontabile tra versioni (--confronta)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--note', type=int, default=1000, help="Note totali nel dataset.")
+        parser.add_argument('--pazienti', type=int, default=20)
+        parser.add_argument('--medici', type=int, default=2)
+        parser.add_argument('--scenari', nargs='+', choices=list(SCENARI), default=list(SCENARI))
+        parser.add_argument('--richieste', type=int, default=50, help="Richieste per scenario.")
+        parser.add_argument('--concorrenza', type=int, default=1, help="Client in parallelo.")
+        parser.add_argument(
+            '--periodo-riassunto', choices=PERIODI_ANALISI, default='7days',
+            help="Periodo dei riassunti generati nello scenario 'riassunto'.",
+        )
+        parser.add_argument('--latenza-prompt-ms', type=float, default=50)
+        parser.add_argument('--latenza-token-ms', type=float, default=20)
+        parser.add_argument('--token-risposta', type=int, default=40)
+        parser.add_argument('--errori', type=float, default=0.0, help="Frazione di risposte 500 di Ollama.")
+        parser.add_argument(
+            '--ollama-url', default=None,
+            help="Usa un Ollama esistente (reale o simulato) invece di avviarne uno nel processo.",
+        )
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--json', default=None, help="File in cui salvare i risultati ('-' per stdout).")
+        parser.add_argument('--confronta', default=None, help="Risultati JSON di riferimento da confrontare.")
+        parser.add_argument('--pulisci', action='store_true', help="Rimuove i dati generati al termine.")
+
+    def handle(self, *args, **options):
+        if options['note'] < options['pazienti'] or options['pazienti'] < options['medici'] or options['medici'] < 1:
+            raise CommandError("Servono almeno un medico, un paziente per medico e una nota per paziente.")
+
+        riferimento = None
+        if options['confronta']:
+            with open(options['confronta'], encoding='utf-8') as file:
+                riferimento = json.load(file)
+
+        pazienti = self._prepara_dati(options)
+
+        simulato = None
+        url = options['ollama_url']
+        if url is None:
+            simulato = OllamaSimulato(
+                latenza_prompt_ms=options['latenza_prompt_ms'],
+                latenza_token_ms=options['latenza_token_ms'],
+                token_risposta=options['token_risposta'],
+                errori=options['errori'],
+                seed=options['seed'],
+            ).avvia()
+            url = simulato.url
+
+        # Backend HTTP verso l'Ollama del benchmark, senza cache: ogni riassunto arriva al modello
+        llm_backends.imposta_backend(None)
+        try:
+            with override_settings(LLM_BACKEND='ollama', OLLAMA_BASE_URL=url, LLM_CACHE_ENABLED=False):
+                risultati = self._esegui_scenari(pazienti, options)
+        finally:
+            llm_backends.imposta_backend(None)
+            if simulato is not None:
+                simulato.ferma()
+
+        dati = {
+            'versione': VERSIONE_RISULTATI,
+            'ambiente': {
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+            },
+            'configurazione': {
+                chiave: options[chiave] for chiave in (
+                    'note', 'pazienti', 'medici', 'richieste', 'concorrenza', 'periodo_riassunto',
+                    'latenza_prompt_ms', 'latenza_token_ms', 'token_risposta', 'errori', 'seed',
+                )
+            },
+            'ollama': simulato.conteggi if simulato is not None else None,
+            'scenari': risultati,
+        }
+
+        self._stampa(risultati, riferimento)
+
+        if options['json'] == '-':
+            self.stdout.write(json.dumps(dati, indent=2, sort_keys=True))
+        elif options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as file:
+                json.dump(dati, file, indent=2, sort_keys=True)
+                file.write('\n')
+            self.stdout.write(self.style.SUCCESS(f"Risultati salvati in {options['json']}"))
+
+        if options['pulisci']:
+            Medico.objects.filter(codice_identificativo__startswith=PREFISSO).delete()
+            self.stdout.write("Dati del benchmark rimossi.")
+
+    def _prepara_dati(self, options):
+        """Crea (o riusa, se ha le stesse dimensioni) il dataset del benchmark e ne restituisce i pazienti."""
+        pazienti = list(
+            Paziente.objects.filter(codice_fiscale__startswith=PREFISSO).select_related('med').order_by('codice_fiscale')
+        )
+        note = NotaDiario.objects.filter(paz__codice_fiscale__startswith=PREFISSO).count()
+        medici = Medico.objects.filter(codice_identificativo__startswith=PREFISSO).count()
+        if (len(pazienti), medici, note) == (options['pazienti'], options['medici'], options['note']):
+            self.stdout.write(f"Dataset esistente riusato: {note} note di {len(pazienti)} pazienti.")
+            return pazienti
+
+        Medico.objects.filter(codice_identificativo__startswith=PREFISSO).delete()
+        casuale = random.Random(options['seed'])
+        inizio = time.perf_counter()
+
+        medici = Medico.objects.bulk_create([
+            Medico(
+                codice_identificativo=f"{PREFISSO}{i:07d}", nome='Medico', cognome=f"Benchmark {i}",
+                indirizzo_studio='Via Roma', citta='Salerno', numero_civico='1',
+                email=f"medico{i}@benchmark.invalid", password='benchmark',
+            )
+            for i in range(options['medici'])
+        ])
+        pazienti = Paziente.objects.bulk_create([
+            Paziente(
+                codice_fiscale=f"{PREFISSO}{i:011d}", nome='Paziente', cognome=f"Benchmark {i}",
+                data_di_nascita='1990-01-01', med=medici[i % len(medici)],
+                email=f"paziente{i}@benchmark.invalid", password='benchmark',
+            )
+            for i in range(options['pazienti'])
+        ])
+
+        # Note distribuite sull'ultimo anno, già analizzate, inserite a blocchi
+        emozioni = list(EMOZIONI_EMOJI)
+        contesti = list(CONTESTI_EMOJI)
+        adesso = timezone.now()
+        blocco = []
+        for n in range(options['note']):
+            blocco.append(NotaDiario(
+                paz=pazienti[n % len(pazienti)],
+                testo_paziente=casuale.choice(TESTI),
+                testo_supporto="Frase di supporto generata per il benchmark.",
+                testo_clinico="Nota clinica generata per il benchmark.",
+                emozione_predominante=casuale.choice(emozioni),
+                spiegazione_emozione="Spiegazione dell'emozione.",
+                contesto_sociale=casuale.choice(contesti),
+                spiegazione_contesto="Spiegazione del contesto.",
+                stato_analisi='completata',
+                data_nota=adesso - timedelta(minutes=casuale.randrange(365 * 24 * 60)),
+            ))
+            if len(blocco) == 5000:
+                NotaDiario.objects.bulk_create(blocco)
+                blocco = []
+        NotaDiario.objects.bulk_create(blocco)
+
+        for paziente in pazienti:
+            ricostruisci_aggregati(paziente.codice_fiscale)
+
+        self.stdout.write(
+            f"Dataset creato in {time.perf_counter() - inizio:.1f} s: {options['note']} note, "
+            f"{len(pazienti)} pazienti, {len(medici)} medici."
+        )
+        return list(Paziente.objects.filter(codice_fiscale__startswith=PREFISSO).select_related('med'))
+
+    def _esegui_scenari(self, pazienti, options):
+        casuale = random.Random(options['seed'])
+        ultima_nota = NotaDiario.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        risultati = {}
+        try:
+            for nome in options['scenari']:
+                richieste = [
+                    SCENARI[nome](casuale.choice(pazienti), casuale, options['periodo_riassunto'])
+                    for _ in range(options['richieste'])
+                ]
+                risultati[nome] = self._esegui_scenario(richieste, options['concorrenza'])
+        finally:
+            # Le note scritte dallo scenario paziente_post vengono rimosse: il dataset resta riusabile
+            nuove = NotaDiario.objects.filter(id__gt=ultima_nota, paz__codice_fiscale__startswith=PREFISSO)
+            pazienti_modificati = set(nuove.values_list('paz_id', flat=True))
+            nuove.delete()
+            for paziente_id in pazienti_modificati:
+                ricostruisci_aggregati(paziente_id)
+        return risultati
+
+    def _esegui_scenario(self, richieste, concorrenza):
+        def esegui(blocco):
+            # Le eccezioni delle view diventano risposte 500, contate come errori
+            client = Client(raise_request_exception=False, SERVER_NAME='localhost')
+            misure = []
+            try:
+                for ruolo, paziente, metodo, url, dati in blocco:
+                    sessione = client.session
+                    sessione['user_type'] = ruolo
+                    sessione['user_id'] = paziente.codice_fiscale if ruolo == 'paziente' else paziente.med_id
+                    sessione.save()
+
+                    with CaptureQueriesContext(connection) as query:
+                        inizio = time.perf_counter()
+                        risposta = getattr(client, metodo)(url, dati)
+                        durata = time.perf_counter() - inizio
+                    misure.append((durata * 1000, len(query), risposta.status_code))
+            finally:
+                connection.close()
+            return misure
+
+        blocchi = [richieste[i::concorrenza] for i in range(concorrenza)]
+        inizio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concorrenza) as esecutore:
+            misure = [misura for parziali in esecutore.map(esegui, blocchi) for misura in parziali]
+        durata = time.perf_counter() - inizio
+
+        latenze = sorted(latenza for latenza, _, _ in misure)
+        query = [numero for _, numero, _ in misure]
+        return {
+            'richieste': len(misure),
+            'errori': sum(1 for _, _, stato in misure if stato >= 400),
+            'latenza_p50_ms': round(_percentile(latenze, 50), 2),
+            'latenza_p95_ms': round(_percentile(latenze, 95), 2),
+            'latenza_p99_ms': round(_percentile(latenze, 99), 2),
+            'latenza_max_ms': round(latenze[-1], 2) if latenze else 0.0,
+            'query_media': round(sum(query) / len(query), 2) if query else 0.0,
+            'query_max': max(query, default=0),
+            'throughput_rps': round(len(misure) / durata, 2) if durata else 0.0,
+        }
+
+    def _stampa(self, risultati, riferimento):
+        self.stdout.write(
+            f"{'scenario':>14} {'richieste':>9} {'errori':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} "
+            f"{'p99 (ms)':>9} {'query':>6} {'req/s':>7}"
+        )
+        for nome, valori in risultati.items():
+            self.stdout.write(
+                f"{nome:>14} {valori['richieste']:>9} {valori['errori']:>6} {valori['latenza_p50_ms']:>9.1f} "
+                f"{valori['latenza_p95_ms']:>9.1f} {valori['latenza_p99_ms']:>9.1f} "
+                f"{valori['query_media']:>6.1f} {valori['throughput_rps']:>7.1f}"
+            )
+
+        if not riferimento:
+            return
+        self.stdout.write("\nVariazione rispetto al riferimento:")
+        for nome, valori in risultati.items():
+            precedenti = riferimento.get('scenari', {}).get(nome)
+            if not precedenti:
+                continue
+            variazioni = []
+            for chiave in ('latenza_p50_ms', 'latenza_p95_ms', 'latenza_p99_ms', 'query_media', 'throughput_rps'):
+                if precedenti.get(chiave):
+                    variazioni.append(f"{chiave} {(valori[chiave] - precedenti[chiave]) / precedenti[chiave]:+.0%}")
+            self.stdout.write(f"{nome:>14}: {', '.join(variazioni)}")
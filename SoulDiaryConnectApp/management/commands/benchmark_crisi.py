@@ -0,0 +1,106 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from SoulDiaryConnectApp.aho_corasick import AhoCorasick
+from SoulDiaryConnectApp.views import CATEGORIE_CRISI
+
+# Frasi neutre usate per comporre diari lunghi senza contenuti di rischio
+FRASI_NEUTRE = [
+    "Oggi sono andato al lavoro e ho parlato a lungo con i colleghi.",
+    "La sera ho cucinato con mia sorella e abbiamo guardato un film.",
+    "Mi sento un po' stanco ma tutto sommato la giornata è andata bene.",
+    "Ho fatto una passeggiata al parco e ho pensato alle prossime vacanze.",
+    "Domani ho un esame e sono leggermente in ansia, ma ho studiato.",
+]
+
+
+def _rileva_lineare(testo, categorie):
+    """Implementazione precedente: una scansione del testo per ogni keyword."""
+    if not testo:
+        return False, 'none'
+    testo_lower = testo.lower()
+    for tipo, keywords in categorie:
+        for keyword in keywords:
+            if keyword in testo_lower:
+                return True, tipo
+    return False, 'none'
+
+
+def _rileva_automa(testo, automa, categorie):
+    """Stessa logica di rileva_contenuto_crisi, con un automa arbitrario."""
+    if not testo:
+        return False, 'none'
+    tipi_trovati = {tipo for _, _, _, tipo in automa.trova(testo.lower())}
+    for tipo, _ in categorie:
+        if tipo in tipi_trovati:
+            return True, tipo
+    return False, 'none'
+
+
+def _espandi_categorie(categorie, fattore):
+    """Aggiunge varianti sintetiche (che non compaiono nei testi) per simulare dizionari più grandi."""
+    if fattore <= 1:
+        return categorie
+    return [
+        (tipo, keywords + [f"{keyword} #{i}" for i in range(1, fattore) for keyword in keywords])
+        for tipo, keywords in categorie
+    ]
+
+
+class Command(BaseCommand):
+    help = "Confronta il matcher Aho-Corasick di rileva_contenuto_crisi con la scansione per keyword."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lunghezze', type=int, nargs='+', default=[1000, 10000, 50000],
+            help="Lunghezze (in caratteri) dei diari generati.",
+        )
+        parser.add_argument(
+            '--fattori-keyword', type=int, nargs='+', default=[1, 10],
+            help="Moltiplicatori del numero di keyword (1 = dizionario attuale).",
+        )
+        parser.add_argument('--ripetizioni', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        casuale = random.Random(options['seed'])
+        ripetizioni = options['ripetizioni']
+
+        self.stdout.write(
+            f"{'keyword':>8} {'caratteri':>10} {'caso':>14} {'lineare (ms)':>13} {'automa (ms)':>12} {'speedup':>8}"
+        )
+        for fattore in options['fattori_keyword']:
+            categorie = _espandi_categorie(CATEGORIE_CRISI, fattore)
+            num_keyword = sum(len(keywords) for _, keywords in categorie)
+            automa = AhoCorasick()
+            for tipo, keywords in categorie:
+                for keyword in keywords:
+                    automa.aggiungi(keyword, tipo)
+            automa.costruisci()
+
+            for lunghezza in options['lunghezze']:
+                testo = ''
+                while len(testo) < lunghezza:
+                    testo += casuale.choice(FRASI_NEUTRE) + ' '
+
+                # Caso peggiore per la scansione lineare: nessuna keyword, oppure solo l'ultima categoria alla fine
+                casi = {
+                    'nessun rischio': testo,
+                    'rischio finale': testo + ' ' + CATEGORIE_CRISI[-1][1][-1],
+                }
+                for nome, campione in casi.items():
+                    if _rileva_lineare(campione, categorie) != _rileva_automa(campione, automa, categorie):
+                        self.stderr.write(self.style.ERROR(f"Risultati diversi per il caso '{nome}' ({lunghezza} caratteri)"))
+
+                    lineare = min(timeit.repeat(
+                        lambda: _rileva_lineare(campione, categorie), number=ripetizioni, repeat=3
+                    )) / ripetizioni
+                    con_automa = min(timeit.repeat(
+                        lambda: _rileva_automa(campione, automa, categorie), number=ripetizioni, repeat=3
+                    )) / ripetizioni
+                    self.stdout.write(
+                        f"{num_keyword:>8} {lunghezza:>10} {nome:>14} {lineare * 1000:>13.3f} "
+                        f"{con_automa * 1000:>12.3f} {lineare / con_automa:>7.1f}x"
+                    )
@@ -0,0 +1,79 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from SoulDiaryConnectApp import llm_client
+from SoulDiaryConnectApp.models import Paziente
+from SoulDiaryConnectApp.views import (
+    _genera_prompt_non_strutturato_breve,
+    LUNGHEZZA_NOTA_BREVE,
+    analizza_contesto_sociale,
+    analizza_sentiment,
+    genera_con_ollama,
+    genera_frasi_di_supporto,
+)
+
+NOMI = ['Luca', 'Giulia', 'Marco', 'Sara', 'Paolo', 'Elena', 'Davide', 'Chiara']
+COGNOMI = ['Rossi', 'Bianchi', 'Esposito', 'Romano', 'Colombo', 'Ricci', 'Marino', 'Greco']
+
+TESTI = [
+    "Oggi al lavoro il mio capo mi ha criticato davanti a tutti e mi sono sentito umiliato.",
+    "Ho passato la serata con mia sorella, abbiamo riso molto e mi sento più leggero.",
+    "Non riesco a dormire, continuo a pensare all'esame di domani e ho il cuore che batte forte.",
+    "Sono andato in palestra dopo settimane e alla fine dell'allenamento ero soddisfatto.",
+]
+
+
+def _nota_clinica(testo, paziente):
+    prompt = _genera_prompt_non_strutturato_breve(
+        testo, LUNGHEZZA_NOTA_BREVE, "Nessuna nota precedente disponibile.", paziente
+    )
+    return genera_con_ollama(prompt, max_chars=LUNGHEZZA_NOTA_BREVE, temperature=0.6)
+
+
+COMPITI = {
+    'supporto': genera_frasi_di_supporto,
+    'sentiment': analizza_sentiment,
+    'contesto': analizza_contesto_sociale,
+    'clinica': _nota_clinica,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura il tempo di valutazione del prompt di Ollama per ogni compito, su pazienti "
+        "e testi diversi: la prima richiesta valuta tutto il prompt, le successive dovrebbero "
+        "rivalutare solo la parte che segue il prefisso statico."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--richieste', type=int, default=5, help="Richieste per compito.")
+        parser.add_argument('--compiti', nargs='+', choices=list(COMPITI), default=list(COMPITI))
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        casuale = random.Random(options['seed'])
+
+        self.stdout.write(
+            f"{'compito':>10} {'richiesta':>9} {'token prompt':>13} {'prompt (ms)':>12} "
+            f"{'caricamento (ms)':>17} {'risposta (ms)':>14}"
+        )
+        # Senza cache delle risposte: ogni richiesta deve arrivare al modello
+        with override_settings(LLM_CACHE_ENABLED=False):
+            for compito in options['compiti']:
+                genera = COMPITI[compito]
+                for numero in range(1, options['richieste'] + 1):
+                    paziente = Paziente(nome=casuale.choice(NOMI), cognome=casuale.choice(COGNOMI))
+                    llm_client.azzera_metriche()
+                    genera(casuale.choice(TESTI), paziente)
+
+                    metriche = llm_client.metriche()
+                    if not metriche.get('richieste'):
+                        self.stderr.write(self.style.ERROR(f"{compito}: nessuna metrica ricevuta da Ollama"))
+                        continue
+                    self.stdout.write(
+                        f"{compito:>10} {numero:>9} {metriche['prompt_token']:>13} "
+                        f"{metriche['prompt_ms']:>12.0f} {metriche['caricamento_ms']:>17.0f} "
+                        f"{metriche['risposta_ms']:>14.0f}"
+                    )
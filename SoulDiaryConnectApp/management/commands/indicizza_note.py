@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from SoulDiaryConnectApp.contesto_note import svuota_simili
+from SoulDiaryConnectApp.embeddings import DIMENSIONE_LOTTO, indicizza_note, modello_embedding
+from SoulDiaryConnectApp.models import NotaDiario
+
+
+class Command(BaseCommand):
+    help = (
+        "Calcola gli embedding delle note non ancora indicizzate (o di tutte con --tutte), "
+        "usati per cercare le note passate più simili."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--paziente', default=None,
+            help="Codice fiscale del paziente da indicizzare (default: tutti i pazienti).",
+        )
+        parser.add_argument('--tutte', action='store_true', help="Ricalcola anche le note già indicizzate.")
+        parser.add_argument('--lotto', type=int, default=DIMENSIONE_LOTTO, help="Note per richiesta al backend.")
+
+    def handle(self, *args, **options):
+        note = NotaDiario.objects.only('id', 'paz_id', 'data_nota', 'testo_paziente').order_by('id')
+        if options['paziente']:
+            note = note.filter(paz_id=options['paziente'])
+        if not options['tutte']:
+            note = note.exclude(embedding__modello=modello_embedding())
+
+        indicizzate = 0
+        lotto = []
+        for nota in note.iterator():
+            lotto.append(nota)
+            if len(lotto) >= options['lotto']:
+                indicizzate += indicizza_note(lotto)
+                lotto = []
+        indicizzate += indicizza_note(lotto)
+        if indicizzate:
+            # Le note simili salvate nei riepiloghi non considerano le note appena indicizzate
+            svuota_simili(options['paziente'])
+        self.stdout.write(self.style.SUCCESS(f"Note indicizzate: {indicizzate}."))
@@ -0,0 +1,47 @@
+import threading
+
+from django.core.management.base import BaseCommand
+
+from SoulDiaryConnectApp.ollama_simulato import OllamaSimulato
+
+
+class Command(BaseCommand):
+    help = (
+        "Avvia un server che simula l'API generate di Ollama (latenza per token, streaming, "
+        "errori), da usare come OLLAMA_BASE_URL nei test di carico."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--porta', type=int, default=11435)
+        parser.add_argument('--latenza-prompt-ms', type=float, default=50)
+        parser.add_argument('--latenza-token-ms', type=float, default=20)
+        parser.add_argument('--token-risposta', type=int, default=40, help="Token generati per risposta.")
+        parser.add_argument('--errori', type=float, default=0.0, help="Frazione di richieste con errore 500.")
+        parser.add_argument(
+            '--disconnessioni', type=float, default=0.0,
+            help="Frazione di richieste a cui viene chiusa la connessione senza risposta.",
+        )
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        simulato = OllamaSimulato(
+            host=options['host'],
+            porta=options['porta'],
+            latenza_prompt_ms=options['latenza_prompt_ms'],
+            latenza_token_ms=options['latenza_token_ms'],
+            token_risposta=options['token_risposta'],
+            errori=options['errori'],
+            disconnessioni=options['disconnessioni'],
+            seed=options['seed'],
+        )
+        with simulato:
+            self.stdout.write(self.style.SUCCESS(f"Ollama simulato in ascolto su {simulato.url}"))
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(
+            f"Richieste: {simulato.conteggi['richieste']}, errori: {simulato.conteggi['errori']}, "
+            f"disconnessioni: {simulato.conteggi['disconnessioni']}"
+        )
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+
+from SoulDiaryConnectApp import jobs
+from SoulDiaryConnectApp.models import NotaDiario
+
+logger = logging.getLogger(__name__)
+
+
+def _rianalizza(job):
+    try:
+        return jobs.esegui_job(job)
+    except Exception as e:
+        logger.error(f"Rianalisi della nota {job.nota_id}: errore imprevisto: {e}")
+        jobs.segna_job_fallito(job, str(e))
+        return False
+
+
+class Command(BaseCommand):
+    help = (
+        "Rianalizza le note con analisi fallita o mancante (ad esempio dopo un'interruzione di Ollama), "
+        "a lotti e con parallelismo limitato. L'avanzamento viene salvato in un checkpoint: "
+        "un'esecuzione interrotta riprende dall'ultimo lotto completato."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'ANALISI_WORKERS', 2),
+            help="Numero massimo di analisi eseguite in parallelo.",
+        )
+        parser.add_argument('--batch-size', type=int, default=20, help="Note per lotto (il checkpoint è salvato a ogni lotto).")
+        parser.add_argument('--limit', type=int, default=None, help="Numero massimo di note da rianalizzare.")
+        parser.add_argument('--patient', default=None, help="Codice fiscale del paziente (default: tutti i pazienti).")
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(settings.BASE_DIR, 'reanalyze_notes.checkpoint.json'),
+            help="File in cui salvare l'avanzamento.",
+        )
+        parser.add_argument('--reset', action='store_true', help="Ignora il checkpoint e riparte dalla prima nota.")
+        parser.add_argument('--dry-run', action='store_true', help="Mostra le note da rianalizzare senza modificarle.")
+
+    def _candidate(self, options):
+        # Analisi fallite, o mai eseguite per note che non sono in coda
+        note = NotaDiario.objects.filter(
+            Q(stato_analisi='fallita') | Q(stato_analisi='in_attesa', generazione_in_corso=False)
+        ).exclude(jobanalisi__stato__in=jobs.STATI_ATTIVI)
+        if options['patient']:
+            note = note.filter(paz_id=options['patient'])
+        return note
+
+    def _leggi_checkpoint(self, percorso):
+        try:
+            with open(percorso, encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _salva_checkpoint(self, percorso, stato):
+        temporaneo = f"{percorso}.tmp"
+        with open(temporaneo, 'w', encoding='utf-8') as file:
+            json.dump(stato, file)
+        os.replace(temporaneo, percorso)
+
+    def _dry_run(self, note):
+        totale = note.count()
+        self.stdout.write(f"Note da rianalizzare: {totale}")
+        errori = note.values('stato_analisi', 'errore_analisi').annotate(numero=Count('id')).order_by('-numero')[:10]
+        for riga in errori:
+            self.stdout.write(f"  {riga['numero']:>6}  [{riga['stato_analisi']}] {riga['errore_analisi'] or 'analisi mancante'}")
+        primi = list(note.order_by('id').values_list('id', flat=True)[:20])
+        if primi:
+            self.stdout.write(f"Prime note: {', '.join(map(str, primi))}")
+
+    def handle(self, *args, **options):
+        percorso = options['checkpoint']
+        dimensione_lotto = max(1, options['batch_size'])
+        num_workers = max(1, options['workers'])
+
+        stato = None if options['reset'] else self._leggi_checkpoint(percorso)
+        if stato is None:
+            stato = {'ultimo_id': 0, 'elaborate': 0, 'riuscite': 0, 'fallite': 0}
+        elif not options['dry_run']:
+            self.stdout.write(f"Ripresa dal checkpoint: note successive alla {stato['ultimo_id']}")
+
+        note = self._candidate(options).filter(id__gt=stato['ultimo_id'])
+        if options['dry_run']:
+            self._dry_run(note)
+            return
+
+        totale = note.count()
+        if options['limit'] is not None:
+            totale = min(totale, options['limit'])
+        self.stdout.write(f"Note da rianalizzare: {totale} (lotti da {dimensione_lotto}, {num_workers} in parallelo)")
+
+        worker = f"reanalyze_notes:{socket.gethostname()}:{os.getpid()}"
+        inizio = time.monotonic()
+        elaborate = 0
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='rianalisi') as executor:
+            while elaborate < totale:
+                lotto = list(
+                    note.filter(id__gt=stato['ultimo_id'])
+                    .select_related('paz__med')
+                    .order_by('id')[:min(dimensione_lotto, totale - elaborate)]
+                )
+                if not lotto:
+                    break
+
+                # Un job in esecuzione per ogni nota: il recupero dei worker non la considera orfana.
+                # Le note tornano "in generazione" per il medico finché l'analisi non termina
+                job_lotto = jobs.assegna_job(lotto, worker)
+                NotaDiario.objects.filter(id__in=[nota.id for nota in lotto]).update(generazione_in_corso=True)
+                esiti = list(executor.map(_rianalizza, job_lotto))
+
+                riuscite = sum(esiti)
+                elaborate += len(lotto)
+                stato.update(
+                    ultimo_id=lotto[-1].id,
+                    elaborate=stato['elaborate'] + len(lotto),
+                    riuscite=stato['riuscite'] + riuscite,
+                    fallite=stato['fallite'] + len(lotto) - riuscite,
+                )
+                self._salva_checkpoint(percorso, stato)
+
+                trascorso = time.monotonic() - inizio
+                velocita = elaborate / trascorso if trascorso else 0.0
+                rimanenti = (totale - elaborate) / velocita if velocita else 0.0
+                self.stdout.write(
+                    f"{elaborate}/{totale} note ({riuscite}/{len(lotto)} riuscite nel lotto) "
+                    f"- {velocita * 60:.1f} note/min, fine stimata tra {rimanenti:.0f} s"
+                )
+
+        if not note.filter(id__gt=stato['ultimo_id']).exists() and os.path.exists(percorso):
+            # Nessuna nota rimasta: la prossima esecuzione riparte dall'inizio
+            os.remove(percorso)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rianalisi completata: {stato['elaborate']} note, {stato['riuscite']} riuscite, "
+            f"{stato['fallite']} ancora fallite."
+        ))
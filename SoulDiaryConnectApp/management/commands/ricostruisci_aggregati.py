@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from SoulDiaryConnectApp.aggregati import ricostruisci_aggregati
+
+
+class Command(BaseCommand):
+    help = "Ricalcola gli aggregati giornalieri di emozioni e contesti sociali usati dalla pagina di analisi."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--paziente', default=None,
+            help="Codice fiscale del paziente da ricalcolare (default: tutti i pazienti).",
+        )
+
+    def handle(self, *args, **options):
+        righe = ricostruisci_aggregati(options['paziente'])
+        self.stdout.write(self.style.SUCCESS(f"Aggregati ricostruiti: {righe} righe."))
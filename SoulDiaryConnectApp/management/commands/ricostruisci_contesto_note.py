@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from SoulDiaryConnectApp.contesto_note import ricostruisci_contesto
+
+
+class Command(BaseCommand):
+    help = "Ricalcola il riepilogo delle ultime note dei pazienti usato come contesto dai prompt clinici."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--paziente', default=None,
+            help="Codice fiscale del paziente da ricalcolare (default: tutti i pazienti).",
+        )
+
+    def handle(self, *args, **options):
+        pazienti = ricostruisci_contesto(options['paziente'])
+        self.stdout.write(self.style.SUCCESS(f"Contesto ricostruito per {pazienti} pazienti."))
@@ -0,0 +1,92 @@
+import logging
+import os
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from SoulDiaryConnectApp import llm_backends, llm_scheduler
+from SoulDiaryConnectApp.jobs import ciclo_worker, recupera_job_bloccati
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Avvia i worker che eseguono in background l'analisi delle note (clinica, sentiment, contesto sociale)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'ANALISI_WORKERS', 2),
+            help="Numero massimo di analisi eseguite in parallelo.",
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=2.0,
+            help="Secondi di attesa tra un controllo e l'altro quando la coda è vuota.",
+        )
+        parser.add_argument(
+            '--stale-after', type=int, default=getattr(settings, 'ANALISI_JOB_TIMEOUT', 900),
+            help="Secondi dopo i quali un job in esecuzione è considerato bloccato e viene rimesso in coda.",
+        )
+        parser.add_argument(
+            '--max-attempts', type=int, default=getattr(settings, 'ANALISI_JOB_MAX_TENTATIVI', 3),
+            help="Numero massimo di esecuzioni di un job prima di marcarlo come fallito.",
+        )
+
+    def handle(self, *args, **options):
+        num_workers = max(1, options['workers'])
+        intervallo = options['poll_interval']
+        timeout_bloccati = options['stale_after']
+        max_tentativi = options['max_attempts']
+
+        # Recupero dopo crash: job rimasti in esecuzione e note senza job
+        riaccodati, falliti, note = recupera_job_bloccati(timeout_bloccati, max_tentativi)
+        self.stdout.write(
+            f"Recupero: {riaccodati} job rimessi in coda, {falliti} falliti, {note} note riaccodate"
+        )
+
+        # Con il backend llama.cpp il modello viene caricato ora, non al primo job
+        llm_backends.get_backend().precarica()
+
+        prefisso = f"{socket.gethostname()}:{os.getpid()}"
+        stop_event = threading.Event()
+        threads = []
+        for i in range(num_workers):
+            thread = threading.Thread(
+                target=ciclo_worker,
+                args=(f"{prefisso}:{i}", stop_event, intervallo),
+                name=f"analisi-worker-{i}",
+            )
+            thread.start()
+            threads.append(thread)
+
+        self.stdout.write(self.style.SUCCESS(f"Avviati {num_workers} worker di analisi ({prefisso})"))
+
+        try:
+            # Il thread principale ripete periodicamente il recupero dei job bloccati
+            while not stop_event.wait(max(intervallo, timeout_bloccati / 4)):
+                try:
+                    recupera_job_bloccati(timeout_bloccati, max_tentativi)
+                except Exception as e:
+                    logger.error(f"Errore nel recupero dei job bloccati: {e}")
+                self._registra_metriche_scheduler()
+        except KeyboardInterrupt:
+            self.stdout.write("Arresto dei worker in corso, attendo la fine dei job in esecuzione...")
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+
+    def _registra_metriche_scheduler(self):
+        """Registra nel log code e tempi di attesa dello scheduler LLM dall'ultimo controllo."""
+        metriche = llm_scheduler.metriche()
+        classi = {classe: valori for classe, valori in metriche['classi'].items() if valori['servite'] or valori['in_coda']}
+        if not classi:
+            return
+        dettagli = ", ".join(
+            f"{classe}: {valori['in_coda']} in coda, {valori['servite']} servite, "
+            f"attesa media {valori['attesa_media_ms']:.0f} ms (max {valori['attesa_max_ms']:.0f} ms)"
+            for classe, valori in classi.items()
+        )
+        logger.info(f"Scheduler LLM ({metriche['occupati']}/{metriche['slot']} slot occupati) - {dettagli}")
+        llm_scheduler.azzera_metriche()
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.5 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0003_alter_medico_options_alter_messaggio_options_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JobAnalisi",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "stato",
+                    models.CharField(
+                        choices=[
+                            ("in_coda", "In coda"),
+                            ("in_esecuzione", "In esecuzione"),
+                            ("completato", "Completato"),
+                            ("fallito", "Fallito"),
+                        ],
+                        default="in_coda",
+                        max_length=20,
+                    ),
+                ),
+                ("tentativi", models.IntegerField(default=0)),
+                ("worker", models.CharField(blank=True, max_length=100, null=True)),
+                ("errore", models.TextField(blank=True, null=True)),
+                ("data_creazione", models.DateTimeField()),
+                ("data_inizio", models.DateTimeField(blank=True, null=True)),
+                ("data_fine", models.DateTimeField(blank=True, null=True)),
+                ("attesa_ms", models.IntegerField(blank=True, null=True)),
+                ("durata_ms", models.IntegerField(blank=True, null=True)),
+                (
+                    "nota",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="SoulDiaryConnectApp.notadiario",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Job Analisi",
+                "verbose_name_plural": "Job Analisi",
+                "db_table": "job_analisi",
+                "indexes": [
+                    models.Index(
+                        fields=["stato", "data_creazione"], name="job_analisi_stato_idx"
+                    )
+                ],
+            },
+        ),
+    ]
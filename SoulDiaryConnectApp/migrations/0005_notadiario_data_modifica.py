@@ -0,0 +1,22 @@
+# Generated by Django 5.1.5 on 2026-10-18 10:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0004_jobanalisi"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notadiario",
+            name="data_modifica",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.5 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0005_notadiario_data_modifica"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="messaggio",
+            index=models.Index(
+                fields=["med", "paz", "data_messaggio"], name="messaggio_med_paz_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="notadiario",
+            index=models.Index(
+                fields=["paz", "-data_nota", "-id"], name="nota_paz_data_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="notadiario",
+            index=models.Index(
+                fields=["paz", "data_modifica"], name="nota_paz_modifica_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="notadiario",
+            index=models.Index(
+                condition=models.Q(("generazione_in_corso", True)),
+                fields=["id"],
+                name="nota_in_generazione_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="riassuntocasoclinico",
+            index=models.Index(
+                fields=["paz", "med", "periodo"], name="riassunto_paz_med_periodo_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0006_indici_note_riassunti_messaggi"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AggregatoEmotivo",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("giorno", models.DateField()),
+                ("emozione", models.CharField(blank=True, default="", max_length=50)),
+                ("categoria", models.CharField(blank=True, default="", max_length=20)),
+                ("contesto", models.CharField(blank=True, default="", max_length=50)),
+                ("num_note", models.IntegerField(default=0)),
+                ("somma_punteggi", models.IntegerField(default=0)),
+                (
+                    "paz",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="SoulDiaryConnectApp.paziente",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Aggregato Emotivo",
+                "verbose_name_plural": "Aggregati Emotivi",
+                "db_table": "aggregato_emotivo",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("paz", "giorno", "emozione", "contesto"),
+                        name="aggregato_emotivo_unico",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.5 on 2026-10-18 11:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0007_aggregatoemotivo"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RiassuntoPeriodico",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "tipo",
+                    models.CharField(
+                        choices=[("settimana", "Settimana"), ("mese", "Mese")],
+                        max_length=10,
+                    ),
+                ),
+                ("inizio", models.DateField()),
+                ("fine", models.DateField()),
+                ("impronta", models.CharField(max_length=64)),
+                ("testo", models.TextField()),
+                ("data_generazione", models.DateTimeField()),
+                (
+                    "paz",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="SoulDiaryConnectApp.paziente",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Riassunto Periodico",
+                "verbose_name_plural": "Riassunti Periodici",
+                "db_table": "riassunto_periodico",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("paz", "tipo", "inizio"),
+                        name="riassunto_periodico_unico",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0008_riassuntoperiodico"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="paziente",
+            name="contesto_note",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0009_paziente_contesto_note"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingNota",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("data_nota", models.DateTimeField()),
+                ("modello", models.CharField(max_length=200)),
+                ("vettore", models.BinaryField()),
+                (
+                    "nota",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="embedding",
+                        to="SoulDiaryConnectApp.notadiario",
+                    ),
+                ),
+                (
+                    "paz",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="SoulDiaryConnectApp.paziente",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Embedding Nota",
+                "verbose_name_plural": "Embedding Note",
+                "db_table": "embedding_nota",
+                "indexes": [
+                    models.Index(
+                        fields=["paz", "modello", "id"],
+                        name="embedding_paz_modello_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.1.5 on 2026-10-18 13:15
+
+from django.db import migrations, models
+from django.db.models import F, Q
+
+# Testi salvati al posto dell'analisi quando la generazione falliva
+# (views.MESSAGGI_ERRORE_LLM e il messaggio del recupero dei job)
+MESSAGGI_ERRORE = [
+    "Generazione non disponibile al momento.",
+    "Il servizio di generazione testo non è al momento disponibile. Riprova più tardi.",
+    "Servizio di generazione testo non disponibile. Verifica che Ollama sia attivo.",
+    "Il tempo di attesa per la generazione è scaduto. Riprova.",
+    "Errore durante la generazione del testo. Riprova più tardi.",
+    "Errore imprevisto durante la generazione. Riprova.",
+    "Errore durante la generazione dell'analisi clinica.",
+]
+
+
+def imposta_stato_analisi(apps, schema_editor):
+    NotaDiario = apps.get_model("SoulDiaryConnectApp", "NotaDiario")
+    concluse = NotaDiario.objects.filter(generazione_in_corso=False)
+    concluse.update(stato_analisi="completata")
+
+    # Messaggi di errore salvati come analisi clinica: spostati in errore_analisi
+    concluse.filter(
+        Q(testo_clinico__in=MESSAGGI_ERRORE) | Q(testo_clinico__startswith="Errore durante la generazione:")
+    ).update(stato_analisi="fallita", errore_analisi=F("testo_clinico"), testo_clinico=None)
+
+    # Analisi senza emozione predominante
+    concluse.filter(Q(emozione_predominante__isnull=True) | Q(emozione_predominante="")).exclude(
+        stato_analisi="fallita"
+    ).update(stato_analisi="fallita", errore_analisi="Emozione predominante non rilevata.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("SoulDiaryConnectApp", "0010_embeddingnota"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notadiario",
+            name="stato_analisi",
+            field=models.CharField(
+                choices=[
+                    ("in_attesa", "In attesa"),
+                    ("completata", "Completata"),
+                    ("fallita", "Fallita"),
+                ],
+                default="in_attesa",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="notadiario",
+            name="errore_analisi",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(imposta_stato_analisi, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="notadiario",
+            index=models.Index(
+                condition=models.Q(("stato_analisi", "fallita")),
+                fields=["id"],
+                name="nota_analisi_fallita_idx",
+            ),
+        ),
+    ]
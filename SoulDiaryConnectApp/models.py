@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Substr
 
 class Medico(models.Model):
     codice_identificativo = models.CharField(max_length=12, primary_key=True)
@@ -29,12 +30,77 @@ class Paziente(models.Model):
     med = models.ForeignKey(Medico, on_delete=models.CASCADE)
     email = models.EmailField(unique=True)
     password = models.CharField(max_length=50)
+    # Riepilogo delle ultime note per il prompt clinico, aggiornato incrementalmente (vedi contesto_note.py)
+    contesto_note = models.JSONField(default=dict, blank=True)
 
     class Meta:
         db_table = 'paziente'
         verbose_name = 'Paziente'
         verbose_name_plural = 'Pazienti'
 
+class NotaDiarioQuerySet(models.QuerySet):
+    """
+    Proiezioni delle note per ciascun uso. Le colonne di testo lunghe (analisi
+    clinica, spiegazioni, messaggio di emergenza, frase di supporto) vengono
+    lette solo dalle query che le mostrano: su PostgreSQL sono salvate fuori
+    riga (TOAST) e non selezionarle evita di leggerle e trasferirle.
+    """
+
+    # Testi lunghi prodotti dall'LLM o dal medico, esclusi dagli elenchi e dalle statistiche
+    CAMPI_TESTO_LUNGO = (
+        'testo_supporto', 'testo_clinico', 'testo_medico', 'spiegazione_emozione',
+        'spiegazione_contesto', 'messaggio_emergenza',
+    )
+
+    # Home del medico: card complete delle note del paziente selezionato
+    CAMPI_MEDICO = (
+        'id', 'data_nota', 'testo_paziente', 'testo_supporto', 'testo_clinico', 'testo_medico',
+        'emozione_predominante', 'spiegazione_emozione', 'contesto_sociale', 'spiegazione_contesto',
+        'is_emergency', 'tipo_emergenza', 'generazione_in_corso', 'stato_analisi',
+    )
+
+    # Home del paziente: niente analisi clinica né spiegazioni
+    CAMPI_PAZIENTE = (
+        'id', 'data_nota', 'testo_paziente', 'testo_supporto', 'testo_medico',
+        'is_emergency', 'messaggio_emergenza',
+    )
+
+    # API di stato: analisi da mostrare nella card una volta completata
+    CAMPI_STATO = (
+        'id', 'generazione_in_corso', 'is_emergency', 'testo_clinico',
+        'emozione_predominante', 'spiegazione_emozione',
+        'contesto_sociale', 'spiegazione_contesto', 'stato_analisi', 'data_modifica',
+    )
+
+    # Riassunti del caso clinico: nota e analisi clinica
+    CAMPI_RIASSUNTO = ('id', 'data_nota', 'emozione_predominante', 'testo_paziente', 'testo_clinico')
+
+    def senza_testi_lunghi(self):
+        """Tutte le colonne tranne i testi lunghi (caricati solo se letti)."""
+        return self.defer(*self.CAMPI_TESTO_LUNGO)
+
+    def per_medico(self):
+        return self.only(*self.CAMPI_MEDICO)
+
+    def per_paziente(self):
+        return self.only(*self.CAMPI_PAZIENTE)
+
+    def per_stato(self):
+        return self.only(*self.CAMPI_STATO)
+
+    def per_riassunto(self):
+        return self.only(*self.CAMPI_RIASSUNTO)
+
+    def per_contesto(self, lunghezza_testo):
+        """
+        Data ed emozione delle note, con i primi lunghezza_testo + 1 caratteri del
+        testo in inizio_testo (il carattere in più indica se il testo è più lungo).
+        """
+        return self.only('id', 'data_nota', 'emozione_predominante').annotate(
+            inizio_testo=Substr('testo_paziente', 1, lunghezza_testo + 1)
+        )
+
+
 class NotaDiario(models.Model):
     TIPO_EMERGENZA_CHOICES = [
         ('none', 'Nessuna emergenza'),
@@ -44,6 +110,12 @@ class NotaDiario(models.Model):
         ('abuso', 'Abuso'),
     ]
 
+    STATO_ANALISI_CHOICES = [
+        ('in_attesa', 'In attesa'),
+        ('completata', 'Completata'),
+        ('fallita', 'Fallita'),
+    ]
+
     id = models.AutoField(primary_key=True)
     paz = models.ForeignKey(Paziente, on_delete=models.CASCADE)
     testo_paziente = models.TextField()
@@ -61,11 +133,76 @@ class NotaDiario(models.Model):
     messaggio_emergenza = models.TextField(null=True, blank=True)
     # Campo per tracciare lo stato di generazione asincrona
     generazione_in_corso = models.BooleanField(default=False)
+    # Esito dell'analisi in background: le note fallite si rianalizzano con "manage.py reanalyze_notes"
+    stato_analisi = models.CharField(max_length=20, choices=STATO_ANALISI_CHOICES, default='in_attesa')
+    errore_analisi = models.TextField(null=True, blank=True)
+    # Ultima modifica della nota (cursore per l'API di stato delle note)
+    data_modifica = models.DateTimeField(auto_now=True)
+
+    objects = NotaDiarioQuerySet.as_manager()
 
     class Meta:
         db_table = 'nota_diario'
         verbose_name = 'Nota Diario'
         verbose_name_plural = 'Note Diario'
+        indexes = [
+            # Note di un paziente dalla più recente (home, analisi, riassunti, contesto clinico)
+            models.Index(fields=['paz', '-data_nota', '-id'], name='nota_paz_data_idx'),
+            # Note di un paziente modificate dopo un cursore (API di stato)
+            models.Index(fields=['paz', 'data_modifica'], name='nota_paz_modifica_idx'),
+            # Indice parziale: solo le poche note con analisi in corso (recupero dei job)
+            models.Index(fields=['id'], condition=models.Q(generazione_in_corso=True), name='nota_in_generazione_idx'),
+            # Indice parziale: solo le note con analisi fallita (rianalisi)
+            models.Index(fields=['id'], condition=models.Q(stato_analisi='fallita'), name='nota_analisi_fallita_idx'),
+        ]
+
+class AggregatoEmotivo(models.Model):
+    """
+    Conteggi giornalieri delle note di un paziente per emozione e contesto sociale,
+    aggiornati incrementalmente (vedi aggregati.py) e letti dalla pagina di analisi.
+    """
+    id = models.AutoField(primary_key=True)
+    paz = models.ForeignKey(Paziente, on_delete=models.CASCADE)
+    giorno = models.DateField()
+    # Emozione e contesto normalizzati (minuscolo); stringa vuota se non ancora analizzati
+    emozione = models.CharField(max_length=50, blank=True, default='')
+    categoria = models.CharField(max_length=20, blank=True, default='')
+    contesto = models.CharField(max_length=50, blank=True, default='')
+    num_note = models.IntegerField(default=0)
+    somma_punteggi = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'aggregato_emotivo'
+        verbose_name = 'Aggregato Emotivo'
+        verbose_name_plural = 'Aggregati Emotivi'
+        constraints = [
+            models.UniqueConstraint(fields=['paz', 'giorno', 'emozione', 'contesto'], name='aggregato_emotivo_unico'),
+        ]
+
+
+class EmbeddingNota(models.Model):
+    """
+    Embedding del testo di una nota, calcolato una sola volta dal backend locale
+    (vedi embeddings.py). Il vettore è salvato come array float32 normalizzato;
+    paziente e data sono copiati dalla nota per leggere l'indice di un paziente
+    senza join.
+    """
+    id = models.AutoField(primary_key=True)
+    nota = models.OneToOneField(NotaDiario, on_delete=models.CASCADE, related_name='embedding')
+    paz = models.ForeignKey(Paziente, on_delete=models.CASCADE)
+    data_nota = models.DateTimeField()
+    modello = models.CharField(max_length=200)
+    vettore = models.BinaryField()
+
+    class Meta:
+        db_table = 'embedding_nota'
+        verbose_name = 'Embedding Nota'
+        verbose_name_plural = 'Embedding Note'
+        indexes = [
+            # Versione dell'indice di un paziente (conteggio e id massimo) senza leggere la tabella
+            models.Index(fields=['paz', 'modello', 'id'], name='embedding_paz_modello_idx'),
+        ]
+
 
 class Messaggio(models.Model):
     id = models.AutoField(primary_key=True)
@@ -79,6 +216,9 @@ class Messaggio(models.Model):
         db_table = 'messaggio'
         verbose_name = 'Messaggio'
         verbose_name_plural = 'Messaggi'
+        indexes = [
+            models.Index(fields=['med', 'paz', 'data_messaggio'], name='messaggio_med_paz_idx'),
+        ]
 
 
 class RiassuntoCasoClinico(models.Model):
@@ -100,5 +240,66 @@ class RiassuntoCasoClinico(models.Model):
         db_table = 'riassunto_caso_clinico'
         verbose_name = 'Riassunto Caso Clinico'
         verbose_name_plural = 'Riassunti Casi Clinici'
+        indexes = [
+            models.Index(fields=['paz', 'med', 'periodo'], name='riassunto_paz_med_periodo_idx'),
+        ]
+
+
+
+class RiassuntoPeriodico(models.Model):
+    """
+    Sintesi intermedia (settimanale o mensile) delle note di un paziente, usata per
+    comporre i riassunti del caso clinico sui periodi lunghi (vedi riassunti.py).
+    L'impronta identifica le note da cui è stata generata: se cambia, va rigenerata.
+    """
+    TIPO_CHOICES = [
+        ('settimana', 'Settimana'),
+        ('mese', 'Mese'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    paz = models.ForeignKey(Paziente, on_delete=models.CASCADE)
+    tipo = models.CharField(max_length=10, choices=TIPO_CHOICES)
+    inizio = models.DateField()
+    fine = models.DateField()
+    impronta = models.CharField(max_length=64)
+    testo = models.TextField()
+    data_generazione = models.DateTimeField()
+
+    class Meta:
+        db_table = 'riassunto_periodico'
+        verbose_name = 'Riassunto Periodico'
+        verbose_name_plural = 'Riassunti Periodici'
+        constraints = [
+            models.UniqueConstraint(fields=['paz', 'tipo', 'inizio'], name='riassunto_periodico_unico'),
+        ]
 
 
+class JobAnalisi(models.Model):
+    STATO_CHOICES = [
+        ('in_coda', 'In coda'),
+        ('in_esecuzione', 'In esecuzione'),
+        ('completato', 'Completato'),
+        ('fallito', 'Fallito'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    nota = models.ForeignKey(NotaDiario, on_delete=models.CASCADE)
+    stato = models.CharField(max_length=20, choices=STATO_CHOICES, default='in_coda')
+    tentativi = models.IntegerField(default=0)
+    worker = models.CharField(max_length=100, null=True, blank=True)
+    errore = models.TextField(null=True, blank=True)
+    data_creazione = models.DateTimeField()
+    data_inizio = models.DateTimeField(null=True, blank=True)
+    data_fine = models.DateTimeField(null=True, blank=True)
+    # Tempi del job: attesa in coda ed esecuzione (millisecondi)
+    attesa_ms = models.IntegerField(null=True, blank=True)
+    durata_ms = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'job_analisi'
+        verbose_name = 'Job Analisi'
+        verbose_name_plural = 'Job Analisi'
+        indexes = [
+            models.Index(fields=['stato', 'data_creazione'], name='job_analisi_stato_idx'),
+        ]
@@ -0,0 +1,193 @@
+"""
+Server HTTP che simula l'API generate di Ollama, per benchmark e test di carico.
+
+Risponde a POST /api/generate (con e senza "stream"), a POST /api/embed e a
+GET /api/tags come Ollama, senza modello: il testo è deterministico sul prompt e i tempi sono
+simulati con una latenza per il prompt e una per ogni token generato. Una
+frazione configurabile delle richieste può fallire con un errore 500 o con la
+chiusura della connessione, per verificare la gestione degli errori.
+
+Si avvia nel processo (OllamaSimulato, usato da benchmark_carico) oppure come
+processo separato con ``python manage.py ollama_simulato``, puntando
+OLLAMA_BASE_URL del server web e dei worker al suo indirizzo.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .llm_backends import embedding_fake, risposta_fake
+
+logger = logging.getLogger(__name__)
+
+
+class _GestoreRichieste(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, formato, *args):
+        logger.debug(formato % args)
+
+    def _invia_json(self, stato, dati):
+        corpo = json.dumps(dati).encode('utf-8')
+        self.send_response(stato)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._invia_json(200, {'models': [{'name': self.server.simulato.modello}]})
+        else:
+            self._invia_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        simulato = self.server.simulato
+        lunghezza = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(lunghezza) or b'{}')
+        except ValueError:
+            self._invia_json(400, {'error': 'invalid JSON'})
+            return
+        if self.path == '/api/embed' and 'input' in payload:
+            testi = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+            time.sleep(simulato.latenza_prompt_ms / 1000)
+            self._invia_json(200, {'model': payload.get('model'), 'embeddings': [embedding_fake(testo) for testo in testi]})
+            return
+        if self.path != '/api/generate' or 'prompt' not in payload:
+            self._invia_json(404, {'error': 'not found'})
+            return
+
+        esito = simulato.estrai_esito()
+        if esito == 'disconnessione':
+            # Connessione chiusa senza risposta, come un crash del server
+            self.close_connection = True
+            return
+        if esito == 'errore':
+            self._invia_json(500, {'error': 'errore simulato'})
+            return
+
+        pezzi, metriche = simulato.genera(payload)
+        if payload.get('stream'):
+            self._invia_stream(simulato, pezzi, metriche, payload)
+        else:
+            time.sleep(simulato.latenza_token_ms * len(pezzi) / 1000)
+            self._invia_json(200, dict(metriche, model=payload.get('model'), response=''.join(pezzi), done=True))
+
+    def _invia_stream(self, simulato, pezzi, metriche, payload):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def scrivi(dati):
+            riga = (json.dumps(dati) + '\n').encode('utf-8')
+            self.wfile.write(f"{len(riga):X}\r\n".encode('ascii') + riga + b"\r\n")
+            self.wfile.flush()
+
+        for pezzo in pezzi:
+            time.sleep(simulato.latenza_token_ms / 1000)
+            scrivi({'model': payload.get('model'), 'response': pezzo, 'done': False})
+        scrivi(dict(metriche, model=payload.get('model'), response='', done=True))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class OllamaSimulato:
+    """
+    Ollama simulato in un thread del processo.
+
+    Args:
+        host, porta: Indirizzo di ascolto (porta 0: scelta dal sistema)
+        latenza_prompt_ms: Attesa prima del primo token (valutazione del prompt)
+        latenza_token_ms: Attesa per ogni token generato
+        token_risposta: Token generati per risposta (al più options.num_predict)
+        errori: Frazione delle richieste che ricevono un errore 500
+        disconnessioni: Frazione delle richieste a cui viene chiusa la connessione
+        seed: Seme per l'estrazione degli errori
+    """
+
+    modello = 'llama3.1:8b'
+
+    def __init__(self, host='127.0.0.1', porta=0, latenza_prompt_ms=50, latenza_token_ms=20,
+                 token_risposta=40, errori=0.0, disconnessioni=0.0, seed=42):
+        self.host = host
+        self.porta = porta
+        self.latenza_prompt_ms = latenza_prompt_ms
+        self.latenza_token_ms = latenza_token_ms
+        self.token_risposta = token_risposta
+        self.errori = errori
+        self.disconnessioni = disconnessioni
+        self._casuale = random.Random(seed)
+        self._lock = threading.Lock()
+        self.conteggi = {'richieste': 0, 'errori': 0, 'disconnessioni': 0}
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """Indirizzo da usare come OLLAMA_BASE_URL."""
+        return f"http://{self.host}:{self.porta}/api/generate"
+
+    def estrai_esito(self):
+        """Decide l'esito della richiesta: 'ok', 'errore' o 'disconnessione'."""
+        with self._lock:
+            self.conteggi['richieste'] += 1
+            estratto = self._casuale.random()
+            if estratto < self.disconnessioni:
+                esito = 'disconnessione'
+            elif estratto < self.disconnessioni + self.errori:
+                esito = 'errore'
+            else:
+                return 'ok'
+            self.conteggi['errori' if esito == 'errore' else 'disconnessioni'] += 1
+            return esito
+
+    def genera(self, payload):
+        """
+        Restituisce i pezzi (token) della risposta e le durate nel formato di Ollama.
+        La latenza del prompt viene attesa qui, quella dei token da chi invia la risposta.
+        """
+        token = min(self.token_risposta, payload.get('options', {}).get('num_predict') or self.token_risposta)
+        testo = risposta_fake(payload)
+        if not payload.get('format'):
+            # Testo lungo token parole: la prima frase identifica il prompt
+            parole = testo.rstrip('.').split(' ')
+            testo = ' '.join(parole + ['parola'] * max(0, token - len(parole))) + '.'
+        parole = testo.split(' ')
+        pezzi = [parola + (' ' if i < len(parole) - 1 else '') for i, parola in enumerate(parole)]
+
+        time.sleep(self.latenza_prompt_ms / 1000)
+        metriche = {
+            'prompt_eval_count': len(payload['prompt'].split()),
+            'prompt_eval_duration': int(self.latenza_prompt_ms * 1e6),
+            'eval_count': len(pezzi),
+            'eval_duration': int(self.latenza_token_ms * len(pezzi) * 1e6),
+            'load_duration': 0,
+        }
+        return pezzi, metriche
+
+    def avvia(self):
+        """Avvia il server in un thread daemon e restituisce l'istanza."""
+        self._server = ThreadingHTTPServer((self.host, self.porta), _GestoreRichieste)
+        self._server.daemon_threads = True
+        self._server.simulato = self
+        self.porta = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='ollama-simulato', daemon=True)
+        self._thread.start()
+        logger.info(f"Ollama simulato in ascolto su {self.url}")
+        return self
+
+    def ferma(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.avvia()
+
+    def __exit__(self, *args):
+        self.ferma()
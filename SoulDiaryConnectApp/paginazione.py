@@ -0,0 +1,56 @@
+"""
+Paginazione a cursore (keyset) delle note del diario.
+
+Le note sono ordinate dalla più recente per (data_nota, id): la pagina successiva
+si ottiene filtrando le note "prima" dell'ultima mostrata, invece di usare un
+OFFSET. Il costo di ogni pagina resta quindi costante anche per pazienti con
+migliaia di note, e una nota inserita nel frattempo non fa slittare le pagine.
+"""
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def codifica_cursore(nota):
+    """Restituisce il cursore (stringa) che punta subito dopo la nota indicata."""
+    return f"{nota.data_nota.isoformat()}_{nota.id}"
+
+
+def decodifica_cursore(cursore):
+    """
+    Restituisce la coppia (data_nota, id) codificata nel cursore,
+    oppure None se il cursore è assente o non valido.
+    """
+    if not cursore:
+        return None
+    data, _, nota_id = cursore.rpartition('_')
+    data_nota = parse_datetime(data)
+    if data_nota is None or not nota_id.isdigit():
+        return None
+    return data_nota, int(nota_id)
+
+
+def pagina_note(queryset, cursore=None, limite=20):
+    """
+    Restituisce una pagina di note ordinate dalla più recente.
+
+    Args:
+        queryset: QuerySet di NotaDiario già filtrato (e proiettato)
+        cursore: Cursore restituito dalla pagina precedente (None per la prima pagina)
+        limite: Numero massimo di note per pagina
+
+    Returns:
+        tuple: (lista delle note, cursore della pagina successiva o None se è l'ultima)
+    """
+    posizione = decodifica_cursore(cursore)
+    if posizione is not None:
+        data_nota, nota_id = posizione
+        queryset = queryset.filter(
+            Q(data_nota__lt=data_nota) | Q(data_nota=data_nota, id__lt=nota_id)
+        )
+
+    # Una nota in più per sapere se esiste una pagina successiva
+    note = list(queryset.order_by('-data_nota', '-id')[:limite + 1])
+    if len(note) > limite:
+        note = note[:limite]
+        return note, codifica_cursore(note[-1])
+    return note, None
@@ -0,0 +1,158 @@
+"""
+Budget in token dei prompt inviati al modello.
+
+Ollama tronca in silenzio i prompt più lunghi della finestra di contesto
+(settings.OLLAMA_NUM_CTX) scartandone l'inizio, cioè proprio le istruzioni.
+Questo modulo stima i token in locale, senza tokenizer, e adatta le sezioni del
+prompt prima dell'invio, in ordine di priorità:
+
+    1. istruzioni: non vengono mai tagliate
+    2. nota corrente: tagliata solo oltre PROMPT_BUDGET_NOTA_CORRENTE token
+    3. note precedenti: al più PROMPT_BUDGET_NOTE_PRECEDENTI token, si scartano
+       per prime le più vecchie
+
+Il taglio è deterministico: a parità di input il prompt è identico, e la
+cache delle risposte LLM continua a funzionare.
+"""
+import logging
+import math
+import re
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Caratteri medi per token nelle risposte in italiano (stima prudente per num_predict)
+CARATTERI_PER_TOKEN = 3
+MARGINE_RISPOSTA = 1.5  # Margine su num_predict per non troncare la risposta a metà frase
+
+# Token lasciati liberi nella finestra di contesto (template del modello, errori di stima)
+MARGINE_CONTESTO = 256
+
+# Parole, numeri e singoli segni di punteggiatura
+_PEZZI = re.compile(r"\w+|[^\w\s]")
+
+
+def _config(nome, default):
+    return getattr(settings, nome, default)
+
+
+def stima_token(testo):
+    """
+    Stima il numero di token di un testo: ogni parola conta un token ogni
+    4 caratteri (almeno uno), ogni segno di punteggiatura un token.
+    Tende a sovrastimare leggermente, che per un budget è il caso sicuro.
+    """
+    if not testo:
+        return 0
+    return sum(max(1, math.ceil(len(pezzo) / 4)) for pezzo in _PEZZI.findall(testo))
+
+
+def token_risposta(max_chars):
+    """Restituisce num_predict per una risposta di al più max_chars caratteri (500 se non indicato)."""
+    if not max_chars:
+        return 500
+    return math.ceil(max_chars / CARATTERI_PER_TOKEN * MARGINE_RISPOSTA)
+
+
+def num_ctx():
+    """Dimensione della finestra di contesto richiesta al modello."""
+    return _config('OLLAMA_NUM_CTX', 8192)
+
+
+def token_disponibili(num_predict):
+    """Token disponibili per il prompt, tolti la risposta e il margine."""
+    return num_ctx() - num_predict - MARGINE_CONTESTO
+
+
+def tronca_testo(testo, max_token):
+    """
+    Tronca il testo a max_token token stimati, a fine parola, aggiungendo "...".
+    Restituisce il testo invariato se rientra nel budget.
+    """
+    if stima_token(testo) <= max_token:
+        return testo
+    if max_token <= stima_token("..."):
+        return ""
+
+    # Il budget comprende i puntini di sospensione finali
+    budget = max_token - stima_token("...")
+    usati = 0
+    fine = 0
+    for pezzo in _PEZZI.finditer(testo):
+        usati += max(1, math.ceil(len(pezzo.group()) / 4))
+        if usati > budget:
+            break
+        fine = pezzo.end()
+    return testo[:fine].rstrip() + "..."
+
+
+def seleziona_recenti(voci, max_token, separatore="\n\n"):
+    """
+    Restituisce le voci più recenti (in coda alla lista, ordine cronologico)
+    che rientrano in max_token token, scartando le più vecchie.
+    """
+    costo_separatore = stima_token(separatore)
+    selezionate = []
+    usati = 0
+    for voce in reversed(voci):
+        costo = stima_token(voce) + (costo_separatore if selezionate else 0)
+        if usati + costo > max_token:
+            break
+        selezionate.append(voce)
+        usati += costo
+    return list(reversed(selezionate))
+
+
+def adatta_sezioni(token_istruzioni, nota_corrente, note_precedenti, num_predict):
+    """
+    Adatta nota corrente e note precedenti al budget del prompt.
+
+    Args:
+        token_istruzioni: Token stimati del prompt senza nota corrente e note precedenti
+        nota_corrente: Testo della nota da analizzare
+        note_precedenti: Voci delle note precedenti, in ordine cronologico
+        num_predict: Token riservati alla risposta
+
+    Returns:
+        tuple: (nota corrente, note precedenti) eventualmente ridotte
+    """
+    disponibili = token_disponibili(num_predict) - token_istruzioni
+    if disponibili <= 0:
+        logger.warning(
+            f"Le sole istruzioni ({token_istruzioni} token) superano la finestra di contesto ({num_ctx()} token)"
+        )
+        return tronca_testo(nota_corrente, 0), []
+
+    budget_nota = min(_config('PROMPT_BUDGET_NOTA_CORRENTE', 3000), disponibili)
+    nota = tronca_testo(nota_corrente, budget_nota)
+    if nota != nota_corrente:
+        logger.warning(f"Nota corrente troncata a {budget_nota} token stimati")
+
+    budget_precedenti = min(
+        _config('PROMPT_BUDGET_NOTE_PRECEDENTI', 1500),
+        disponibili - stima_token(nota),
+    )
+    precedenti = seleziona_recenti(note_precedenti, budget_precedenti)
+    if len(precedenti) < len(note_precedenti):
+        logger.info(
+            f"Contesto ridotto a {len(precedenti)} note precedenti su {len(note_precedenti)} "
+            f"(budget {budget_precedenti} token)"
+        )
+    return nota, precedenti
+
+
+def verifica_prompt(prompt, num_predict):
+    """
+    Registra un avviso se il prompt stimato non entra nella finestra di contesto.
+
+    Returns:
+        int: Token stimati del prompt
+    """
+    token = stima_token(prompt)
+    if token > token_disponibili(num_predict):
+        logger.warning(
+            f"Prompt di {token} token stimati oltre il budget di {token_disponibili(num_predict)} "
+            f"(num_ctx {num_ctx()}, num_predict {num_predict}): il modello ne scarterà l'inizio"
+        )
+    return token
@@ -0,0 +1,304 @@
+"""
+Riassunti del caso clinico sui periodi lunghi, calcolati per livelli (map-reduce).
+
+Le note vengono raggruppate per settimana di calendario (da lunedì a domenica):
+ogni settimana viene sintetizzata una sola volta e la sintesi salvata in
+RiassuntoPeriodico insieme all'impronta delle note da cui deriva. Le sintesi
+settimanali vengono combinate in sintesi mensili, e queste (o direttamente quelle
+settimanali, per l'ultimo mese) nel riassunto finale del periodo.
+
+Rigenerando un periodo il modello viene interrogato solo per le settimane in cui
+sono state aggiunte, modificate o eliminate note e per i mesi che le contengono;
+il prompt finale resta breve anche per un anno di note.
+"""
+import asyncio
+import hashlib
+import logging
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import prompt_budget
+from .models import NotaDiario, RiassuntoPeriodico
+
+logger = logging.getLogger(__name__)
+
+# Periodi riassunti a partire dalle sintesi settimanali e, per i più lunghi, mensili
+PERIODI_GERARCHICI = ('30days', '3months', 'year')
+PERIODI_PER_MESE = ('3months', 'year')
+
+# Lunghezza massima (in caratteri) delle sintesi intermedie e del riassunto finale
+LUNGHEZZA_SINTESI_SETTIMANALE = 800
+LUNGHEZZA_SINTESI_MENSILE = 1200
+LUNGHEZZA_RIASSUNTO = 2000
+
+NOMI_MESI = [
+    'Gennaio', 'Febbraio', 'Marzo', 'Aprile', 'Maggio', 'Giugno',
+    'Luglio', 'Agosto', 'Settembre', 'Ottobre', 'Novembre', 'Dicembre',
+]
+
+
+def inizio_settimana(giorno):
+    """Restituisce il lunedì della settimana a cui appartiene il giorno."""
+    return giorno - timedelta(days=giorno.weekday())
+
+
+def calcola_impronta(voci):
+    """Impronta (SHA-256) di una sequenza di voci, usata per capire se una sintesi è ancora valida."""
+    return hashlib.sha256("\n".join(voci).encode('utf-8')).hexdigest()
+
+
+def _fine_mese(anno, mese):
+    if mese == 12:
+        return date(anno + 1, 1, 1) - timedelta(days=1)
+    return date(anno, mese + 1, 1) - timedelta(days=1)
+
+
+def _mese_settimana(settimana, oggi):
+    """
+    Mese (anno, mese) a cui appartiene la settimana: quello della sua domenica,
+    così la settimana a cavallo del primo giorno del mese appartiene al mese. La
+    settimana in corso resta nel mese corrente anche se finisce nel successivo.
+    """
+    fine = settimana + timedelta(days=6)
+    return min((fine.year, fine.month), (oggi.year, oggi.month))
+
+
+def _etichetta_settimana(inizio):
+    fine = inizio + timedelta(days=6)
+    return f"Settimana dal {inizio.strftime('%d/%m/%Y')} al {fine.strftime('%d/%m/%Y')}"
+
+
+def _etichetta_mese(anno, mese):
+    return f"{NOMI_MESI[mese - 1]} {anno}"
+
+
+async def impronte_settimane(paziente, dal):
+    """
+    Restituisce {lunedì: impronta} delle settimane con almeno una nota, a partire
+    dalla settimana che contiene il giorno dal. L'impronta dipende da id e
+    data_modifica delle note: cambia se una nota viene aggiunta, modificata
+    (anche dall'analisi) o eliminata.
+    """
+    da = timezone.make_aware(datetime.combine(inizio_settimana(dal), time.min))
+
+    voci = {}
+    note = (
+        NotaDiario.objects.filter(paz=paziente, data_nota__gte=da)
+        .order_by('data_nota', 'id')
+        .values_list('id', 'data_nota', 'data_modifica')
+    )
+    async for nota_id, data_nota, data_modifica in note:
+        settimana = inizio_settimana(timezone.localdate(data_nota))
+        voci.setdefault(settimana, []).append(f"{nota_id}:{data_modifica.isoformat()}")
+
+    return {settimana: calcola_impronta(righe) for settimana, righe in voci.items()}
+
+
+class _ErroreGenerazione(Exception):
+    """La generazione di una sintesi intermedia non è riuscita (il messaggio è quello da mostrare)."""
+
+
+async def _sintesi(paziente, tipo, inizio, fine, impronta, costruisci_prompt, max_chars, semaforo):
+    """
+    Restituisce la sintesi salvata per il periodo se l'impronta coincide,
+    altrimenti la genera con il prompt restituito da costruisci_prompt e la salva.
+    """
+    # Import locale: views importa questo modulo
+    from .views import MESSAGGI_ERRORE_LLM, agenera_con_ollama
+
+    esistente = await RiassuntoPeriodico.objects.filter(
+        paz=paziente, tipo=tipo, inizio=inizio
+    ).only('impronta', 'testo').afirst()
+    if esistente is not None and esistente.impronta == impronta:
+        return esistente.testo
+
+    async with semaforo:
+        prompt = await costruisci_prompt()
+        testo = await agenera_con_ollama(prompt, max_chars=max_chars, temperature=0.5)
+    if testo in MESSAGGI_ERRORE_LLM:
+        raise _ErroreGenerazione(testo)
+
+    await RiassuntoPeriodico.objects.aupdate_or_create(
+        paz=paziente, tipo=tipo, inizio=inizio,
+        defaults={
+            'fine': fine,
+            'impronta': impronta,
+            'testo': testo,
+            'data_generazione': timezone.now(),
+        },
+    )
+    logger.info(f"Sintesi {tipo} dal {inizio} rigenerata per il paziente {paziente.codice_fiscale}")
+    return testo
+
+
+def _sintesi_settimana(paziente, settimana, impronta, semaforo):
+    fine = settimana + timedelta(days=6)
+
+    async def costruisci_prompt():
+        # Import locale: views importa questo modulo
+        from .views import formatta_note_per_riassunto
+
+        da = timezone.make_aware(datetime.combine(settimana, time.min))
+        note = [
+            nota async for nota in NotaDiario.objects.filter(
+                paz=paziente, data_nota__gte=da, data_nota__lt=da + timedelta(days=7)
+            ).per_riassunto().order_by('data_nota', 'id')
+        ]
+        # Settimane molto attive: si tengono le note più recenti che rientrano nel budget del prompt
+        budget_note = prompt_budget.token_disponibili(
+            prompt_budget.token_risposta(LUNGHEZZA_SINTESI_SETTIMANALE)
+        ) - prompt_budget.stima_token(_prompt_sintesi_settimanale(paziente, settimana, note, ""))
+        return _prompt_sintesi_settimanale(
+            paziente, settimana, note, formatta_note_per_riassunto(note, max_token=budget_note)
+        )
+
+    return _sintesi(
+        paziente, 'settimana', settimana, fine, impronta, costruisci_prompt,
+        LUNGHEZZA_SINTESI_SETTIMANALE, semaforo,
+    )
+
+
+def _sintesi_mese(paziente, anno, mese, settimane, semaforo):
+    """settimane: lista ordinata di (lunedì, impronta, sintesi) delle settimane del mese."""
+    inizio = date(anno, mese, 1)
+    impronta = calcola_impronta(f"{settimana.isoformat()}:{voce}" for settimana, voce, _ in settimane)
+
+    async def costruisci_prompt():
+        parti = [(_etichetta_settimana(settimana), testo) for settimana, _, testo in settimane]
+        return _prompt_sintesi_aggregata(paziente, _etichetta_mese(anno, mese), parti)
+
+    return _sintesi(
+        paziente, 'mese', inizio, _fine_mese(anno, mese), impronta, costruisci_prompt,
+        LUNGHEZZA_SINTESI_MENSILE, semaforo,
+    )
+
+
+def _prompt_sintesi_settimanale(paziente, settimana, note, contesto_note):
+    return f"""Sei uno psicologo clinico esperto. Sintetizza in modo conciso le note del diario del paziente relative a una settimana: la sintesi verrà usata per comporre un riassunto clinico su un periodo più lungo.
+
+    ISTRUZIONI:
+    1. Descrivi lo stato emotivo prevalente della settimana e le emozioni ricorrenti
+    2. Riporta eventi, situazioni o relazioni significative citate nelle note
+    3. Segnala eventuali elementi di rischio o di preoccupazione clinica
+    4. Usa un linguaggio professionale, senza raccomandazioni e senza ripetere le note
+
+    INFORMAZIONI PAZIENTE:
+    Nome: {paziente.nome} {paziente.cognome}
+    Periodo: {_etichetta_settimana(settimana)}
+    Numero di note: {len(note)}
+
+    NOTE DEL DIARIO:
+    {contesto_note}
+
+    Genera la sintesi settimanale:"""
+
+
+def _prompt_sintesi_aggregata(paziente, etichetta, parti):
+    sintesi = "\n\n---\n\n".join(f"{titolo}:\n{testo}" for titolo, testo in parti)
+    return f"""Sei uno psicologo clinico esperto. Combina le sintesi cliniche seguenti, in ordine cronologico, in un'unica sintesi concisa del periodo indicato.
+
+    ISTRUZIONI:
+    1. Descrivi l'andamento dello stato emotivo nel periodo e i pattern ricorrenti
+    2. Evidenzia cambiamenti tra l'inizio e la fine del periodo
+    3. Mantieni gli elementi di rischio o di preoccupazione clinica segnalati
+    4. Usa un linguaggio professionale, senza raccomandazioni
+
+    INFORMAZIONI PAZIENTE:
+    Nome: {paziente.nome} {paziente.cognome}
+    Periodo: {etichetta}
+
+    SINTESI:
+    {sintesi}
+
+    Genera la sintesi del periodo:"""
+
+
+def _prompt_riassunto_finale(paziente, periodo_label, parti):
+    sintesi = "\n\n---\n\n".join(f"{titolo}:\n{testo}" for titolo, testo in parti)
+    return f"""Sei uno psicologo clinico esperto. Il tuo compito è generare un riassunto clinico professionale dello stato del paziente basandoti sulle sintesi delle note del diario raccolte nel periodo specificato.
+
+    ISTRUZIONI:
+    1. Fornisci un riassunto clinico strutturato che includa:
+       - Panoramica generale dello stato emotivo nel periodo
+       - Pattern emotivi ricorrenti identificati
+       - Eventuali miglioramenti o peggioramenti osservati
+       - Aree di attenzione o preoccupazione
+       - Raccomandazioni per il follow-up
+
+    2. Usa un linguaggio professionale e clinico
+    3. Sii obiettivo e basati solo sui dati forniti
+    4. Evidenzia eventuali trend significativi
+
+    INFORMAZIONI PAZIENTE:
+    Nome: {paziente.nome} {paziente.cognome}
+    Periodo analizzato: {periodo_label}
+
+    SINTESI DEL PERIODO (in ordine cronologico):
+    {sintesi}
+
+    Genera il riassunto clinico:"""
+
+
+async def ariassunto_periodo(paziente, periodo, periodo_label, data_inizio):
+    """
+    Genera il riassunto del caso clinico di un periodo lungo (PERIODI_GERARCHICI)
+    combinando le sintesi settimanali e mensili, rigenerate solo se cambiate.
+
+    Settimane e mesi sono di calendario: il primo può includere qualche nota
+    precedente a data_inizio, così che la sua sintesi resti riutilizzabile. Il
+    primo mese comprende anche la settimana a cavallo del suo primo giorno.
+
+    Returns:
+        str: Il riassunto, oppure il messaggio di errore della generazione
+             (le sintesi intermedie fallite non vengono salvate)
+    """
+    # Import locale: views importa questo modulo
+    from .views import agenera_con_ollama
+
+    if periodo in PERIODI_PER_MESE:
+        # Mesi interi, così la sintesi di un mese è la stessa per i 3 mesi e per l'anno
+        # (dalla settimana che contiene il primo giorno del primo mese)
+        primo_giorno = timezone.localdate(data_inizio).replace(day=1)
+        impronte = await impronte_settimane(paziente, primo_giorno)
+    else:
+        impronte = await impronte_settimane(paziente, timezone.localdate(data_inizio))
+    if not impronte:
+        return "Non sono presenti note nel periodo selezionato."
+
+    semaforo = asyncio.Semaphore(getattr(settings, 'RIASSUNTI_MAX_PARALLELO', 4))
+    settimane = sorted(impronte)
+
+    try:
+        # Map: una sintesi per settimana (solo quelle cambiate interrogano il modello)
+        testi = await asyncio.gather(*[
+            _sintesi_settimana(paziente, settimana, impronte[settimana], semaforo)
+            for settimana in settimane
+        ])
+
+        if periodo in PERIODI_PER_MESE:
+            # Reduce intermedio: le settimane vengono assegnate al mese della loro domenica
+            oggi = timezone.localdate()
+            mesi = {}
+            for settimana, testo in zip(settimane, testi):
+                mesi.setdefault(_mese_settimana(settimana, oggi), []).append(
+                    (settimana, impronte[settimana], testo)
+                )
+            chiavi_mesi = sorted(mesi)
+            testi_mesi = await asyncio.gather(*[
+                _sintesi_mese(paziente, anno, mese, mesi[(anno, mese)], semaforo)
+                for anno, mese in chiavi_mesi
+            ])
+            parti = [
+                (_etichetta_mese(anno, mese), testo)
+                for (anno, mese), testo in zip(chiavi_mesi, testi_mesi)
+            ]
+        else:
+            parti = [(_etichetta_settimana(settimana), testo) for settimana, testo in zip(settimane, testi)]
+    except _ErroreGenerazione as e:
+        return str(e)
+
+    # Reduce finale: se nessuna sintesi è cambiata il prompt è identico e la risposta arriva dalla cache LLM
+    prompt = _prompt_riassunto_finale(paziente, periodo_label, parti)
+    return await agenera_con_ollama(prompt, max_chars=LUNGHEZZA_RIASSUNTO, temperature=0.5)
@@ -0,0 +1,266 @@
+"""
+Deduplicazione (single-flight) delle generazioni LLM identiche e concorrenti.
+
+Un doppio click su "rigenera", due POST ripetute della frase di supporto o due
+medici che aprono lo stesso riassunto producono lo stesso prompt, e quindi la
+stessa chiave di cache. Finché la prima generazione è in corso, le richieste
+con la stessa chiave:
+
+    - nello stesso processo (thread o coroutine) attendono la generazione in
+      corso e ne ricevono il risultato;
+    - in processi diversi (worker, server web) attendono un advisory lock di
+      PostgreSQL sulla chiave e poi leggono il risultato dalla cache LLM.
+
+Su database diversi da PostgreSQL (o con LLM_SINGLE_FLIGHT_DB = False) la
+deduplicazione resta limitata al singolo processo.
+
+Le generazioni in streaming usano direttamente registra()/concludi(): chi
+arriva mentre lo stesso prompt è in streaming riceve il testo completo alla
+fine, senza advisory lock tra processi.
+"""
+import asyncio
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from .eventi import connessione_dedicata
+
+logger = logging.getLogger(__name__)
+
+_voli = {}
+_voli_lock = threading.Lock()
+
+
+class GenerazioneInterrotta(Exception):
+    """La generazione condivisa è stata interrotta (ad esempio richiesta annullata)."""
+
+
+class _Volo:
+    """Generazione in corso per una chiave, condivisa da thread e coroutine in attesa."""
+
+    def __init__(self):
+        self.completato = threading.Event()
+        self.risultato = None
+        self.errore = None
+        self._attese = []
+        self._lock = threading.Lock()
+
+    def completa(self, risultato=None, errore=None):
+        with self._lock:
+            self.risultato = risultato
+            self.errore = errore
+            self.completato.set()
+            attese, self._attese = self._attese, []
+        for loop, futuro in attese:
+            try:
+                loop.call_soon_threadsafe(_sveglia, futuro)
+            except RuntimeError:
+                # Loop già chiuso (richiesta terminata)
+                pass
+
+    def _esito(self):
+        if self.errore is not None:
+            raise self.errore
+        return self.risultato
+
+    def attendi(self):
+        self.completato.wait()
+        return self._esito()
+
+    async def aattendi(self):
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        with self._lock:
+            if not self.completato.is_set():
+                self._attese.append((loop, futuro))
+        if not self.completato.is_set():
+            await futuro
+        return self._esito()
+
+
+def _sveglia(futuro):
+    if not futuro.done():
+        futuro.set_result(None)
+
+
+def registra(chiave):
+    """
+    Restituisce (volo, True) se il chiamante deve generare, (volo, False) se deve attendere.
+
+    Chi riceve True deve sempre chiamare concludi() (anche in caso di errore),
+    altrimenti chi attende resta bloccato.
+    """
+    with _voli_lock:
+        volo = _voli.get(chiave)
+        if volo is not None:
+            return volo, False
+        volo = _voli[chiave] = _Volo()
+        return volo, True
+
+
+def concludi(chiave, volo, risultato=None, errore=None):
+    """Rimuove il volo dalla tabella e consegna risultato o errore a chi attende."""
+    with _voli_lock:
+        if _voli.get(chiave) is volo:
+            del _voli[chiave]
+    volo.completa(risultato, errore)
+
+
+class _LockAdvisory:
+    """Advisory lock di sessione di PostgreSQL su una chiave, con una connessione dedicata."""
+
+    def __init__(self, chiave):
+        # I primi 60 bit dell'hash esadecimale stanno in un bigint
+        self.id = int(chiave[:15], 16)
+        self.conn = None
+
+    def _esegui(self, sql):
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql, [self.id])
+            return cursor.fetchone()[0]
+
+    def prova(self):
+        """Tenta di acquisire il lock senza attendere."""
+        self.conn = connessione_dedicata()
+        return self._esegui("SELECT pg_try_advisory_lock(%s)")
+
+    def attendi_rilascio(self):
+        """Attende che il processo che detiene il lock lo rilasci, poi chiude la connessione."""
+        try:
+            self._esegui("SELECT pg_advisory_lock(%s)")
+            self._esegui("SELECT pg_advisory_unlock(%s)")
+        finally:
+            self.chiudi()
+
+    def rilascia(self):
+        try:
+            self._esegui("SELECT pg_advisory_unlock(%s)")
+        finally:
+            self.chiudi()
+
+    def chiudi(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _lock_db_attivo():
+    return getattr(settings, 'LLM_SINGLE_FLIGHT_DB', True) and connection.vendor == 'postgresql'
+
+
+def _genera_con_lock_db(chiave, genera, leggi_cache, usa_cache):
+    if not _lock_db_attivo():
+        return genera()
+
+    lock = _LockAdvisory(chiave)
+    try:
+        acquisito = lock.prova()
+    except Exception as e:
+        # Senza lock si genera comunque: la deduplicazione è un'ottimizzazione
+        logger.warning(f"Advisory lock non disponibile, genero senza deduplicazione: {e}")
+        lock.chiudi()
+        return genera()
+
+    if acquisito:
+        try:
+            return genera()
+        finally:
+            lock.rilascia()
+
+    # Lo stesso prompt è in generazione in un altro processo: si usa il suo risultato.
+    # Una rigenerazione forzata accetta solo una risposta scritta durante l'attesa, non
+    # quella già in cache (restituita anche se l'altro processo fallisce)
+    precedente = None if usa_cache else leggi_cache()
+    lock.attendi_rilascio()
+    risultato = leggi_cache()
+    if risultato is not None and risultato != precedente:
+        logger.info("Risposta LLM ottenuta dalla generazione di un altro processo")
+        return risultato
+    return genera()
+
+
+async def _agenera_con_lock_db(chiave, agenera, leggi_cache, usa_cache):
+    if not _lock_db_attivo():
+        return await agenera()
+
+    lock = _LockAdvisory(chiave)
+    in_thread = sync_to_async(thread_sensitive=False)
+    try:
+        acquisito = await in_thread(lock.prova)()
+    except Exception as e:
+        logger.warning(f"Advisory lock non disponibile, genero senza deduplicazione: {e}")
+        lock.chiudi()
+        return await agenera()
+
+    if acquisito:
+        try:
+            return await agenera()
+        finally:
+            await in_thread(lock.rilascia)()
+
+    precedente = None if usa_cache else await in_thread(leggi_cache)()
+    await in_thread(lock.attendi_rilascio)()
+    risultato = await in_thread(leggi_cache)()
+    if risultato is not None and risultato != precedente:
+        logger.info("Risposta LLM ottenuta dalla generazione di un altro processo")
+        return risultato
+    return await agenera()
+
+
+def esegui(chiave, genera, leggi_cache, usa_cache=True):
+    """
+    Esegue genera() una sola volta per le chiamate concorrenti con la stessa chiave.
+
+    Args:
+        chiave: Chiave della richiesta (la chiave della cache LLM)
+        genera: Funzione senza argomenti che esegue la generazione
+        leggi_cache: Funzione senza argomenti che legge il risultato dalla cache
+                     (usata dopo aver atteso una generazione in un altro processo)
+        usa_cache: Se False (rigenerazione forzata) dopo l'attesa si usa solo una
+                   risposta salvata in cache durante l'attesa stessa
+
+    Returns:
+        Il risultato di genera(), proprio o della chiamata che si è atteso
+    """
+    volo, da_generare = registra(chiave)
+    if not da_generare:
+        logger.info("Generazione identica già in corso: attendo il suo risultato")
+        return volo.attendi()
+
+    try:
+        risultato = _genera_con_lock_db(chiave, genera, leggi_cache, usa_cache)
+    except Exception as e:
+        concludi(chiave, volo, errore=e)
+        raise
+    except BaseException:
+        concludi(chiave, volo, errore=GenerazioneInterrotta("Generazione interrotta"))
+        raise
+    concludi(chiave, volo, risultato=risultato)
+    return risultato
+
+
+async def aesegui(chiave, agenera, leggi_cache, usa_cache=True):
+    """
+    Versione asincrona di esegui: agenera è una funzione senza argomenti che
+    restituisce una coroutine, leggi_cache è sincrona (eseguita in un thread).
+    Thread e coroutine dello stesso processo condividono le generazioni in corso.
+    """
+    volo, da_generare = registra(chiave)
+    if not da_generare:
+        logger.info("Generazione identica già in corso: attendo il suo risultato")
+        return await volo.aattendi()
+
+    try:
+        risultato = await _agenera_con_lock_db(chiave, agenera, leggi_cache, usa_cache)
+    except Exception as e:
+        concludi(chiave, volo, errore=e)
+        raise
+    except BaseException:
+        # Richiesta annullata (ad esempio client disconnesso): chi attende non va cancellato
+        concludi(chiave, volo, errore=GenerazioneInterrotta("Generazione interrotta"))
+        raise
+    concludi(chiave, volo, risultato=risultato)
+    return risultato
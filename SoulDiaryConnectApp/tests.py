@@ -1,3 +1,1108 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import re
+import tempfile
+import threading
+from datetime import date, datetime, time, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache as django_cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import aggregati, contesto_note, embeddings, eventi, jobs, llm_backends, llm_cache, llm_scheduler, prompt_budget, riassunti, single_flight, views
+from .aho_corasick import AhoCorasick
+from .eventi import BrokerLocale, canale_medico
+from .models import AggregatoEmotivo, JobAnalisi, Medico, Messaggio, NotaDiario, Paziente, RiassuntoCasoClinico, RiassuntoPeriodico
+from .ollama_simulato import OllamaSimulato
+
+
+class BrokerLocaleTest(SimpleTestCase):
+    """Consegna degli eventi di completamento con il broker in memoria."""
+
+    def test_evento_pubblicato_da_un_altro_thread_sveglia_l_attesa(self):
+        broker = BrokerLocale()
+
+        async def attendi():
+            with broker.iscrivi(canale_medico('M1')) as iscrizione:
+                threading.Timer(0.05, broker.pubblica, [canale_medico('M1'), {'nota_id': 1}]).start()
+                return await iscrizione.attendi(5)
+
+        self.assertEqual(asyncio.run(attendi()), [{'nota_id': 1}])
+        self.assertEqual(broker.consegna(canale_medico('M1'), {}), 0)
+
+    def test_attesa_senza_eventi_scade(self):
+        broker = BrokerLocale()
+
+        async def attendi():
+            with broker.iscrivi(canale_medico('M1')) as iscrizione:
+                broker.pubblica(canale_medico('M2'), {'nota_id': 2})
+                return await iscrizione.attendi(0.05)
+
+        self.assertEqual(asyncio.run(attendi()), [])
+
+
+class PromptBudgetTest(SimpleTestCase):
+    """Le sezioni a priorità più bassa vengono ridotte in modo deterministico."""
+
+    def test_note_precedenti_scartate_dalla_piu_vecchia(self):
+        voci = ['prima ' * 50, 'seconda ' * 50, 'terza ' * 50]
+        self.assertEqual(prompt_budget.seleziona_recenti(voci, 220), voci[1:])
+        self.assertEqual(prompt_budget.seleziona_recenti(voci, 10), [])
+
+    def test_nota_corrente_troncata_solo_oltre_il_budget(self):
+        testo = 'Oggi mi sono sentito molto triste.'
+        self.assertEqual(prompt_budget.tronca_testo(testo, 100), testo)
+        troncato = prompt_budget.tronca_testo(testo, 6)
+        self.assertTrue(troncato.endswith('...'))
+        self.assertLessEqual(prompt_budget.stima_token(troncato), 6)
+
+    @override_settings(OLLAMA_NUM_CTX=2048, PROMPT_BUDGET_NOTA_CORRENTE=3000, PROMPT_BUDGET_NOTE_PRECEDENTI=1500)
+    def test_prompt_adattato_alla_finestra_di_contesto(self):
+        num_predict = prompt_budget.token_risposta(500)
+        nota, precedenti = prompt_budget.adatta_sezioni(300, 'parola ' * 3000, ['nota ' * 200] * 5, num_predict)
+        totale = 300 + prompt_budget.stima_token(nota) + prompt_budget.stima_token('\n\n'.join(precedenti))
+        self.assertLessEqual(totale, prompt_budget.token_disponibili(num_predict))
+
+
+class RilevamentoCrisiTest(SimpleTestCase):
+    """Parole chiave di rischio trovate con una sola scansione e tipo di emergenza per priorità."""
+
+    def test_occorrenze_sovrapposte(self):
+        automa = AhoCorasick()
+        for parola in ('he', 'she', 'his', 'hers'):
+            automa.aggiungi(parola, parola)
+        self.assertEqual(
+            sorted(automa.trova('ushers')),
+            [(1, 4, 'she', 'she'), (2, 4, 'he', 'he'), (2, 6, 'hers', 'hers')],
+        )
+
+    def test_keyword_contenute_in_altre(self):
+        trovate = {(o['keyword'], o['inizio']) for o in views.trova_contenuti_crisi('Ho deciso di farla finita')}
+        self.assertEqual(trovate, {('ho deciso di farla finita', 0), ('farla finita', 13)})
+        trovate = [o['keyword'] for o in views.trova_contenuti_crisi('violenza domestica')]
+        self.assertEqual(sorted(trovate), ['violenza', 'violenza domestica'])
+        # Keyword ripetuta nell'elenco: una sola occorrenza
+        self.assertEqual(len(views.trova_contenuti_crisi('picchiato')), 1)
+
+    def test_priorita_dei_tipi(self):
+        self.assertEqual(views.rileva_contenuto_crisi('Mi taglio perché mi picchia e voglio morire'), (True, 'suicidio'))
+        self.assertEqual(views.rileva_contenuto_crisi('Mi taglio perché mi picchia'), (True, 'violenza'))
+        self.assertEqual(views.rileva_contenuto_crisi('Mi taglio spesso'), (True, 'autolesionismo'))
+        self.assertEqual(views.rileva_contenuto_crisi('Oggi sono stato al parco'), (False, 'none'))
+
+    def test_testo_in_maiuscolo(self):
+        self.assertEqual(views.rileva_contenuto_crisi('VOGLIO MORIRE'), (True, 'suicidio'))
+        self.assertEqual(views.trova_contenuti_crisi('Mi Picchia')[0]['keyword'], 'mi picchia')
+
+    def test_log_solo_keyword_del_tipo_segnalato(self):
+        with self.assertLogs(views.logger, 'WARNING') as log:
+            views.rileva_contenuto_crisi('Mi taglio perché voglio morire')
+        self.assertIn("'voglio morire'", log.output[0])
+        self.assertNotIn('mi taglio', log.output[0])
+
+
+@override_settings(LLM_CACHE_ENABLED=False)
+class BackendFakeTest(TestCase):
+    """Il backend fake risponde in modo deterministico e rispetta lo schema JSON richiesto."""
+
+    def setUp(self):
+        self.backend = llm_backends.BackendFake()
+        llm_backends.imposta_backend(self.backend)
+        self.addCleanup(llm_backends.imposta_backend, None)
+
+    def test_risposta_deterministica(self):
+        self.assertEqual(views.genera_con_ollama('Prompt di prova'), views.genera_con_ollama('Prompt di prova'))
+        self.assertNotEqual(views.genera_con_ollama('Prompt di prova'), views.genera_con_ollama('Altro prompt'))
+        self.assertEqual(len(self.backend.richieste), 4)
+
+    def test_analisi_combinata_con_schema(self):
+        medico = Medico(codice_identificativo='MED1', nome='Anna', cognome='Bianchi', tipo_nota=False, lunghezza_nota=False)
+        paziente = Paziente(codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test', med=medico)
+        _, emozione, _, contesto, _ = views.analizza_nota_combinata('Oggi sono stato al parco.', medico, paziente)
+        self.assertIn(emozione, views.EMOZIONI_EMOJI)
+        self.assertIn(contesto, views.CONTESTI_EMOJI)
+
+
+@override_settings(LLM_CACHE_ENABLED=True, LLM_CACHE_BACKEND='django')
+class CacheRisposteLLMTest(SimpleTestCase):
+    """Le risposte identiche sono servite dalla cache, salvo rigenerazione forzata."""
+
+    def setUp(self):
+        self.backend = llm_backends.BackendFake()
+        llm_backends.imposta_backend(self.backend)
+        self.addCleanup(llm_backends.imposta_backend, None)
+        # Backend della cache scelto al primo uso: va ricreato con le impostazioni del test
+        llm_cache._backend = None
+        self.addCleanup(setattr, llm_cache, '_backend', None)
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+
+    def test_sincrona(self):
+        risposta = views.genera_con_ollama('Prompt in cache')
+        self.assertEqual(views.genera_con_ollama('Prompt in cache'), risposta)
+        self.assertEqual(len(self.backend.richieste), 1)
+        views.genera_con_ollama('Altro prompt')
+        self.assertEqual(len(self.backend.richieste), 2)
+        views.genera_con_ollama('Prompt in cache', usa_cache=False)
+        self.assertEqual(len(self.backend.richieste), 3)
+
+    def test_asincrona(self):
+        async def genera():
+            risposta = await views.agenera_con_ollama('Prompt in cache')
+            self.assertEqual(await views.agenera_con_ollama('Prompt in cache'), risposta)
+            self.assertEqual(len(self.backend.richieste), 1)
+            await views.agenera_con_ollama('Prompt in cache', usa_cache=False)
+            self.assertEqual(len(self.backend.richieste), 2)
+        asyncio.run(genera())
+
+    def test_streaming(self):
+        eventi_ricevuti = list(views.genera_con_ollama_stream('Prompt in cache'))
+        risposta = eventi_ricevuti[-1][1]
+        self.assertEqual(eventi_ricevuti[-1][0], 'fine')
+        self.assertEqual(list(views.genera_con_ollama_stream('Prompt in cache')), [('token', risposta), ('fine', risposta)])
+        # Stessa chiave anche per la generazione non in streaming
+        self.assertEqual(views.genera_con_ollama('Prompt in cache'), risposta)
+        self.assertEqual(len(self.backend.richieste), 1)
+
+    def test_finestra_di_contesto_nella_chiave(self):
+        with override_settings(OLLAMA_NUM_CTX=4096):
+            views.genera_con_ollama('Prompt in cache')
+        with override_settings(OLLAMA_NUM_CTX=8192):
+            views.genera_con_ollama('Prompt in cache')
+        self.assertEqual([r['options']['num_ctx'] for r in self.backend.richieste], [4096, 8192])
+
+
+@override_settings(LLM_CACHE_ENABLED=False)
+class SingleFlightTest(SimpleTestCase):
+    """Richieste identiche e concorrenti producono una sola generazione."""
+
+    def setUp(self):
+        self.backend = llm_backends.BackendFake(latenza_ms=200)
+        llm_backends.imposta_backend(self.backend)
+        self.addCleanup(llm_backends.imposta_backend, None)
+
+    def test_thread_concorrenti(self):
+        risultati = []
+        thread = [
+            threading.Thread(target=lambda: risultati.append(views.genera_con_ollama('Rigenera', usa_cache=False)))
+            for _ in range(5)
+        ]
+        for t in thread:
+            t.start()
+        for t in thread:
+            t.join()
+        self.assertEqual(len(self.backend.richieste), 1)
+        self.assertEqual(len(set(risultati)), 1)
+
+    def test_coroutine_concorrenti(self):
+        async def genera():
+            return await asyncio.gather(
+                *[views.agenera_con_ollama('Riassunto', usa_cache=False) for _ in range(5)],
+                views.agenera_con_ollama('Altro prompt', usa_cache=False),
+            )
+        risultati = asyncio.run(genera())
+        self.assertEqual(len(self.backend.richieste), 2)
+        self.assertEqual(len(set(risultati)), 2)
+
+    def test_richieste_successive_rigenerano(self):
+        views.genera_con_ollama('Rigenera', usa_cache=False)
+        views.genera_con_ollama('Rigenera', usa_cache=False)
+        self.assertEqual(len(self.backend.richieste), 2)
+
+    def _attendi_altro_processo(self, cache, risposta_altro_processo):
+        """Simula l'advisory lock tenuto da un altro processo, che al rilascio ha scritto (o no) in cache."""
+        class LockTenuto:
+            def __init__(self, chiave):
+                pass
+
+            def prova(self):
+                return False
+
+            def attendi_rilascio(self):
+                if risposta_altro_processo is not None:
+                    cache['risposta'] = risposta_altro_processo
+
+            def chiudi(self):
+                pass
+
+        self.enterContext(mock.patch.object(single_flight, '_lock_db_attivo', return_value=True))
+        self.enterContext(mock.patch.object(single_flight, '_LockAdvisory', LockTenuto))
+
+    def test_rigenerazione_forzata_ignora_la_cache_precedente(self):
+        cache = {'risposta': 'Vecchia'}
+        # L'altro processo fallisce: la rigenerazione non deve restituire la risposta già in cache
+        self._attendi_altro_processo(cache, None)
+        risultato = single_flight.esegui('a' * 64, lambda: 'Nuova', lambda: cache.get('risposta'), usa_cache=False)
+        self.assertEqual(risultato, 'Nuova')
+        risultato = asyncio.run(single_flight.aesegui(
+            'a' * 64, mock.AsyncMock(return_value='Nuova'), lambda: cache.get('risposta'), usa_cache=False
+        ))
+        self.assertEqual(risultato, 'Nuova')
+
+    def test_rigenerazione_forzata_condivide_il_risultato_dell_attesa(self):
+        cache = {'risposta': 'Vecchia'}
+        self._attendi_altro_processo(cache, 'Rigenerata altrove')
+        genera = mock.Mock(return_value='Nuova')
+        risultato = single_flight.esegui('a' * 64, genera, lambda: cache.get('risposta'), usa_cache=False)
+        self.assertEqual(risultato, 'Rigenerata altrove')
+        genera.assert_not_called()
+
+    def test_streaming_concorrenti(self):
+        eventi_ricevuti = []
+        thread = [
+            threading.Thread(target=lambda: eventi_ricevuti.append(list(views.genera_con_ollama_stream('Supporto'))))
+            for _ in range(3)
+        ]
+        for t in thread:
+            t.start()
+        for t in thread:
+            t.join()
+        self.assertEqual(len(self.backend.richieste), 1)
+        finali = {eventi[-1] for eventi in eventi_ricevuti}
+        self.assertEqual(len(finali), 1)
+        self.assertEqual(next(iter(finali))[0], 'fine')
+
+    def test_streaming_interrotto_rigenera_per_chi_attende(self):
+        leader = views.genera_con_ollama_stream('Supporto')
+        self.assertEqual(next(leader)[0], 'token')
+        eventi_ricevuti = []
+        thread = threading.Thread(target=lambda: eventi_ricevuti.extend(views.genera_con_ollama_stream('Supporto')))
+        thread.start()
+        # Lascia al secondo stream il tempo di mettersi in attesa, poi il client che generava si disconnette
+        thread.join(0.05)
+        leader.close()
+        thread.join()
+        self.assertEqual(len(self.backend.richieste), 2)
+        self.assertEqual(eventi_ricevuti[-1][0], 'fine')
+
+
+class SchedulerLLMTest(SimpleTestCase):
+    """Gli slot liberi vanno alla classe più prioritaria e, nella stessa classe, a turno per medico."""
+
+    def setUp(self):
+        self.scheduler = llm_scheduler.Scheduler(1)
+        self.servite = []
+
+    def _accoda(self, classe, medico_id, nome):
+        def richiesta():
+            self.scheduler.acquisisci(classe, medico_id)
+            self.servite.append(nome)
+            self.scheduler.rilascia()
+        thread = threading.Thread(target=richiesta)
+        thread.start()
+        # Attende che la richiesta sia in coda prima di accodare la successiva
+        while sum(v['in_coda'] for v in self.scheduler.metriche()['classi'].values()) < len(self.thread) + 1:
+            thread.join(0.001)
+        self.thread.append(thread)
+
+    def _esegui(self, richieste):
+        self.thread = []
+        self.scheduler.acquisisci('analisi')
+        for richiesta in richieste:
+            self._accoda(*richiesta)
+        self.scheduler.rilascia()
+        for thread in self.thread:
+            thread.join()
+
+    def test_ordine_per_priorita(self):
+        self._esegui([
+            ('riassunto', 'MED1', 'riassunto'),
+            ('analisi', 'MED1', 'analisi'),
+            ('supporto', 'MED1', 'supporto'),
+            ('rigenerazione', 'MED1', 'rigenerazione'),
+        ])
+        self.assertEqual(self.servite, ['supporto', 'rigenerazione', 'analisi', 'riassunto'])
+
+    def test_turni_per_medico(self):
+        self._esegui([
+            ('rigenerazione', 'MED1', 'a1'),
+            ('rigenerazione', 'MED1', 'a2'),
+            ('rigenerazione', 'MED1', 'a3'),
+            ('rigenerazione', 'MED2', 'b1'),
+        ])
+        self.assertEqual(self.servite, ['a1', 'b1', 'a2', 'a3'])
+
+    def test_metriche(self):
+        self._esegui([('supporto', None, 'supporto')])
+        metriche = self.scheduler.metriche()
+        self.assertEqual(metriche['occupati'], 0)
+        self.assertEqual(metriche['classi']['supporto']['servite'], 1)
+        self.assertEqual(metriche['classi']['supporto']['in_coda'], 0)
+        self.assertGreater(metriche['classi']['supporto']['attesa_max_ms'], 0)
+
+    def test_annullamento_in_coda(self):
+        async def annulla():
+            await self.scheduler.aacquisisci('analisi')
+            attesa = asyncio.create_task(self.scheduler.aacquisisci('riassunto'))
+            await asyncio.sleep(0)
+            attesa.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await attesa
+            self.scheduler.rilascia()
+        asyncio.run(annulla())
+        self.assertEqual(self.scheduler.metriche()['occupati'], 0)
+        self.assertEqual(self.scheduler.metriche()['classi']['riassunto']['in_coda'], 0)
+
+
+@override_settings(LLM_CACHE_ENABLED=False, OLLAMA_MAX_RETRIES=0)
+class OllamaSimulatoTest(SimpleTestCase):
+    """Il backend Ollama funziona contro il server simulato, anche in streaming e con errori iniettati."""
+
+    def _avvia(self, **opzioni):
+        simulato = OllamaSimulato(latenza_prompt_ms=0, latenza_token_ms=0, token_risposta=10, **opzioni).avvia()
+        self.addCleanup(simulato.ferma)
+        impostazioni = override_settings(OLLAMA_BASE_URL=simulato.url, LLM_BACKEND='ollama')
+        impostazioni.enable()
+        self.addCleanup(impostazioni.disable)
+        llm_backends.imposta_backend(None)
+        self.addCleanup(llm_backends.imposta_backend, None)
+        return simulato
+
+    def test_generazione_e_streaming(self):
+        simulato = self._avvia()
+        testo = views.genera_con_ollama('Prompt di prova', max_chars=100)
+        self.assertTrue(testo.startswith('Testo simulato'))
+        self.assertEqual(len(testo.split()), 10)
+        eventi = list(views.genera_con_ollama_stream('Prompt di prova', max_chars=100))
+        self.assertEqual(eventi[-1], ('fine', testo))
+        self.assertEqual(simulato.conteggi['richieste'], 2)
+
+    def test_errori_iniettati(self):
+        simulato = self._avvia(errori=1.0)
+        self.assertIn(views.genera_con_ollama('Prompt di prova'), views.MESSAGGI_ERRORE_LLM)
+        self.assertEqual(simulato.conteggi['errori'], 1)
+
+
+class IndiciQueryTest(TestCase):
+    """
+    Verifica con EXPLAIN che le query più frequenti usino l'indice previsto e
+    non una scansione sequenziale della tabella (PostgreSQL o SQLite).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        cls.pazienti = [
+            Paziente.objects.create(
+                codice_fiscale=f'PZNTST00A01H70{i}X', nome='Paziente', cognome=str(i),
+                data_di_nascita='1990-01-01', med=cls.medico, email=f'paziente{i}@example.com', password='x',
+            )
+            for i in range(10)
+        ]
+        adesso = timezone.now()
+        NotaDiario.objects.bulk_create([
+            NotaDiario(
+                paz=paziente, testo_paziente=f'Nota {n}', data_nota=adesso - timedelta(hours=n),
+                generazione_in_corso=(n == 0),
+            )
+            for paziente in cls.pazienti
+            for n in range(200)
+        ])
+        Messaggio.objects.bulk_create([
+            Messaggio(med=cls.medico, paz=paziente, testo='Ciao', data_messaggio=adesso.date(), mittente='MED1')
+            for paziente in cls.pazienti
+            for _ in range(20)
+        ])
+        RiassuntoCasoClinico.objects.bulk_create([
+            RiassuntoCasoClinico(
+                paz=paziente, med=cls.medico, periodo=periodo, testo_riassunto='...', data_generazione=adesso,
+            )
+            for paziente in cls.pazienti
+            for periodo, _ in RiassuntoCasoClinico.PERIODO_CHOICES
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertUsaIndice(self, queryset, tabella, indice):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # Con le scansioni sequenziali disabilitate il planner le sceglie solo se non ha alternative
+                cursor.execute('SET enable_seqscan = off')
+                try:
+                    piano = queryset.explain()
+                finally:
+                    cursor.execute('RESET enable_seqscan')
+            self.assertNotIn(f'Seq Scan on {tabella}', piano, piano)
+        else:
+            piano = queryset.explain()
+            # SQLite: "SCAN tabella" senza indice indica una scansione completa
+            self.assertIsNone(re.search(rf'SCAN {tabella}\b(?! USING)', piano), piano)
+        self.assertIn(indice, piano, piano)
+
+    def test_note_del_paziente_dalla_piu_recente(self):
+        paziente = self.pazienti[3]
+        self.assertUsaIndice(
+            NotaDiario.objects.filter(paz=paziente).order_by('-data_nota', '-id')[:20], 'nota_diario', 'nota_paz_data_idx'
+        )
+
+    def test_note_del_paziente_in_un_periodo(self):
+        paziente = self.pazienti[3]
+        self.assertUsaIndice(
+            NotaDiario.objects.filter(paz=paziente, data_nota__gte=timezone.now() - timedelta(days=7)).order_by('data_nota'),
+            'nota_diario', 'nota_paz_data_idx',
+        )
+
+    def test_note_modificate_dopo_il_cursore(self):
+        paziente = self.pazienti[3]
+        self.assertUsaIndice(
+            NotaDiario.objects.filter(paz=paziente, data_modifica__gt=timezone.now() - timedelta(minutes=1)),
+            'nota_diario', 'nota_paz_modifica_idx',
+        )
+
+    def test_note_in_generazione(self):
+        self.assertUsaIndice(NotaDiario.objects.filter(generazione_in_corso=True), 'nota_diario', 'nota_in_generazione_idx')
+
+    def test_riassunto_per_paziente_medico_e_periodo(self):
+        self.assertUsaIndice(
+            RiassuntoCasoClinico.objects.filter(paz=self.pazienti[3], med=self.medico, periodo='30days'),
+            'riassunto_caso_clinico', 'riassunto_paz_med_periodo_idx',
+        )
+
+    def test_messaggi_tra_medico_e_paziente(self):
+        self.assertUsaIndice(
+            Messaggio.objects.filter(med=self.medico, paz=self.pazienti[3]), 'messaggio', 'messaggio_med_paz_idx'
+        )
+
+
+class RiassuntiGerarchiciTest(TestCase):
+    """Le sintesi settimanali e mensili vengono rigenerate solo se cambiano le loro note."""
+
+    def setUp(self):
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        self.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+        adesso = timezone.now()
+        self.note = [
+            NotaDiario.objects.create(paz=self.paziente, testo_paziente=f'Nota {n}', data_nota=adesso - timedelta(days=n))
+            for n in range(0, 80, 2)
+        ]
+        self.data_inizio = adesso - timedelta(days=90)
+
+    async def genera(self, genera):
+        with mock.patch('SoulDiaryConnectApp.views.agenera_con_ollama', genera):
+            return await riassunti.ariassunto_periodo(self.paziente, '3months', 'Ultimi 3 mesi', self.data_inizio)
+
+    async def test_rigenera_solo_le_settimane_modificate(self):
+        genera = mock.AsyncMock(return_value='Sintesi')
+        self.assertEqual(await self.genera(genera), 'Sintesi')
+        settimane = await RiassuntoPeriodico.objects.filter(paz=self.paziente, tipo='settimana').acount()
+        mesi = await RiassuntoPeriodico.objects.filter(paz=self.paziente, tipo='mese').acount()
+        self.assertGreater(settimane, mesi)
+        self.assertEqual(genera.await_count, settimane + mesi + 1)
+
+        genera.reset_mock()
+        await self.genera(genera)
+        self.assertEqual(genera.await_count, 1)
+
+        self.note[0].testo_paziente = 'Nota modificata'
+        await self.note[0].asave()
+        genera.reset_mock()
+        await self.genera(genera)
+        # Una settimana, il suo mese e il riassunto finale
+        self.assertEqual(genera.await_count, 3)
+
+    async def test_settimana_a_cavallo_del_primo_mese(self):
+        # Primo giorno di un mese, non di lunedì, tra circa 3 mesi fa e oggi
+        primo = (timezone.localdate() - timedelta(days=85)).replace(day=1)
+        while primo.weekday() == 0:
+            primo = (primo + timedelta(days=32)).replace(day=1)
+        await NotaDiario.objects.acreate(
+            paz=self.paziente, testo_paziente='Nota del primo del mese',
+            data_nota=timezone.make_aware(datetime.combine(primo, time(10))),
+        )
+        self.data_inizio = timezone.make_aware(datetime.combine(primo, time(12)))
+
+        prompt = []
+        genera = mock.AsyncMock(side_effect=lambda testo, **kwargs: prompt.append(testo) or 'Sintesi')
+        await self.genera(genera)
+        self.assertTrue(any('Nota del primo del mese' in testo for testo in prompt))
+        self.assertTrue(await RiassuntoPeriodico.objects.filter(
+            paz=self.paziente, tipo='settimana', inizio=riassunti.inizio_settimana(primo)
+        ).aexists())
+        # La settimana fa parte della sintesi del primo mese, non del mese precedente
+        mesi = [inizio async for inizio in RiassuntoPeriodico.objects.filter(
+            paz=self.paziente, tipo='mese'
+        ).order_by('inizio').values_list('inizio', flat=True)]
+        self.assertEqual(mesi[0], primo)
+
+    async def test_sintesi_fallita_non_viene_salvata(self):
+        errore = 'Il tempo di attesa per la generazione è scaduto. Riprova.'
+        self.assertEqual(await self.genera(mock.AsyncMock(return_value=errore)), errore)
+        self.assertFalse(await RiassuntoPeriodico.objects.aexists())
+
+
+class NotePazienteTest(TestCase):
+    """La home del paziente mostra una pagina di note, le successive arrivano dall'endpoint JSON."""
+
+    @classmethod
+    def setUpTestData(cls):
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        cls.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+        adesso = timezone.now()
+        NotaDiario.objects.bulk_create([
+            NotaDiario(
+                paz=cls.paziente, testo_paziente=f'Nota {n}', testo_clinico='Analisi riservata',
+                data_nota=adesso - timedelta(hours=n // 2),
+            )
+            for n in range(45)
+        ])
+
+    def setUp(self):
+        sessione = self.client.session
+        sessione['user_type'] = 'paziente'
+        sessione['user_id'] = self.paziente.codice_fiscale
+        sessione.save()
+
+    def test_scorrimento_completo(self):
+        risposta = self.client.get('/paziente/home/')
+        self.assertEqual(len(risposta.context['note_diario']), views.NOTE_PER_PAGINA_PAZIENTE)
+
+        ids = [nota.id for nota in risposta.context['note_diario']]
+        cursore = risposta.context['cursore_successivo']
+        while cursore:
+            dati = self.client.get('/api/paziente/note/', {'cursore': cursore}).json()
+            self.assertNotIn('testo_clinico', dati['note'][0])
+            ids += [nota['id'] for nota in dati['note']]
+            cursore = dati['cursore']
+
+        self.assertEqual(len(ids), 45)
+        self.assertEqual(set(ids), set(NotaDiario.objects.values_list('id', flat=True)))
+
+    def test_cursore_non_valido(self):
+        self.assertEqual(self.client.get('/api/paziente/note/', {'cursore': 'x'}).status_code, 400)
+
+    def test_solo_pazienti(self):
+        sessione = self.client.session
+        sessione['user_type'] = 'medico'
+        sessione.save()
+        self.assertEqual(self.client.get('/api/paziente/note/').status_code, 403)
+
+
+@override_settings(EVENTI_LONG_POLL_TIMEOUT=0.3)
+class StatoNoteTest(TestCase):
+    """API di stato delle note e long-poll sugli eventi di completamento."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        cls.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=cls.medico, email='paziente@example.com', password='x',
+        )
+        adesso = timezone.now()
+        cls.completata = NotaDiario.objects.create(
+            paz=cls.paziente, testo_paziente='Nota analizzata', data_nota=adesso - timedelta(hours=1),
+            testo_clinico='Analisi', emozione_predominante='gioia', stato_analisi='completata',
+        )
+        cls.in_corso = NotaDiario.objects.create(
+            paz=cls.paziente, testo_paziente='Nota in analisi', data_nota=adesso, generazione_in_corso=True,
+        )
+
+    def setUp(self):
+        self.broker = BrokerLocale()
+        eventi.imposta_broker(self.broker)
+        self.addCleanup(eventi.imposta_broker, None)
+        sessione = self.client.session
+        sessione['user_type'] = 'medico'
+        sessione['user_id'] = self.medico.codice_identificativo
+        sessione.save()
+        self.async_client.cookies = self.client.cookies
+
+    async def _attendi(self, **parametri):
+        loop = asyncio.get_running_loop()
+        inizio = loop.time()
+        risposta = await self.async_client.get('/api/note/attendi/', parametri)
+        return risposta, loop.time() - inizio
+
+    async def test_cursore_successivo_attende_il_timeout(self):
+        dati = (await self.async_client.get('/api/note/stato/', {'ids': f'{self.completata.id},{self.in_corso.id}'})).json()
+        self.assertEqual(dati['cursore'], f"{self.in_corso.data_modifica.isoformat()}_{self.in_corso.id}")
+
+        # Nessuna nota modificata dopo il cursore: la richiesta resta in attesa fino al timeout
+        risposta, durata = await self._attendi(paziente_id=self.paziente.pk, dopo=dati['cursore'])
+        self.assertEqual(risposta.json(), {'cursore': dati['cursore'], 'in_corso': [], 'note': []})
+        self.assertGreaterEqual(durata, 0.3)
+
+    async def test_nota_non_seguita_non_risponde_subito(self):
+        # La nota completata è modificata dopo il cursore, ma il client segue solo quella in corso
+        dopo = (self.completata.data_modifica - timedelta(seconds=1)).isoformat()
+        risposta, durata = await self._attendi(paziente_id=self.paziente.pk, dopo=dopo, seguite=str(self.in_corso.id))
+        self.assertEqual(risposta.status_code, 200)
+        self.assertGreaterEqual(durata, 0.3)
+        # Il cursore avanza oltre le note lette
+        self.assertEqual(
+            risposta.json()['cursore'], f"{self.in_corso.data_modifica.isoformat()}_{self.in_corso.id}"
+        )
+
+    def test_stato_per_ids(self):
+        dati = self.client.get('/api/note/stato/', {'ids': f'{self.completata.id},{self.in_corso.id}'}).json()
+        self.assertEqual(dati['in_corso'], [self.in_corso.id])
+        self.assertEqual([nota['id'] for nota in dati['note']], [self.completata.id])
+        self.assertEqual(dati['note'][0]['testo_clinico'], 'Analisi')
+        self.assertEqual(dati['note'][0]['emotion_category'], views.get_emotion_category('gioia'))
+
+    def test_stato_per_paziente_dopo_il_cursore(self):
+        dopo = (self.completata.data_modifica - timedelta(seconds=1)).isoformat()
+        dati = self.client.get('/api/note/stato/', {'paziente_id': self.paziente.pk, 'dopo': dopo}).json()
+        self.assertEqual(dati['in_corso'], [self.in_corso.id])
+        self.assertEqual([nota['id'] for nota in dati['note']], [self.completata.id])
+
+        # Con il cursore restituito non ci sono altre note; la nota completata in seguito sì
+        dati = self.client.get('/api/note/stato/', {'paziente_id': self.paziente.pk, 'dopo': dati['cursore']}).json()
+        self.assertEqual((dati['in_corso'], dati['note']), ([], []))
+        NotaDiario.objects.filter(id=self.in_corso.id).update(
+            generazione_in_corso=False, data_modifica=timezone.now() + timedelta(seconds=1),
+        )
+        dati = self.client.get('/api/note/stato/', {'paziente_id': self.paziente.pk, 'dopo': dati['cursore']}).json()
+        self.assertEqual([nota['id'] for nota in dati['note']], [self.in_corso.id])
+
+    def test_al_massimo_200_ids(self):
+        mancanti = range(10 ** 6, 10 ** 6 + 200)
+        ids = ','.join(map(str, [*mancanti, self.completata.id]))
+        dati = self.client.get('/api/note/stato/', {'ids': ids}).json()
+        self.assertEqual((dati['in_corso'], dati['note']), ([], []))
+
+    def test_parametri_non_validi(self):
+        for parametri in ({}, {'ids': '1,a'}, {'paziente_id': self.paziente.pk, 'dopo': 'ieri'}):
+            with self.subTest(parametri=parametri):
+                self.assertEqual(self.client.get('/api/note/stato/', parametri).status_code, 400)
+
+        sessione = self.client.session
+        sessione['user_type'] = 'paziente'
+        sessione.save()
+        self.assertEqual(self.client.get('/api/note/stato/', {'ids': self.in_corso.id}).status_code, 403)
+
+    @override_settings(EVENTI_LONG_POLL_TIMEOUT=5)
+    async def test_attendi_svegliato_dal_completamento(self):
+        async def completa():
+            await asyncio.sleep(0.1)
+            await NotaDiario.objects.filter(id=self.in_corso.id).aupdate(
+                generazione_in_corso=False, testo_clinico='Analisi completata',
+                data_modifica=timezone.now() + timedelta(seconds=1),
+            )
+            self.broker.pubblica(canale_medico(self.medico.pk), {'nota_id': self.in_corso.id})
+
+        dati = (await self.async_client.get('/api/note/stato/', {'ids': self.in_corso.id})).json()
+        self.assertEqual(dati['in_corso'], [self.in_corso.id])
+        completamento = asyncio.create_task(completa())
+        risposta, durata = await self._attendi(
+            paziente_id=self.paziente.pk, dopo=dati['cursore'], seguite=str(self.in_corso.id)
+        )
+        await completamento
+        self.assertEqual([nota['testo_clinico'] for nota in risposta.json()['note']], ['Analisi completata'])
+        self.assertLess(durata, 5)
+
+
+class ProiezioniNoteTest(TestCase):
+    """Le query degli elenchi e del contesto non leggono le colonne di testo lunghe."""
+
+    @classmethod
+    def setUpTestData(cls):
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        cls.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+        adesso = timezone.now()
+        cls.lunga = NotaDiario.objects.create(
+            paz=cls.paziente, testo_paziente='a' * 200, testo_clinico='Analisi', emozione_predominante='gioia',
+            data_nota=adesso - timedelta(days=2),
+        )
+        cls.breve = NotaDiario.objects.create(
+            paz=cls.paziente, testo_paziente='Nota breve', data_nota=adesso - timedelta(days=1),
+        )
+
+    def test_colonne_selezionate(self):
+        for query in (
+            NotaDiario.objects.per_paziente(),
+            NotaDiario.objects.per_contesto(150),
+            NotaDiario.objects.senza_testi_lunghi(),
+        ):
+            self.assertNotIn('testo_clinico', str(query.query))
+        self.assertNotIn('testo_paziente', str(NotaDiario.objects.per_contesto(150).query).split('SUBSTR')[0])
+
+    def test_contesto_note_precedenti(self):
+        with self.assertNumQueries(1):
+            voci = views._recupera_voci_note_precedenti(self.paziente)
+        self.assertEqual(len(voci), 2)
+        self.assertIn('Emozione: gioia', voci[0])
+        self.assertTrue(voci[0].endswith('Testo: ' + 'a' * 150 + '...'))
+        self.assertTrue(voci[1].endswith('Testo: Nota breve'))
+        self.assertEqual(views._recupera_voci_note_precedenti(self.paziente, escludi_nota_id=self.breve.id), voci[:1])
+
+
+class ContestoNoteTest(TestCase):
+    """Il riepilogo delle ultime note dà le stesse voci della query, senza query."""
+
+    def setUp(self):
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        self.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+        adesso = timezone.now()
+        self.note = []
+        for i in range(contesto_note.DIMENSIONE_CONTESTO + 2):
+            nota = NotaDiario.objects.create(
+                paz=self.paziente, testo_paziente=f'Nota {i} ' + 'b' * 160 * (i % 2),
+                emozione_predominante='gioia' if i % 3 else '', data_nota=adesso - timedelta(hours=20 - i),
+            )
+            contesto_note.aggiorna_nota(nota, self.paziente)
+            self.note.append(nota)
+
+    def _voci_da_query(self, escludi_nota_id=None):
+        paziente = Paziente.objects.get(pk=self.paziente.pk)
+        paziente.contesto_note = {}
+        return views._recupera_voci_note_precedenti(paziente, escludi_nota_id=escludi_nota_id)
+
+    def test_voci_senza_query(self):
+        for nota in [None] + self.note[-4:]:
+            escludi = nota.id if nota else None
+            with self.assertNumQueries(0):
+                voci = views._recupera_voci_note_precedenti(self.paziente, escludi_nota_id=escludi)
+            self.assertEqual(voci, self._voci_da_query(escludi))
+
+    def test_note_vecchie_lette_dal_database(self):
+        vecchia = self.note[1]
+        self.assertIsNone(contesto_note.voci_precedenti(self.paziente, escludi_nota_id=vecchia.id))
+        self.assertEqual(
+            views._recupera_voci_note_precedenti(self.paziente, escludi_nota_id=vecchia.id), self._voci_da_query(vecchia.id)
+        )
+
+    def test_analisi_ed_eliminazione(self):
+        ultima = self.note[-1]
+        ultima.emozione_predominante = 'tristezza'
+        ultima.save()
+        contesto_note.aggiorna_nota(ultima)
+        contesto_note.rimuovi_nota(self.note[-2])
+        self.note[-2].delete()
+
+        paziente = Paziente.objects.get(pk=self.paziente.pk)
+        self.assertEqual(len(paziente.contesto_note['note']), contesto_note.DIMENSIONE_CONTESTO)
+        voci = views._recupera_voci_note_precedenti(paziente)
+        self.assertIn('Emozione: tristezza', voci[-1])
+        self.assertEqual(voci, self._voci_da_query())
+
+
+class NoteSimiliTest(TestCase):
+    """La ricerca per embedding trova le note passate più simili, solo tra quelle precedenti."""
+
+    def setUp(self):
+        llm_backends.imposta_backend(llm_backends.BackendFake())
+        self.addCleanup(llm_backends.imposta_backend, None)
+        embeddings.svuota_cache()
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        self.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+        testi = [
+            'Litigio con mia sorella per la casa dei nonni',
+            'Esame di matematica andato bene, studio premiato',
+            'Passeggiata al mare con il cane',
+            'Ancora tensione con mia sorella per la casa',
+        ]
+        adesso = timezone.now()
+        self.note = [
+            NotaDiario.objects.create(paz=self.paziente, testo_paziente=testo, data_nota=adesso - timedelta(days=10 - i))
+            for i, testo in enumerate(testi)
+        ]
+        embeddings.indicizza_note(self.note)
+
+    def test_nota_piu_simile(self):
+        corrente = self.note[-1]
+        simili = embeddings.note_simili(self.paziente.pk, nota_id=corrente.id, k=1)
+        self.assertEqual([nota_id for nota_id, _ in simili], [self.note[0].id])
+        # Le note successive e la nota stessa non sono candidate
+        self.assertEqual(embeddings.note_simili(self.paziente.pk, nota_id=self.note[0].id), [])
+
+    def test_ricerca_vettoriale(self):
+        generatore = np.random.default_rng(0)
+        matrice = generatore.standard_normal((10000, 64)).astype(np.float32)
+        matrice /= np.linalg.norm(matrice, axis=1, keepdims=True)
+        indice = embeddings.IndicePaziente(np.arange(10000), np.arange(10000, dtype=np.float64), matrice)
+        vettore = matrice[123]
+        risultati = indice.cerca(vettore, 5, prima_di=5000.0)
+        attesi = np.argsort(matrice[:5000] @ vettore)[::-1][:5]
+        self.assertEqual([nota_id for nota_id, _ in risultati], attesi.tolist())
+
+    def test_prompt_clinico_con_note_simili(self):
+        medico = Medico.objects.get()
+        with override_settings(NOTE_SIMILI_SOGLIA=0.1):
+            voci = views._recupera_voci_note_simili(self.paziente, '', nota_id=self.note[-1].id, limite_recenti=1)
+        self.assertEqual(len(voci), 1)
+        self.assertIn('Litigio con mia sorella', voci[0])
+        # Le note già tra le ultime 5 non vengono ripetute
+        prompt, _ = views._costruisci_prompt_clinico(self.note[-1].testo_paziente, medico, self.paziente, nota_id=self.note[-1].id)
+        self.assertEqual(prompt.count('Litigio con mia sorella'), 1)
+
+    @override_settings(NOTE_SIMILI_SOGLIA=0.1)
+    def test_rigenerazione_senza_query(self):
+        medico = Medico.objects.get()
+        adesso = timezone.now()
+        altre = [
+            NotaDiario.objects.create(
+                paz=self.paziente, testo_paziente=f'Giornata tranquilla al lavoro numero {i}',
+                data_nota=adesso - timedelta(days=6 - i),
+            )
+            for i in range(6)
+        ]
+        corrente = NotaDiario.objects.create(
+            paz=self.paziente, testo_paziente='Di nuovo discussione con mia sorella per la casa dei nonni', data_nota=adesso,
+        )
+        embeddings.indicizza_note(altre + [corrente])
+        for nota in self.note + altre + [corrente]:
+            contesto_note.aggiorna_nota(nota)
+
+        # Prima generazione: ricerca delle note simili, salvate nel riepilogo del paziente
+        paziente = Paziente.objects.get(pk=self.paziente.pk)
+        prompt, _ = views._costruisci_prompt_clinico(corrente.testo_paziente, medico, paziente, nota_id=corrente.id)
+        self.assertIn('Litigio con mia sorella', prompt)
+
+        # Rigenerazione: paziente riletto con la nota, contesto recente e note simili senza query
+        paziente = Paziente.objects.get(pk=self.paziente.pk)
+        with self.assertNumQueries(0):
+            rigenerato, _ = views._costruisci_prompt_clinico(corrente.testo_paziente, medico, paziente, nota_id=corrente.id)
+        self.assertEqual(rigenerato, prompt)
+
+        # Eliminare una nota simile invalida le note simili salvate
+        contesto_note.rimuovi_nota(self.note[0])
+        self.note[0].delete()
+        paziente = Paziente.objects.get(pk=self.paziente.pk)
+        elemento = next(e for e in paziente.contesto_note['note'] if e['id'] == corrente.id)
+        self.assertNotIn('simili', elemento)
+        prompt, _ = views._costruisci_prompt_clinico(corrente.testo_paziente, medico, paziente, nota_id=corrente.id)
+        self.assertNotIn('Litigio con mia sorella', prompt)
+
+
+def _backend_non_raggiungibile(payload):
+    raise llm_backends.BackendNonRaggiungibile("connessione rifiutata")
+
+
+@override_settings(LLM_CACHE_ENABLED=False, ANALISI_COMBINATA=True)
+class RianalisiNoteTest(TransactionTestCase):
+    """Le analisi fallite vengono marcate nello stato della nota e rielaborate da reanalyze_notes."""
+
+    def setUp(self):
+        self.addCleanup(llm_backends.imposta_backend, None)
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        self.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+        self.nota = NotaDiario.objects.create(
+            paz=self.paziente, testo_paziente='Oggi sono stato al parco.', data_nota=timezone.now(),
+            generazione_in_corso=True,
+        )
+
+    def _analizza(self):
+        # In un thread, come nei worker: la funzione chiude la connessione al termine
+        esito = []
+        thread = threading.Thread(target=lambda: esito.append(views.genera_analisi_in_background(
+            self.nota.id, self.nota.testo_paziente, self.paziente.med, self.paziente
+        )))
+        thread.start()
+        thread.join()
+        self.nota.refresh_from_db()
+        return esito[0]
+
+    def test_analisi_fallita_e_rianalisi(self):
+        llm_backends.imposta_backend(llm_backends.BackendFake(genera_risposta=_backend_non_raggiungibile))
+        with self.assertRaises(llm_backends.BackendNonRaggiungibile):
+            views.genera_con_ollama('Prompt di prova', solleva_errori=True)
+        self.assertFalse(self._analizza())
+        self.assertEqual(self.nota.stato_analisi, 'fallita')
+        self.assertIn('connessione rifiutata', self.nota.errore_analisi)
+        # Nessun messaggio di errore salvato al posto dell'analisi clinica
+        self.assertIsNone(self.nota.testo_clinico)
+        sessione = self.client.session
+        sessione['user_type'] = 'medico'
+        sessione['user_id'] = self.paziente.med_id
+        sessione.save()
+        risposta = self.client.get('/medico/home/', {'paziente_id': self.paziente.pk})
+        self.assertContains(risposta, 'Analisi clinica non disponibile')
+
+        llm_backends.imposta_backend(llm_backends.BackendFake())
+        with tempfile.TemporaryDirectory() as cartella:
+            checkpoint = os.path.join(cartella, 'checkpoint.json')
+            call_command('reanalyze_notes', '--dry-run', '--checkpoint', checkpoint, stdout=io.StringIO())
+            self.nota.refresh_from_db()
+            self.assertEqual(self.nota.stato_analisi, 'fallita')
+
+            call_command('reanalyze_notes', '--workers', '1', '--checkpoint', checkpoint, stdout=io.StringIO())
+            self.assertFalse(os.path.exists(checkpoint))
+        self.nota.refresh_from_db()
+        self.assertEqual(self.nota.stato_analisi, 'completata')
+        self.assertIsNone(self.nota.errore_analisi)
+        self.assertIn(self.nota.emozione_predominante, views.EMOZIONI_EMOJI)
+        # La rianalisi passa da un job, registrato come quelli dei worker
+        self.assertEqual(list(JobAnalisi.objects.filter(nota=self.nota).values_list('stato', flat=True)), ['completato'])
+
+    def test_errore_imprevisto_del_worker_sblocca_la_nota(self):
+        job = jobs.accoda_analisi(self.nota)
+        stop_event = threading.Event()
+        with mock.patch.object(jobs, 'esegui_job', side_effect=RuntimeError('errore imprevisto')):
+            thread = threading.Thread(target=jobs.ciclo_worker, args=('worker-test', stop_event, 0.05))
+            thread.start()
+            for _ in range(200):
+                if JobAnalisi.objects.filter(id=job.id, stato='fallito').exists():
+                    break
+                stop_event.wait(0.05)
+            stop_event.set()
+            thread.join()
+
+        self.nota.refresh_from_db()
+        self.assertFalse(self.nota.generazione_in_corso)
+        self.assertEqual(self.nota.stato_analisi, 'fallita')
+        self.assertEqual(self.nota.errore_analisi, 'errore imprevisto')
+        # La nota non viene più considerata orfana e riaccodata
+        self.assertEqual(jobs.recupera_job_bloccati(900, 3), (0, 0, 0))
+
+    def test_note_in_rianalisi_non_orfane(self):
+        NotaDiario.objects.filter(id=self.nota.id).update(generazione_in_corso=False, stato_analisi='fallita')
+        jobs.assegna_job([self.nota], 'reanalyze_notes:test')
+        NotaDiario.objects.filter(id=self.nota.id).update(generazione_in_corso=True)
+
+        self.assertEqual(jobs.recupera_job_bloccati(900, 3), (0, 0, 0))
+        self.assertEqual(JobAnalisi.objects.filter(nota=self.nota).count(), 1)
+
+
+class IntervalloAnalisiTest(TestCase):
+    """Parametri di periodo non validi nella pagina di analisi ricadono sull'intervallo predefinito."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        cls.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=cls.medico, email='paziente@example.com', password='x',
+        )
+
+    def setUp(self):
+        sessione = self.client.session
+        sessione['user_type'] = 'medico'
+        sessione['user_id'] = self.medico.codice_identificativo
+        sessione.save()
+
+    def test_parametri_non_validi(self):
+        for parametri in (
+            {'anno': '0'},
+            {'anno': '0', 'periodo': 'year'},
+            {'anno': '0', 'periodo': 'anno'},
+            {'anno': '99999999999999999999'},
+            {'anno': '9999', 'mese': '12'},
+            {'anno': '2024', 'mese': '13'},
+            {'dal': '2024-02-30', 'al': '2024-13-01'},
+            {'dal': 'ieri'},
+        ):
+            with self.subTest(parametri=parametri):
+                risposta = self.client.get('/medico/analisi/', dict(parametri, paziente_id=self.paziente.pk))
+                self.assertEqual(risposta.status_code, 200)
+
+    def test_intervallo(self):
+        self.assertEqual(views._intervallo_analisi({'anno': '0'})[3], 'all')
+        dal, al, _, periodo = views._intervallo_analisi({'anno': '2024', 'mese': '2'})
+        self.assertEqual((dal, al, periodo), (date(2024, 2, 1), date(2024, 2, 29), 'specifico'))
+        dal, al, _, _ = views._intervallo_analisi({'periodo': '7days', 'dal': '2024-02-30'})
+        self.assertEqual(dal, timezone.localdate() - timedelta(days=7))
+
+
+class AggregatiEmotiviTest(TestCase):
+    """Gli aggregati aggiornati nota per nota coincidono con quelli ricostruiti da zero."""
+
+    @classmethod
+    def setUpTestData(cls):
+        medico = Medico.objects.create(
+            codice_identificativo='MED1', nome='Anna', cognome='Bianchi', indirizzo_studio='Via Roma',
+            citta='Salerno', numero_civico='1', email='medico@example.com', password='x',
+        )
+        cls.paziente = Paziente.objects.create(
+            codice_fiscale='PZNTST00A01H701X', nome='Paziente', cognome='Test',
+            data_di_nascita='1990-01-01', med=medico, email='paziente@example.com', password='x',
+        )
+
+    def _righe(self):
+        return sorted(AggregatoEmotivo.objects.filter(paz=self.paziente).values_list(
+            'giorno', 'emozione', 'categoria', 'contesto', 'num_note', 'somma_punteggi'
+        ))
+
+    def assertAggregatiCoerenti(self):
+        incrementali = self._righe()
+        aggregati.ricostruisci_aggregati(self.paziente.pk)
+        self.assertEqual(incrementali, self._righe())
+
+    def _crea(self, data_nota):
+        # Come in paziente_home: la nota nasce senza analisi
+        nota = NotaDiario.objects.create(
+            paz=self.paziente, testo_paziente='Nota', data_nota=data_nota,
+            emozione_predominante='', contesto_sociale='', generazione_in_corso=True,
+        )
+        aggregati.registra_nota(nota)
+        return nota
+
+    def _analizza(self, nota, emozione, contesto):
+        # Come in genera_analisi_in_background
+        chiave_precedente = aggregati.chiave_nota(nota)
+        nota.emozione_predominante = emozione
+        nota.contesto_sociale = contesto
+        nota.generazione_in_corso = False
+        nota.save()
+        aggregati.sposta_nota(nota.paz_id, chiave_precedente, aggregati.chiave_nota(nota))
+
+    def test_aggregati_incrementali(self):
+        adesso = timezone.now()
+        note = [self._crea(adesso), self._crea(adesso), self._crea(adesso - timedelta(days=1))]
+        self.assertAggregatiCoerenti()
+
+        self._analizza(note[0], 'Gioia', 'famiglia')
+        self._analizza(note[1], 'gioia ', 'Famiglia')
+        self._analizza(note[2], 'tristezza', 'lavoro')
+        self.assertEqual(AggregatoEmotivo.objects.get(paz=self.paziente, emozione='gioia').num_note, 2)
+        self.assertAggregatiCoerenti()
+
+        # Rianalisi: emozione e contesto cambiano
+        self._analizza(note[1], 'ansia', 'amici')
+        self._analizza(note[2], 'emozione sconosciuta', 'lavoro')
+        self.assertAggregatiCoerenti()
+
+        aggregati.rimuovi_nota(note[0])
+        note[0].delete()
+        self.assertFalse(AggregatoEmotivo.objects.filter(paz=self.paziente, emozione='gioia').exists())
+        self.assertAggregatiCoerenti()
@@ -16,8 +16,12 @@ urlpatterns = [
     path('medico/personalizza/', views.personalizza_generazione, name='personalizza_generazione'),
     path('paziente/note/<int:nota_id>/elimina/', views.elimina_nota, name='elimina_nota'),
     path('paziente/note/<int:nota_id>/genera-supporto/', views.genera_frase_supporto_nota, name='genera_frase_supporto_nota'),
+    path('paziente/note/<int:nota_id>/supporto/stream/', views.stream_frase_supporto, name='stream_frase_supporto'),
+    path('api/paziente/note/', views.note_paziente, name='note_paziente'),
     path('medico/rigenera_frase_clinica/', views.rigenera_frase_clinica, name='rigenera_frase_clinica'),
     path('api/nota/<int:nota_id>/stato/', views.controlla_stato_generazione, name='controlla_stato_generazione'),
+    path('api/note/stato/', views.stato_note, name='stato_note'),
+    path('api/note/attendi/', views.attendi_note, name='attendi_note'),
 ]
 
 if settings.DEBUG:
@@ -1,27 +1,42 @@
-from django.shortcuts import render, redirect, get_object_or_404
-from .models import Medico, Paziente, NotaDiario, RiassuntoCasoClinico
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from .models import Medico, Paziente, NotaDiario, RiassuntoCasoClinico, AggregatoEmotivo
 from django.contrib import messages
 from django.contrib.auth import logout
 from django.utils import timezone
-from django.http import JsonResponse
-from django.db import connection
+from django.utils.dateparse import parse_date, parse_datetime
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db import connection, transaction
+from django.db.models import Case, CharField, DateField, Min, Q, Sum, Value, When
+from django.db.models.functions import ExtractYear, Lower, Trim, TruncDay, TruncMonth, TruncWeek
+from django.db.models.lookups import Exact
 from django.core.cache import cache
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from datetime import timedelta
-import requests
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from datetime import date, timedelta
+from . import aggregati, contesto_note, embeddings, eventi, llm_backends, llm_cache, llm_client, llm_scheduler, prompt_budget, riassunti, single_flight
+from .aho_corasick import AhoCorasick
+from .jobs import accoda_analisi
+from .paginazione import decodifica_cursore, pagina_note
+import asyncio
 import logging
 import re
 import json
 import hashlib
 import difflib
-import threading
 
 logger = logging.getLogger(__name__)
 
-# Configurazione Ollama
-OLLAMA_BASE_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "llama3.1:8b"  # Cambia in "cbt-assistant" se hai creato il modello personalizzato
+# Testi restituiti da genera_con_ollama / agenera_con_ollama quando la generazione fallisce
+MESSAGGI_ERRORE_LLM = frozenset({
+    "Generazione non disponibile al momento.",
+    "Il servizio di generazione testo non è al momento disponibile. Riprova più tardi.",
+    "Servizio di generazione testo non disponibile. Verifica che Ollama sia attivo.",
+    "Il tempo di attesa per la generazione è scaduto. Riprova.",
+    "Errore durante la generazione del testo. Riprova più tardi.",
+    "Errore imprevisto durante la generazione. Riprova.",
+})
 
 # Configurazione lunghezza note cliniche (in caratteri)
 LUNGHEZZA_NOTA_BREVE = 300
@@ -126,6 +141,47 @@ MESSAGGI_CONFORTO = {
 }
 
 
+# Categorie di emergenza in ordine di priorità (la prima trovata determina il tipo)
+CATEGORIE_CRISI = [
+    ('suicidio', KEYWORDS_SUICIDIO),
+    ('violenza', KEYWORDS_VIOLENZA_STALKING),
+    ('autolesionismo', KEYWORDS_AUTOLESIONISMO),
+]
+
+
+def _costruisci_automa_crisi():
+    automa = AhoCorasick()
+    for tipo, keywords in CATEGORIE_CRISI:
+        for keyword in keywords:
+            automa.aggiungi(keyword, tipo)
+    return automa.costruisci()
+
+
+# Automa costruito una sola volta all'import: una scansione del testo trova tutte le keyword
+AUTOMA_CRISI = _costruisci_automa_crisi()
+
+
+def trova_contenuti_crisi(testo):
+    """
+    Trova tutte le parole chiave di rischio presenti nel testo, con una sola scansione.
+
+    Args:
+        testo: Il testo della nota del paziente
+
+    Returns:
+        list: dizionari {'tipo', 'keyword', 'inizio', 'fine'} ordinati per posizione.
+              Le posizioni si riferiscono al testo convertito in minuscolo.
+    """
+    if not testo:
+        return []
+
+    occorrenze = AUTOMA_CRISI.trova(testo.lower())
+    return [
+        {'tipo': tipo, 'keyword': keyword, 'inizio': inizio, 'fine': fine}
+        for inizio, fine, keyword, tipo in sorted(occorrenze)
+    ]
+
+
 def rileva_contenuto_crisi(testo):
     """
     Analizza il testo per rilevare contenuti di rischio/crisi.
@@ -138,28 +194,17 @@ def rileva_contenuto_crisi(testo):
                is_emergency: True se rilevato contenuto di rischio
                tipo_emergenza: 'suicidio', 'violenza', 'autolesionismo', o 'none'
     """
-    if not testo:
+    occorrenze = trova_contenuti_crisi(testo)
+    if not occorrenze:
         return False, 'none'
 
-    testo_lower = testo.lower()
-
-    # Controlla prima il suicidio (priorità più alta)
-    for keyword in KEYWORDS_SUICIDIO:
-        if keyword in testo_lower:
-            logger.warning(f"EMERGENZA RILEVATA - Tipo: suicidio - Keyword: {keyword}")
-            return True, 'suicidio'
-
-    # Controlla violenza/stalking
-    for keyword in KEYWORDS_VIOLENZA_STALKING:
-        if keyword in testo_lower:
-            logger.warning(f"EMERGENZA RILEVATA - Tipo: violenza - Keyword: {keyword}")
-            return True, 'violenza'
-
-    # Controlla autolesionismo
-    for keyword in KEYWORDS_AUTOLESIONISMO:
-        if keyword in testo_lower:
-            logger.warning(f"EMERGENZA RILEVATA - Tipo: autolesionismo - Keyword: {keyword}")
-            return True, 'autolesionismo'
+    # Rispetta la priorità: suicidio, poi violenza/stalking, poi autolesionismo
+    for tipo, _ in CATEGORIE_CRISI:
+        occorrenze_tipo = [o for o in occorrenze if o['tipo'] == tipo]
+        if occorrenze_tipo:
+            dettaglio = ', '.join(f"'{o['keyword']}'@{o['inizio']}" for o in occorrenze_tipo)
+            logger.warning(f"EMERGENZA RILEVATA - Tipo: {tipo} - Keyword: {dettaglio}")
+            return True, tipo
 
     return False, 'none'
 
@@ -197,7 +242,122 @@ def genera_messaggio_emergenza(tipo_emergenza, medico):
     return messaggio
 
 
-def genera_con_ollama(prompt, max_chars=None, temperature=0.7):
+def _normalizza_risposta(text):
+    """
+    Normalizza il testo generato rimuovendo eventuali prefissi o etichette introduttive
+    (es. "Risposta:", "La tua risposta:", "Ecco la nota clinica:").
+    """
+    text = str(text or '').strip()
+
+    # Rimuove prefissi introduttivi comuni (case-insensitive)
+    text = re.sub(
+        r'^\s*(?:La tua risposta[:\-\s]*|Risposta[:\-\s]*|Output[:\-\s]*|>\s*|Answer[:\-\s]*|Risposta del modello[:\-\s]*)+',
+        '',
+        text,
+        flags=re.I
+    )
+
+    # Rimuove frasi introduttive tipiche delle note cliniche
+    text = re.sub(
+        r'^\s*(?:Ecco la (?:nota clinica|valutazione|analisi)[:\-\s]*|Di seguito[:\-\s]*|La valutazione è[:\-\s]*|Ecco l\'analisi[:\-\s]*|Nota clinica[:\-\s]*)+',
+        '',
+        text,
+        flags=re.I
+    )
+
+    # Rimuove virgolette, apici, bullets o caratteri di maggiore iniziali
+    return re.sub(r'^[\'"«\s\-\u2022>]+', '', text).strip()
+
+
+def _prepara_richiesta_ollama(prompt, max_chars=None, temperature=0.7, formato=None, stream=False):
+    """
+    Costruisce il payload (nel formato dell'API generate di Ollama, comune a tutti
+    i backend di llm_backends) e la relativa chiave di cache.
+
+    Returns:
+        tuple: (payload, chiave_cache)
+    """
+    modello = llm_backends.get_backend().modello
+    num_ctx = prompt_budget.num_ctx()
+
+    # Token della risposta stimati dalla lunghezza massima, con margine per non troncarla
+    estimated_tokens = prompt_budget.token_risposta(max_chars)
+    prompt_budget.verifica_prompt(prompt, estimated_tokens)
+
+    payload = {
+        "model": modello,
+        "prompt": prompt,
+        "stream": stream,
+        "options": {
+            "temperature": temperature,
+            "num_predict": estimated_tokens,
+            # Finestra di contesto esplicita: il default di Ollama è più piccolo dei nostri prompt
+            "num_ctx": num_ctx,
+        },
+        # Modello tenuto in memoria tra una richiesta e l'altra (evita di ricaricarlo)
+        "keep_alive": getattr(settings, 'OLLAMA_KEEP_ALIVE', '30m'),
+    }
+    if formato:
+        payload["format"] = formato
+
+    chiave_cache = llm_cache.calcola_chiave(modello, prompt, temperature, estimated_tokens, formato, num_ctx)
+    return payload, chiave_cache
+
+
+def _estrai_testo_risposta(result, formato, chiave_cache):
+    """
+    Estrae il testo dalla risposta JSON di Ollama, lo normalizza e, se valido,
+    lo salva nella cache. Condivisa dalla versione sincrona e da quella asincrona.
+    """
+    llm_client.registra_metriche(result)
+
+    # Estrai il testo dalla risposta in modo robusto
+    text = ''
+    if isinstance(result, dict):
+        # Ollama può restituire diversi formati; proviamo alcune chiavi comuni
+        for key in ('response', 'text', 'output', 'result'):
+            if key in result and result[key]:
+                text = result[key]
+                break
+    else:
+        text = result
+
+    # Se il testo è una lista, unisci gli elementi
+    if isinstance(text, list):
+        text = " ".join(map(str, text))
+
+    if formato:
+        text = str(text or '').strip()
+        llm_cache.salva(chiave_cache, text)
+        return text
+
+    text = _normalizza_risposta(text)
+    if text:
+        llm_cache.salva(chiave_cache, text)
+    return text
+
+
+def _messaggio_errore_llm(errore):
+    """
+    Registra l'errore di una generazione e restituisce il messaggio da mostrare
+    all'utente (uno di MESSAGGI_ERRORE_LLM).
+    """
+    if isinstance(errore, llm_backends.BackendNonDisponibile):
+        return "Il servizio di generazione testo non è al momento disponibile. Riprova più tardi."
+    if isinstance(errore, llm_backends.BackendNonRaggiungibile):
+        logger.error("Impossibile connettersi a Ollama. Assicurati che il servizio sia in esecuzione.")
+        return "Servizio di generazione testo non disponibile. Verifica che Ollama sia attivo."
+    if isinstance(errore, llm_backends.TimeoutGenerazione):
+        logger.error("Timeout nella chiamata a Ollama")
+        return "Il tempo di attesa per la generazione è scaduto. Riprova."
+    if isinstance(errore, llm_backends.ErroreGenerazione):
+        logger.error(f"Errore nella chiamata a Ollama: {errore}")
+        return "Errore durante la generazione del testo. Riprova più tardi."
+    logger.error(f"Errore imprevisto: {errore}")
+    return "Errore imprevisto durante la generazione. Riprova."
+
+
+def genera_con_ollama(prompt, max_chars=None, temperature=0.7, formato=None, usa_cache=True, solleva_errori=False):
     """
     Funzione helper per chiamare Ollama API e normalizzare la risposta rimuovendo
     eventuali prefissi o etichette introduttive (es. "Risposta:", "La tua risposta:").
@@ -206,83 +366,184 @@ def genera_con_ollama(prompt, max_chars=None, temperature=0.7):
         prompt: Il prompt da inviare al modello
         max_chars: Numero massimo di caratteri per la risposta (opzionale)
         temperature: Temperatura per la generazione (default 0.7)
+        formato: JSON schema per vincolare l'output (opzionale). Se indicato,
+                 la risposta viene restituita grezza, senza normalizzazione.
+        usa_cache: Se False non legge la cache (rigenerazioni volute); la nuova
+                   risposta viene comunque salvata
+        solleva_errori: Se True gli errori vengono sollevati (llm_backends.ErroreGenerazione,
+                        anche per una risposta vuota) invece di restituire il messaggio per l'utente
     """
     try:
-        # Stima approssimativa: ~2 caratteri per token in italiano
-        # Aggiungiamo un margine di sicurezza per evitare troncamenti
-        estimated_tokens = (max_chars * 2) if max_chars else 500
-
-        payload = {
-            "model": OLLAMA_MODEL,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "temperature": temperature,
-                "num_predict": estimated_tokens,
-            }
-        }
+        testo = _genera_con_ollama(prompt, max_chars, temperature, formato, usa_cache)
+    except Exception as e:
+        if solleva_errori:
+            raise
+        return _messaggio_errore_llm(e)
 
-        response = requests.post(OLLAMA_BASE_URL, json=payload, timeout=500)
+    if not testo and not formato:
+        if solleva_errori:
+            raise llm_backends.ErroreGenerazione("risposta vuota del modello")
+        return "Generazione non disponibile al momento."
+    return testo
 
-        # Log della risposta per debug
-        if response.status_code != 200:
-            logger.error(f"Ollama ha restituito status code {response.status_code}")
-            logger.error(f"Risposta: {response.text}")
-            return "Il servizio di generazione testo non è al momento disponibile. Riprova più tardi."
 
-        response.raise_for_status()
-        result = response.json()
+def _genera_con_ollama(prompt, max_chars, temperature, formato, usa_cache):
+    """Generazione di genera_con_ollama: gli errori del backend vengono propagati."""
+    payload, chiave_cache = _prepara_richiesta_ollama(prompt, max_chars, temperature, formato)
 
-        # Estrai il testo dalla risposta in modo robusto
-        text = ''
-        if isinstance(result, dict):
-            # Ollama può restituire diversi formati; proviamo alcune chiavi comuni
-            for key in ('response', 'text', 'output', 'result'):
-                if key in result and result[key]:
-                    text = result[key]
-                    break
-        else:
-            text = result
+    # Cache indirizzata dal contenuto: richieste identiche non vengono rigenerate
+    if usa_cache:
+        in_cache = llm_cache.leggi(chiave_cache)
+        if in_cache is not None:
+            logger.info("Risposta LLM servita dalla cache")
+            return in_cache
 
-        # Se il testo è una lista, unisci gli elementi
-        if isinstance(text, list):
-            text = " ".join(map(str, text))
+    def genera():
+        # Backend configurato in settings.LLM_BACKEND (Ollama, llama.cpp nel processo o fake),
+        # con uno slot assegnato dallo scheduler secondo la priorità del chiamante
+        with llm_scheduler.slot():
+            risultato = llm_backends.get_backend().genera(payload)
+        return _estrai_testo_risposta(risultato, formato, chiave_cache)
 
-        text = str(text or '').strip()
+    # Richieste identiche concorrenti (doppio click, più medici sullo stesso riassunto)
+    # attendono un'unica generazione e ne condividono il risultato
+    return single_flight.esegui(chiave_cache, genera, lambda: llm_cache.leggi(chiave_cache), usa_cache)
 
-        # Rimuove prefissi introduttivi comuni (case-insensitive)
-        text = re.sub(
-            r'^\s*(?:La tua risposta[:\-\s]*|Risposta[:\-\s]*|Output[:\-\s]*|>\s*|Answer[:\-\s]*|Risposta del modello[:\-\s]*)+',
-            '',
-            text,
-            flags=re.I
-        )
 
-        # Rimuove frasi introduttive tipiche delle note cliniche
-        text = re.sub(
-            r'^\s*(?:Ecco la (?:nota clinica|valutazione|analisi)[:\-\s]*|Di seguito[:\-\s]*|La valutazione è[:\-\s]*|Ecco l\'analisi[:\-\s]*|Nota clinica[:\-\s]*)+',
-            '',
-            text,
-            flags=re.I
+async def agenera_con_ollama(prompt, max_chars=None, temperature=0.7, formato=None, usa_cache=True, solleva_errori=False):
+    """
+    Versione asincrona di genera_con_ollama per le view async servite via ASGI:
+    l'attesa della generazione non occupa un thread. Stessi argomenti e stessi
+    messaggi di errore della versione sincrona.
+    """
+    try:
+        testo = await _agenera_con_ollama(prompt, max_chars, temperature, formato, usa_cache)
+    except Exception as e:
+        if solleva_errori:
+            raise
+        return _messaggio_errore_llm(e)
+
+    if not testo and not formato:
+        if solleva_errori:
+            raise llm_backends.ErroreGenerazione("risposta vuota del modello")
+        return "Generazione non disponibile al momento."
+    return testo
+
+
+async def _agenera_con_ollama(prompt, max_chars, temperature, formato, usa_cache):
+    payload, chiave_cache = _prepara_richiesta_ollama(prompt, max_chars, temperature, formato)
+
+    # La cache su disco è sincrona: viene letta in un thread separato
+    if usa_cache:
+        in_cache = await sync_to_async(llm_cache.leggi, thread_sensitive=False)(chiave_cache)
+        if in_cache is not None:
+            logger.info("Risposta LLM servita dalla cache")
+            return in_cache
+
+    async def agenera():
+        async with llm_scheduler.aslot():
+            risultato = await llm_backends.get_backend().agenera(payload)
+        return await sync_to_async(_estrai_testo_risposta, thread_sensitive=False)(
+            risultato, formato, chiave_cache
         )
 
-        # Rimuove virgolette, apici, bullets o caratteri di maggiore iniziali
-        text = re.sub(r'^[\'"«\s\-\u2022>]+', '', text).strip()
+    return await single_flight.aesegui(chiave_cache, agenera, lambda: llm_cache.leggi(chiave_cache), usa_cache)
+
+
+def genera_con_ollama_stream(prompt, max_chars=None, temperature=0.7, priorita=None):
+    """
+    Versione in streaming di genera_con_ollama: restituisce i token man mano che
+    Ollama li genera (risposta NDJSON con "stream": true).
+
+    La priorità nello scheduler (classe, medico_id) va passata esplicitamente: il
+    generatore può essere consumato fuori dal contesto in cui è stato creato.
+
+    Le richieste identiche e concorrenti nello stesso processo (pagina ricaricata,
+    seconda scheda) non avviano un secondo streaming: attendono quello in corso e
+    ne ricevono il testo completo come un solo token.
+
+    Yields:
+        tuple: ('token', testo_parziale) per ogni frammento generato e, alla fine,
+               ('fine', testo_completo_normalizzato) oppure ('errore', messaggio)
+    """
+    payload, chiave_cache = _prepara_richiesta_ollama(prompt, max_chars, temperature, stream=True)
+
+    while True:
+        volo, da_generare = single_flight.registra(chiave_cache)
+        if da_generare:
+            break
+        logger.info("Streaming identico già in corso: attendo il suo risultato")
+        try:
+            testo = volo.attendi()
+        except single_flight.GenerazioneInterrotta:
+            # Il client che generava si è disconnesso: si riprova, generando in proprio
+            continue
+        except Exception as e:
+            yield 'errore', str(e)
+            return
+        yield 'token', testo
+        yield 'fine', testo
+        return
 
-        return text if text else "Generazione non disponibile al momento."
+    esito = None
+    try:
+        for evento in _stream_ollama(payload, chiave_cache, priorita):
+            if evento[0] != 'token':
+                esito = evento
+            yield evento
+    finally:
+        # Eseguito anche se il client si disconnette (GeneratorExit): chi attende va sempre svegliato
+        if esito is None:
+            single_flight.concludi(
+                chiave_cache, volo, errore=single_flight.GenerazioneInterrotta("Generazione interrotta")
+            )
+        elif esito[0] == 'fine':
+            single_flight.concludi(chiave_cache, volo, risultato=esito[1])
+        else:
+            single_flight.concludi(chiave_cache, volo, errore=llm_backends.ErroreGenerazione(esito[1]))
 
-    except requests.exceptions.ConnectionError:
+
+def _stream_ollama(payload, chiave_cache, priorita):
+    """Esegue lo streaming per genera_con_ollama_stream (servendo la cache se presente)."""
+    in_cache = llm_cache.leggi(chiave_cache)
+    if in_cache is not None:
+        logger.info("Risposta LLM servita dalla cache")
+        yield 'token', in_cache
+        yield 'fine', in_cache
+        return
+
+    parti = []
+    try:
+        # Lo slot resta occupato per tutto lo streaming (rilasciato anche se il client si disconnette)
+        with llm_scheduler.slot(*(priorita or ())):
+            for frammento in llm_backends.get_backend().stream(payload):
+                token = frammento.get('response', '')
+                if token:
+                    parti.append(token)
+                    yield 'token', token
+                if frammento.get('done'):
+                    llm_client.registra_metriche(frammento)
+                    break
+    except llm_backends.BackendNonRaggiungibile:
         logger.error("Impossibile connettersi a Ollama. Assicurati che il servizio sia in esecuzione.")
-        return "Servizio di generazione testo non disponibile. Verifica che Ollama sia attivo."
-    except requests.exceptions.Timeout:
+        yield 'errore', "Servizio di generazione testo non disponibile. Verifica che Ollama sia attivo."
+        return
+    except llm_backends.TimeoutGenerazione:
         logger.error("Timeout nella chiamata a Ollama")
-        return "Il tempo di attesa per la generazione è scaduto. Riprova."
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Errore nella chiamata a Ollama: {e}")
-        return "Errore durante la generazione del testo. Riprova più tardi."
+        yield 'errore', "Il tempo di attesa per la generazione è scaduto. Riprova."
+        return
     except Exception as e:
-        logger.error(f"Errore imprevisto: {e}")
-        return "Errore imprevisto durante la generazione. Riprova."
+        logger.error(f"Errore nello streaming da Ollama: {e}")
+        yield 'errore', "Errore durante la generazione del testo. Riprova più tardi."
+        return
+
+    testo = _normalizza_risposta(''.join(parti))
+    if not testo:
+        yield 'errore', "Generazione non disponibile al momento."
+        return
+
+    llm_cache.salva(chiave_cache, testo)
+    yield 'fine', testo
 
 
 def home(request):
@@ -389,6 +650,23 @@ def logout_view(request):
     return redirect('login')
 
 
+# Note mostrate per pagina nella home del medico (paginazione a cursore, vedi paginazione.py)
+NOTE_PER_PAGINA_MEDICO = 20
+
+
+def case_da_dizionario(campo, dizionario, default):
+    """
+    Traduce un dizionario di lookup (es. EMOZIONI_EMOJI) in un'espressione CASE SQL
+    sul campo normalizzato (minuscolo e senza spazi), come nelle funzioni get_emoji_*.
+    """
+    normalizzato = Lower(Trim(campo))
+    return Case(
+        *[When(Exact(normalizzato, chiave), then=Value(valore)) for chiave, valore in dizionario.items()],
+        default=Value(default),
+        output_field=CharField(),
+    )
+
+
 def medico_home(request):
     if request.session.get('user_type') != 'medico':
         return redirect('/login/')
@@ -403,35 +681,38 @@ def medico_home(request):
     paziente_id = request.GET.get('paziente_id')
     paziente_selezionato = Paziente.objects.filter(codice_fiscale=paziente_id).first()
 
-    # Note del paziente selezionato
-    note_diario = NotaDiario.objects.filter(paz=paziente_selezionato).order_by('-data_nota') if paziente_selezionato else None
-
-    # Aggiungi le emoji alle note per il template
-    if note_diario:
-        for nota in note_diario:
-            nota.emoji = get_emoji_for_emotion(nota.emozione_predominante)
-            nota.emotion_category = get_emotion_category(nota.emozione_predominante)
-            nota.context_emoji = get_emoji_for_context(nota.contesto_sociale)
+    # Note del paziente selezionato, una pagina alla volta. Emoji e categoria
+    # dell'emozione vengono calcolate direttamente nella query
+    note_diario = None
+    cursore_successivo = None
+    if paziente_selezionato:
+        note_query = (
+            NotaDiario.objects.filter(paz=paziente_selezionato)
+            .per_medico()
+            .annotate(
+                emoji=case_da_dizionario('emozione_predominante', EMOZIONI_EMOJI, '💭'),
+                emotion_category=case_da_dizionario('emozione_predominante', EMOZIONI_CATEGORIE, 'neutral'),
+                context_emoji=case_da_dizionario('contesto_sociale', CONTESTI_EMOJI, '📝'),
+            )
+        )
+        note_diario, cursore_successivo = pagina_note(
+            note_query, request.GET.get('cursore'), NOTE_PER_PAGINA_MEDICO
+        )
 
     return render(request, 'SoulDiaryConnectApp/medico_home.html', {
         'medico': medico,
         'pazienti': pazienti,
         'paziente_selezionato': paziente_selezionato,
         'note_diario': note_diario,
+        'cursore_successivo': cursore_successivo,
+        'prima_pagina': not request.GET.get('cursore'),
     })
 
 
-def genera_frasi_di_supporto(testo, paziente=None):
-    """
-    Genera frasi di supporto empatico per il paziente usando Ollama
-
-    Args:
-        testo: Il testo della nota del paziente
-        paziente: L'oggetto Paziente (opzionale, per evitare confusione con altri nomi nel testo)
-    """
-    print("Generazione frasi supporto con Ollama")
-
-    # Costruisco il contesto sul paziente se disponibile
+def _prompt_frasi_di_supporto(testo, paziente=None):
+    """Costruisce il prompt per la frase di supporto empatico al paziente."""
+    # Il contesto sul paziente va in coda, subito prima del testo: tutto ciò che lo
+    # precede è identico per ogni paziente e Ollama può riusarne la valutazione
     contesto_paziente = ""
     if paziente:
         nome_completo = f"{paziente.nome} {paziente.cognome}"
@@ -445,7 +726,7 @@ def genera_frasi_di_supporto(testo, paziente=None):
 
     prompt = f"""Sei un assistente empatico e di supporto emotivo. Il tuo compito è rispondere con calore e comprensione a persone che stanno attraversando momenti difficili.
 
-    {contesto_paziente}Esempio:
+    Esempio:
     Testo del paziente: "Ho fallito il mio esame e ho voglia di arrendermi."
     Risposta di supporto: "Mi dispiace molto per il tuo esame. È normale sentirsi delusi, ma questo non definisce il tuo valore come persona. Potresti provare a rivedere il tuo metodo di studio e chiedere aiuto se ne hai bisogno. Ce la puoi fare!"
     
@@ -458,12 +739,46 @@ def genera_frasi_di_supporto(testo, paziente=None):
     - Completa sempre la risposta, non troncare mai a metà
     - NON confondere l'autore del testo con altre persone menzionate nella nota
     
-    Testo del paziente:
+    {contesto_paziente}Testo del paziente:
     {testo}
     
     Rispondi con una frase di supporto:"""
 
-    return genera_con_ollama(prompt, max_chars=500, temperature=0.3)
+    return prompt
+
+
+def genera_frasi_di_supporto(testo, paziente=None):
+    """
+    Genera frasi di supporto empatico per il paziente usando Ollama
+
+    Args:
+        testo: Il testo della nota del paziente
+        paziente: L'oggetto Paziente (opzionale, per evitare confusione con altri nomi nel testo)
+    """
+    print("Generazione frasi supporto con Ollama")
+
+    # Il paziente attende la risposta: priorità massima nello scheduler
+    with llm_scheduler.priorita('supporto', paziente.med_id if paziente else None):
+        return genera_con_ollama(_prompt_frasi_di_supporto(testo, paziente), max_chars=500, temperature=0.3)
+
+
+async def agenera_frasi_di_supporto(testo, paziente=None):
+    """Versione asincrona di genera_frasi_di_supporto (vedi agenera_con_ollama)."""
+    with llm_scheduler.priorita('supporto', paziente.med_id if paziente else None):
+        return await agenera_con_ollama(_prompt_frasi_di_supporto(testo, paziente), max_chars=500, temperature=0.3)
+
+
+def genera_frasi_di_supporto_stream(testo, paziente=None):
+    """
+    Come genera_frasi_di_supporto, ma restituisce i token man mano che vengono generati
+    (vedi genera_con_ollama_stream).
+    """
+    print("Generazione frasi supporto con Ollama (streaming)")
+
+    return genera_con_ollama_stream(
+        _prompt_frasi_di_supporto(testo, paziente), max_chars=500, temperature=0.3,
+        priorita=('supporto', paziente.med_id if paziente else None),
+    )
 
 
 # Dizionario delle emozioni con le relative emoji
@@ -582,6 +897,111 @@ def get_emoji_for_context(contesto):
     return CONTESTI_EMOJI.get(contesto_lower, '📝')
 
 
+def _valida_contesto(contesto):
+    """
+    Normalizza il contesto restituito dal modello su una delle chiavi di CONTESTI_EMOJI,
+    usando fuzzy matching e sinonimi. Se non riconosciuto, restituisce 'altro'.
+    """
+    if contesto and contesto in CONTESTI_EMOJI:
+        contesto_validato = contesto
+    else:
+        # Fallback con fuzzy matching
+        contesto_validato = 'altro'
+        for chiave in CONTESTI_EMOJI.keys():
+            if contesto and chiave in contesto:
+                contesto_validato = chiave
+                break
+
+        # Controllo sinonimi
+        sinonimi = {
+            'ufficio': 'lavoro',
+            'azienda': 'lavoro',
+            'professione': 'lavoro',
+            'carriera': 'lavoro',
+            'college': 'università',
+            'ateneo': 'università',
+            'liceo': 'scuola',
+            'elementare': 'scuola',
+            'media': 'scuola',
+            'genitori': 'famiglia',
+            'fratelli': 'famiglia',
+            'parenti': 'famiglia',
+            'figli': 'famiglia',
+            'madre': 'famiglia',
+            'padre': 'famiglia',
+            'mamma': 'famiglia',
+            'papà': 'famiglia',
+            'sorella': 'famiglia',
+            'fratello': 'famiglia',
+            'amici': 'amicizia',
+            'compagni': 'amicizia',
+            'amico': 'amicizia',
+            'amica': 'amicizia',
+            'partner': 'relazione',
+            'fidanzato': 'relazione',
+            'fidanzata': 'relazione',
+            'marito': 'relazione',
+            'moglie': 'relazione',
+            'compagno': 'relazione',
+            'compagna': 'relazione',
+            'ragazzo': 'relazione',
+            'ragazza': 'relazione',
+            'sentimentale': 'relazione',
+            'romantico': 'relazione',
+            'romantica': 'relazione',
+            'coppia': 'relazione',
+            'amore': 'relazione',
+            'innamorato': 'relazione',
+            'innamorata': 'relazione',
+            'medico': 'salute',
+            'ospedale': 'salute',
+            'malattia': 'salute',
+            'allenamento': 'palestra',
+            'allenarsi': 'palestra',
+            'corsa': 'sport',
+            'correre': 'sport',
+            'nuoto': 'sport',
+            'nuotare': 'sport',
+            'calcio': 'sport',
+            'tennis': 'sport',
+            'basket': 'sport',
+            'pallavolo': 'sport',
+            'ciclismo': 'sport',
+            'bicicletta': 'sport',
+            'fitness': 'palestra',
+            'pesi': 'palestra',
+            'cardio': 'palestra',
+            'crossfit': 'palestra',
+            'yoga': 'palestra',
+            'pilates': 'palestra',
+            'esercizi': 'palestra',
+            'esercizio': 'palestra',
+            'attività fisica': 'sport',
+            'ginnastica': 'palestra',
+            'svago': 'tempo libero',
+            'divertimento': 'tempo libero',
+            'passatempo': 'hobby',
+            'vacanza': 'viaggi',
+            'viaggio': 'viaggi',
+            'appartamento': 'casa',
+            'soldi': 'finanze',
+            'economia': 'finanze',
+            'meditazione': 'spiritualità',
+            'religione': 'spiritualità',
+            'esame': 'studio',
+            'compiti': 'studio',
+            'cibo': 'alimentazione',
+            'dieta': 'alimentazione',
+            'dormire': 'sonno',
+            'insonnia': 'sonno',
+        }
+
+        if contesto and contesto in sinonimi:
+            contesto_validato = sinonimi[contesto]
+
+    return contesto_validato
+
+
 def analizza_contesto_sociale(testo, paziente=None):
     """
     Analizza il contesto sociale del testo del paziente e restituisce il contesto principale
@@ -612,7 +1032,7 @@ def analizza_contesto_sociale(testo, paziente=None):
 
     prompt = f"""Sei un esperto di analisi del contesto sociale. Il tuo compito è identificare il contesto sociale principale in cui si svolge il racconto di un paziente e spiegare perché.
 
-    {info_paziente}CONTESTI DISPONIBILI (scegli SOLO tra questi):
+    CONTESTI DISPONIBILI (scegli SOLO tra questi):
     {contesti_lista}
     
     FORMATO RISPOSTA (OBBLIGATORIO):
@@ -663,7 +1083,7 @@ def analizza_contesto_sociale(testo, paziente=None):
     Contesto: sport
     Spiegazione: Il testo descrive attività fisica come "corsa" ed "esercizi", che rientrano nel contesto sportivo.
     
-    Testo da analizzare:
+    {info_paziente}Testo da analizzare:
     {testo}
     
     Rispondi ora nel formato richiesto:"""
@@ -687,102 +1107,7 @@ def analizza_contesto_sociale(testo, paziente=None):
     print(f"Contesto parsed: {contesto}, Spiegazione parsed: {spiegazione}")
 
     # Validazione e normalizzazione del contesto
-    if contesto and contesto in CONTESTI_EMOJI:
-        contesto_validato = contesto
-    else:
-        # Fallback con fuzzy matching
-        contesto_validato = 'altro'
-        for chiave in CONTESTI_EMOJI.keys():
-            if contesto and chiave in contesto:
-                contesto_validato = chiave
-                break
-
-        # Controllo sinonimi
-        sinonimi = {
-            'ufficio': 'lavoro',
-            'azienda': 'lavoro',
-            'professione': 'lavoro',
-            'carriera': 'lavoro',
-            'college': 'università',
-            'ateneo': 'università',
-            'liceo': 'scuola',
-            'elementare': 'scuola',
-            'media': 'scuola',
-            'genitori': 'famiglia',
-            'fratelli': 'famiglia',
-            'parenti': 'famiglia',
-            'figli': 'famiglia',
-            'madre': 'famiglia',
-            'padre': 'famiglia',
-            'mamma': 'famiglia',
-            'papà': 'famiglia',
-            'sorella': 'famiglia',
-            'fratello': 'famiglia',
-            'amici': 'amicizia',
-            'compagni': 'amicizia',
-            'amico': 'amicizia',
-            'amica': 'amicizia',
-            'partner': 'relazione',
-            'fidanzato': 'relazione',
-            'fidanzata': 'relazione',
-            'marito': 'relazione',
-            'moglie': 'relazione',
-            'compagno': 'relazione',
-            'compagna': 'relazione',
-            'ragazzo': 'relazione',
-            'ragazza': 'relazione',
-            'sentimentale': 'relazione',
-            'romantico': 'relazione',
-            'romantica': 'relazione',
-            'coppia': 'relazione',
-            'amore': 'relazione',
-            'innamorato': 'relazione',
-            'innamorata': 'relazione',
-            'medico': 'salute',
-            'ospedale': 'salute',
-            'malattia': 'salute',
-            'allenamento': 'palestra',
-            'allenarsi': 'palestra',
-            'corsa': 'sport',
-            'correre': 'sport',
-            'nuoto': 'sport',
-            'nuotare': 'sport',
-            'calcio': 'sport',
-            'tennis': 'sport',
-            'basket': 'sport',
-            'pallavolo': 'sport',
-            'ciclismo': 'sport',
-            'bicicletta': 'sport',
-            'fitness': 'palestra',
-            'pesi': 'palestra',
-            'cardio': 'palestra',
-            'crossfit': 'palestra',
-            'yoga': 'palestra',
-            'pilates': 'palestra',
-            'esercizi': 'palestra',
-            'esercizio': 'palestra',
-            'attività fisica': 'sport',
-            'ginnastica': 'palestra',
-            'svago': 'tempo libero',
-            'divertimento': 'tempo libero',
-            'passatempo': 'hobby',
-            'vacanza': 'viaggi',
-            'viaggio': 'viaggi',
-            'appartamento': 'casa',
-            'soldi': 'finanze',
-            'economia': 'finanze',
-            'meditazione': 'spiritualità',
-            'religione': 'spiritualità',
-            'esame': 'studio',
-            'compiti': 'studio',
-            'cibo': 'alimentazione',
-            'dieta': 'alimentazione',
-            'dormire': 'sonno',
-            'insonnia': 'sonno',
-        }
-
-        if contesto and contesto in sinonimi:
-            contesto_validato = sinonimi[contesto]
+    contesto_validato = _valida_contesto(contesto)
 
     if not spiegazione:
         spiegazione = "Contesto rilevato in base al contenuto generale del testo."
@@ -792,6 +1117,65 @@ def analizza_contesto_sociale(testo, paziente=None):
     return contesto_validato, spiegazione
 
 
+def _valida_emozione(emozione):
+    """
+    Normalizza l'emozione restituita dal modello su una delle chiavi di EMOZIONI_EMOJI,
+    usando fuzzy matching e sinonimi. Se non riconosciuta, restituisce l'output del modello.
+    """
+    if emozione and emozione in EMOZIONI_EMOJI:
+        emozione_validata = emozione
+    else:
+        # Fuzzy matching: controlla se l'emozione è contenuta parzialmente
+        emozione_validata = None
+        for chiave in EMOZIONI_EMOJI.keys():
+            if emozione and chiave in emozione:
+                emozione_validata = chiave
+                break
+
+        # Controllo sinonimi
+        if not emozione_validata:
+            sinonimi = {
+                'contentezza': 'gioia',
+                'allegria': 'gioia',
+                'contento': 'gioia',
+                'felice': 'felicità',
+                'triste': 'tristezza',
+                'arrabbiato': 'rabbia',
+                'furioso': 'rabbia',
+                'spaventato': 'paura',
+                'impaurito': 'paura',
+                'ansioso': 'ansia',
+                'agitato': 'ansia',
+                'nervoso': 'nervosismo',
+                'stanco': 'stanchezza',
+                'affaticato': 'stanchezza',
+                'angoscia': 'ansia',
+                'angosciato': 'ansia',
+                'confuso': 'confusione',
+                'nostalgico': 'nostalgia',
+                'deluso': 'delusione',
+                'solo': 'solitudine',
+                'isolato': 'solitudine',
+                'frustrato': 'frustrazione',
+                'orgoglioso': 'orgoglio',
+                'imbarazzato': 'imbarazzo',
+                'inadeguato': 'inadeguatezza',
+                'disperato': 'disperazione',
+            }
+
+            if emozione and emozione in sinonimi:
+                emozione_validata = sinonimi[emozione]
+
+        # Se proprio non troviamo nulla, logga l'errore e mantieni l'output del modello
+        if not emozione_validata:
+            print(f"⚠️ ATTENZIONE: Emozione non valida ricevuta dal modello: '{emozione}'")
+            # Il modello dovrebbe sempre restituire un'emozione valida secondo il prompt
+            # Manteniamo quello che ha restituito il modello senza forzare un fallback
+            emozione_validata = emozione if emozione else None
+
+    return emozione_validata
+
+
 def analizza_sentiment(testo, paziente=None):
     """
     Analizza il sentiment del testo del paziente e restituisce l'emozione predominante
@@ -822,7 +1206,7 @@ def analizza_sentiment(testo, paziente=None):
 
     prompt = f"""Sei un esperto di analisi delle emozioni. Il tuo compito è identificare l'emozione predominante in un testo e spiegare perché.
 
-    {info_paziente}EMOZIONI DISPONIBILI (scegli SOLO tra queste):
+    EMOZIONI DISPONIBILI (scegli SOLO tra queste):
     {emozioni_lista}
     
     FORMATO RISPOSTA (OBBLIGATORIO):
@@ -861,7 +1245,7 @@ def analizza_sentiment(testo, paziente=None):
     Emozione: confusione
     Spiegazione: Le espressioni "non so cosa fare" e "sono indeciso" indicano uno stato di incertezza e disorientamento decisionale.
     
-    Testo da analizzare:
+    {info_paziente}Testo da analizzare:
     {testo}
     
     Rispondi ora nel formato richiesto (ricorda: la spiegazione DEVE citare parole specifiche del testo):"""
@@ -891,56 +1275,7 @@ def analizza_sentiment(testo, paziente=None):
         spiegazione = ' '.join(spiegazione_parts)
 
     # Validazione e normalizzazione dell'emozione
-    if emozione and emozione in EMOZIONI_EMOJI:
-        emozione_validata = emozione
-    else:
-        # Fuzzy matching: controlla se l'emozione è contenuta parzialmente
-        emozione_validata = None
-        for chiave in EMOZIONI_EMOJI.keys():
-            if emozione and chiave in emozione:
-                emozione_validata = chiave
-                break
-
-        # Controllo sinonimi
-        if not emozione_validata:
-            sinonimi = {
-                'contentezza': 'gioia',
-                'allegria': 'gioia',
-                'contento': 'gioia',
-                'felice': 'felicità',
-                'triste': 'tristezza',
-                'arrabbiato': 'rabbia',
-                'furioso': 'rabbia',
-                'spaventato': 'paura',
-                'impaurito': 'paura',
-                'ansioso': 'ansia',
-                'agitato': 'ansia',
-                'nervoso': 'nervosismo',
-                'stanco': 'stanchezza',
-                'affaticato': 'stanchezza',
-                'angoscia': 'ansia',
-                'angosciato': 'ansia',
-                'confuso': 'confusione',
-                'nostalgico': 'nostalgia',
-                'deluso': 'delusione',
-                'solo': 'solitudine',
-                'isolato': 'solitudine',
-                'frustrato': 'frustrazione',
-                'orgoglioso': 'orgoglio',
-                'imbarazzato': 'imbarazzo',
-                'inadeguato': 'inadeguatezza',
-                'disperato': 'disperazione',
-            }
-
-            if emozione and emozione in sinonimi:
-                emozione_validata = sinonimi[emozione]
-
-        # Se proprio non troviamo nulla, logga l'errore e mantieni l'output del modello
-        if not emozione_validata:
-            print(f"⚠️ ATTENZIONE: Emozione non valida ricevuta dal modello: '{emozione}'")
-            # Il modello dovrebbe sempre restituire un'emozione valida secondo il prompt
-            # Manteniamo quello che ha restituito il modello senza forzare un fallback
-            emozione_validata = emozione if emozione else None
+    emozione_validata = _valida_emozione(emozione)
 
     # Migliora il fallback della spiegazione
     if not spiegazione or (spiegazione and len(spiegazione) < 10):
@@ -1009,23 +1344,11 @@ def _genera_prompt_strutturato_breve(testo, parametri_strutturati, tipo_parametr
 
     return f"""Sei un assistente per uno psicoterapeuta. Analizza il seguente testo e fornisci una valutazione clinica strutturata e CONCISA.
 
-    {info_paziente}{sezione_contesto}
-    Esempio:
-    Testo: "Oggi ho fallito il mio esame e ho voglia di arrendermi."
-    Risposta:
-    {parametri_strutturati}
-    
-    Parametri da utilizzare:
-    {tipo_parametri}
-    
     ISTRUZIONI FONDAMENTALI:
     - La risposta deve essere BREVE e SINTETICA (massimo {max_chars} caratteri)
     - FORMATO OBBLIGATORIO: ogni parametro deve essere su una NUOVA RIGA nel formato "NomeParametro: valore"
     - Vai a capo dopo ogni parametro
     
-    REGOLE PER L'ANALISI:
-    1. CONCENTRATI AL 90% SULLA NOTA CORRENTE - analizza principalmente il testo attuale {regole_note_precedenti}
-    
     COSA FARE:
     ✓ Analizzare gli aspetti emotivi, cognitivi e comportamentali della NOTA CORRENTE
     ✓ Notare eventuali cambiamenti o pattern rispetto al passato (in modo generico)
@@ -1037,6 +1360,18 @@ def _genera_prompt_strutturato_breve(testo, parametri_strutturati, tipo_parametr
     
     Completa sempre la frase, non troncare mai a metà. Inizia DIRETTAMENTE con il primo parametro.
     
+    Esempio:
+    Testo: "Oggi ho fallito il mio esame e ho voglia di arrendermi."
+    Risposta:
+    {parametri_strutturati}
+    
+    Parametri da utilizzare:
+    {tipo_parametri}
+    
+    REGOLE PER L'ANALISI:
+    1. CONCENTRATI AL 90% SULLA NOTA CORRENTE - analizza principalmente il testo attuale {regole_note_precedenti}
+    
+    {info_paziente}{sezione_contesto}
     Ora analizza questo testo (FOCALIZZATI SU QUESTO):
     {testo}"""
 
@@ -1075,24 +1410,12 @@ def _genera_prompt_strutturato_lungo(testo, parametri_strutturati, tipo_parametr
 
     return f"""Sei un assistente per uno psicoterapeuta. Analizza il seguente testo e fornisci una valutazione clinica strutturata e DETTAGLIATA.
 
-    {info_paziente}{sezione_contesto}
-    Esempio:
-    Testo: "Oggi ho fallito il mio esame e ho voglia di arrendermi."
-    Risposta:
-    {parametri_strutturati}
-    
-    Parametri da utilizzare:
-    {tipo_parametri}
-    
     ISTRUZIONI FONDAMENTALI:
     - La risposta deve essere DETTAGLIATA e APPROFONDITA (massimo {max_chars} caratteri)
     - FORMATO OBBLIGATORIO: ogni parametro deve essere su una NUOVA RIGA nel formato "NomeParametro: valore"
     - Vai a capo dopo ogni parametro
     - Fornisci analisi complete per ogni parametro
     
-    REGOLE PER L'ANALISI:
-    1. CONCENTRATI AL 80% SULLA NOTA CORRENTE - analizza principalmente il testo attuale in profondità {regole_note_precedenti}
-    
     COSA FARE:
     ✓ Analizzare in profondità la NOTA CORRENTE: emozioni, pensieri, comportamenti
     ✓ Identificare schemi cognitivi e pattern comportamentali visibili OGGI
@@ -1103,8 +1426,20 @@ def _genera_prompt_strutturato_lungo(testo, parametri_strutturati, tipo_parametr
     ✗ NON usare markdown, elenchi puntati o simboli
     ✗ NON usare frasi introduttive come "Ecco la nota clinica"
     
-    Completa sempre la frase, non troncare mai a metà. Inizia DIRETTAMENTE con il primo parametro.
+    Completa sempre la frase, non troncare mai a metà. Inizia DIRETTAMENTE con il primo parametro.
+    
+    Esempio:
+    Testo: "Oggi ho fallito il mio esame e ho voglia di arrendermi."
+    Risposta:
+    {parametri_strutturati}
+    
+    Parametri da utilizzare:
+    {tipo_parametri}
     
+    REGOLE PER L'ANALISI:
+    1. CONCENTRATI AL 80% SULLA NOTA CORRENTE - analizza principalmente il testo attuale in profondità {regole_note_precedenti}
+    
+    {info_paziente}{sezione_contesto}
     Ora analizza questo testo in profondità (QUESTO È IL FOCUS PRINCIPALE):
     {testo}"""
 
@@ -1142,15 +1477,11 @@ def _genera_prompt_non_strutturato_breve(testo, max_chars, contesto_precedente,
 
     return f"""Sei un assistente di uno psicoterapeuta specializzato. Analizza il seguente testo e fornisci una valutazione clinica discorsiva BREVE.
 
-    {info_paziente}{sezione_contesto}
     ISTRUZIONI FONDAMENTALI:
     - La risposta deve essere BREVE e SINTETICA (massimo {max_chars} caratteri)
     - Scrivi in modo discorsivo, come un commento clinico professionale
     - NON usare elenchi, grassetti, markdown, simboli o titoli
     
-    REGOLE PER L'ANALISI:
-    1. CONCENTRATI AL 90% SULLA NOTA CORRENTE - analizza principalmente il testo attuale {regole_note_precedenti}
-    
     COSA FARE:
     ✓ Analizzare il contenuto emotivo e psicologico della NOTA CORRENTE
     ✓ Identificare i vissuti emotivi emergenti OGGI
@@ -1162,6 +1493,10 @@ def _genera_prompt_non_strutturato_breve(testo, max_chars, contesto_precedente,
     
     Inizia DIRETTAMENTE con l'analisi del contenuto emotivo/psicologico. Completa sempre la frase.
     
+    REGOLE PER L'ANALISI:
+    1. CONCENTRATI AL 90% SULLA NOTA CORRENTE - analizza principalmente il testo attuale {regole_note_precedenti}
+    
+    {info_paziente}{sezione_contesto}
     Testo da analizzare (QUESTO È IL FOCUS):
     {testo}"""
 
@@ -1200,16 +1535,12 @@ def _genera_prompt_non_strutturato_lungo(testo, max_chars, contesto_precedente,
 
     return f"""Sei un assistente di uno psicoterapeuta specializzato. Analizza il seguente testo e fornisci una valutazione clinica discorsiva DETTAGLIATA e APPROFONDITA.
 
-    {info_paziente}{sezione_contesto}
     ISTRUZIONI FONDAMENTALI:
     - La risposta deve essere DETTAGLIATA e COMPLETA (massimo {max_chars} caratteri)
     - Scrivi in modo discorsivo e professionale, come una nota clinica narrativa
     - Approfondisci gli aspetti emotivi, cognitivi e comportamentali
     - NON usare elenchi, grassetti, markdown, simboli o titoli
     
-    REGOLE PER L'ANALISI:
-    1. CONCENTRATI AL 80% SULLA NOTA CORRENTE - analizza in profondità il testo attuale {regole_note_precedenti}
-    
     COSA FARE:
     ✓ Analizzare in profondità il contenuto emotivo della NOTA CORRENTE
     ✓ Esplorare i meccanismi cognitivi e i pattern comportamentali visibili OGGI
@@ -1222,11 +1553,15 @@ def _genera_prompt_non_strutturato_lungo(testo, max_chars, contesto_precedente,
     
     Inizia DIRETTAMENTE con l'analisi del contenuto emotivo/psicologico ATTUALE. Completa sempre la frase.
     
+    REGOLE PER L'ANALISI:
+    1. CONCENTRATI AL 80% SULLA NOTA CORRENTE - analizza in profondità il testo attuale {regole_note_precedenti}
+    
+    {info_paziente}{sezione_contesto}
     Testo da analizzare in profondità (QUESTO È IL FOCUS PRINCIPALE):
     {testo}"""
 
 
-def _recupera_contesto_note_precedenti(paziente, limite=5, escludi_nota_id=None):
+def _recupera_voci_note_precedenti(paziente, limite=5, escludi_nota_id=None):
     """
     Recupera le ultime note del paziente per fornire contesto, escludendo la nota corrente.
 
@@ -1236,49 +1571,160 @@ def _recupera_contesto_note_precedenti(paziente, limite=5, escludi_nota_id=None)
         escludi_nota_id: ID della nota da escludere (tipicamente la nota corrente) (opzionale)
 
     Returns:
-        String con il riepilogo delle note precedenti
+        Lista delle voci (una per nota) in ordine cronologico, vuota se non ci sono note
     """
 
+    # Le note recenti sono nel riepilogo già caricato con il paziente (vedi contesto_note.py)
+    voci = contesto_note.voci_precedenti(paziente, limite=limite, escludi_nota_id=escludi_nota_id)
+    if voci is not None:
+        return voci
+
     # Filtra le note del paziente
     query = NotaDiario.objects.filter(paz=paziente)
 
     # Escludi la nota corrente se specificata e filtra solo note PRECEDENTI
     if escludi_nota_id is not None:
-        try:
-            nota_corrente = NotaDiario.objects.get(id=escludi_nota_id)
+        data_nota_corrente = NotaDiario.objects.filter(id=escludi_nota_id).values_list('data_nota', flat=True).first()
+        if data_nota_corrente is not None:
             # Filtra solo le note con data PRECEDENTE alla nota corrente
-            query = query.filter(data_nota__lt=nota_corrente.data_nota)
-        except NotaDiario.DoesNotExist:
+            query = query.filter(data_nota__lt=data_nota_corrente)
+        else:
             query = query.exclude(id=escludi_nota_id)
 
-    # Prendi le ultime 'limite' note (le più recenti tra quelle precedenti)
-    note_precedenti = query.order_by('-data_nota')[:limite]
+    # Prendi le ultime 'limite' note (le più recenti tra quelle precedenti):
+    # del testo serve solo l'inizio, tagliato direttamente nella query
+    note_precedenti = query.per_contesto(contesto_note.LUNGHEZZA_TESTO).order_by('-data_nota')[:limite]
+
+    return [
+        contesto_note.formatta_voce(nota.data_nota, nota.emozione_predominante, nota.inizio_testo)
+        for nota in reversed(list(note_precedenti))
+    ]
+
+
+def _note_da_ids(ids):
+    """Note indicate (con i campi delle voci di contesto), in ordine cronologico."""
+    return list(NotaDiario.objects.filter(id__in=ids).per_contesto(contesto_note.LUNGHEZZA_TESTO).order_by('data_nota'))
+
 
-    if not note_precedenti.exists():
-        return "Nessuna nota precedente disponibile."
+def _voci_da_ids(ids):
+    """Voci di contesto delle note indicate, in ordine cronologico."""
+    return [
+        contesto_note.formatta_voce(nota.data_nota, nota.emozione_predominante, nota.inizio_testo)
+        for nota in _note_da_ids(ids)
+    ]
 
-    contesto = []
-    for i, nota in enumerate(reversed(list(note_precedenti)), 1):
-        # Converti al timezone locale per la formattazione
-        data_locale = timezone.localtime(nota.data_nota)
-        data_ora_formattata = data_locale.strftime('%d/%m/%Y alle %H:%M')
-        emozione = nota.emozione_predominante or "non specificata"
-        testo_breve = nota.testo_paziente[:150] + "..." if len(nota.testo_paziente) > 150 else nota.testo_paziente
-        contesto.append(f"[{data_ora_formattata}] - Emozione: {emozione}\nTesto: {testo_breve}")
 
-    return "\n\n".join(contesto)
+def _recupera_voci_note_simili(paziente, testo, nota_id=None, limite_recenti=5):
+    """
+    Recupera le note passate del paziente più simili alla nota corrente (vedi
+    embeddings.py), escluse le ultime 'limite_recenti' già presenti nel contesto.
+    Per le note nel riepilogo del paziente il risultato viene salvato nel
+    riepilogo: la rigenerazione lo rilegge senza query.
+
+    Returns:
+        Lista delle voci in ordine cronologico, vuota se la ricerca non è disponibile
+    """
+    k = getattr(settings, 'NOTE_SIMILI_K', 3)
+    if k <= 0:
+        return []
+    try:
+        parametri = (embeddings.modello_embedding(), k, getattr(settings, 'NOTE_SIMILI_SOGLIA', 0.3), limite_recenti)
+        if nota_id is not None:
+            voci = contesto_note.voci_simili(paziente, nota_id, parametri)
+            if voci is not None:
+                return voci
+        simili = embeddings.note_simili(paziente.pk, testo=testo, nota_id=nota_id, escludi_ultime=limite_recenti)
+    except Exception as e:
+        logger.warning(f"Ricerca delle note simili non disponibile: {e}")
+        return []
+
+    note = _note_da_ids([simile_id for simile_id, _ in simili]) if simili else []
+    if nota_id is not None:
+        contesto_note.salva_simili(paziente, nota_id, parametri, note)
+    return [contesto_note.formatta_voce(nota.data_nota, nota.emozione_predominante, nota.inizio_testo) for nota in note]
+
+
+def _recupera_contesto_note_precedenti(paziente, limite=5, escludi_nota_id=None):
+    """
+    Come _recupera_voci_note_precedenti, ma restituisce il riepilogo come stringa.
+    """
+    voci = _recupera_voci_note_precedenti(paziente, limite=limite, escludi_nota_id=escludi_nota_id)
+    return "\n\n".join(voci) if voci else "Nessuna nota precedente disponibile."
+
+
+def _costruisci_prompt_clinico(testo, medico, paziente, nota_id=None):
+    """
+    Costruisce il prompt per la nota clinica in base alle preferenze del medico.
+
+    Returns:
+        tuple: (prompt, max_chars)
+    """
+    tipo_nota = medico.tipo_nota  # True per "strutturato", False per "non strutturato"
+    lunghezza_nota = medico.lunghezza_nota  # True per "lungo", False per "breve"
+    tipo_parametri = medico.tipo_parametri.split(".:;!") if medico.tipo_parametri else []
+    testo_parametri = medico.testo_parametri.split(".:;!") if medico.testo_parametri else []
+
+    # Determina la lunghezza massima in caratteri
+    max_chars = LUNGHEZZA_NOTA_LUNGA if lunghezza_nota else LUNGHEZZA_NOTA_BREVE
+
+    # Recupera il contesto delle note precedenti (esclusa quella corrente).
+    # Nei prompt i dati del paziente seguono le istruzioni: il prefisso statico è
+    # identico tra le richieste e Ollama ne riusa la valutazione (cache del prompt)
+    # Prima delle ultime 5 note vanno le note passate più simili a quella corrente
+    voci_precedenti = (
+        _recupera_voci_note_simili(paziente, testo, nota_id=nota_id)
+        + _recupera_voci_note_precedenti(paziente, limite=5, escludi_nota_id=nota_id)
+    )
+
+    if tipo_nota:
+        # Nota strutturata
+        parametri_strutturati = "\n".join(
+            [f"{tipo}: {txt}" for tipo, txt in zip(tipo_parametri, testo_parametri)]
+        )
+        if lunghezza_nota:
+            # Strutturata + Lunga
+            def genera_prompt(testo, contesto):
+                return _genera_prompt_strutturato_lungo(testo, parametri_strutturati, tipo_parametri, max_chars, contesto, paziente)
+        else:
+            # Strutturata + Breve
+            def genera_prompt(testo, contesto):
+                return _genera_prompt_strutturato_breve(testo, parametri_strutturati, tipo_parametri, max_chars, contesto, paziente)
+    else:
+        # Nota non strutturata
+        if lunghezza_nota:
+            # Non Strutturata + Lunga
+            def genera_prompt(testo, contesto):
+                return _genera_prompt_non_strutturato_lungo(testo, max_chars, contesto, paziente)
+        else:
+            # Non Strutturata + Breve
+            def genera_prompt(testo, contesto):
+                return _genera_prompt_non_strutturato_breve(testo, max_chars, contesto, paziente)
+
+    # Budget in token: le istruzioni restano intere, nota corrente e note precedenti
+    # vengono ridotte (prima le note più vecchie) per rientrare nella finestra di contesto
+    token_istruzioni = prompt_budget.stima_token(genera_prompt("", "-"))
+    testo, voci_precedenti = prompt_budget.adatta_sezioni(
+        token_istruzioni, testo, voci_precedenti, prompt_budget.token_risposta(max_chars)
+    )
+    contesto_precedente = "\n\n".join(voci_precedenti) if voci_precedenti else "Nessuna nota precedente disponibile."
+
+    return genera_prompt(testo, contesto_precedente), max_chars
 
 
-def genera_frasi_cliniche(testo, medico, paziente, nota_id=None):
+def genera_frasi_cliniche(testo, medico, paziente, nota_id=None, usa_cache=True, solleva_errori=False):
     """
     Genera note cliniche personalizzate in base alle preferenze del medico.
-    Include il contesto delle ultime 5 note del paziente (esclusa quella corrente) per una valutazione più completa.
+    Include il contesto delle ultime 5 note del paziente (esclusa quella corrente) e delle
+    note passate più simili per una valutazione più completa.
 
     Args:
         testo: Testo della nota del paziente
         medico: Oggetto Medico
         paziente: Oggetto Paziente
         nota_id: ID della nota corrente da escludere dal contesto (opzionale)
+        usa_cache: Se False forza una nuova generazione anche a parità di prompt
+        solleva_errori: Se True una generazione fallita solleva llm_backends.ErroreGenerazione
+                        invece di restituire un messaggio di errore
 
     Gestisce 4 combinazioni:
     - Strutturata + Breve
@@ -1289,80 +1735,208 @@ def genera_frasi_cliniche(testo, medico, paziente, nota_id=None):
     print("Generazione commenti clinici con Ollama")
 
     try:
-        tipo_nota = medico.tipo_nota  # True per "strutturato", False per "non strutturato"
-        lunghezza_nota = medico.lunghezza_nota  # True per "lungo", False per "breve"
-        tipo_parametri = medico.tipo_parametri.split(".:;!") if medico.tipo_parametri else []
-        testo_parametri = medico.testo_parametri.split(".:;!") if medico.testo_parametri else []
-
-        # Determina la lunghezza massima in caratteri
-        max_chars = LUNGHEZZA_NOTA_LUNGA if lunghezza_nota else LUNGHEZZA_NOTA_BREVE
+        prompt, max_chars = _costruisci_prompt_clinico(testo, medico, paziente, nota_id=nota_id)
+        return genera_con_ollama(
+            prompt, max_chars=max_chars, temperature=0.6, usa_cache=usa_cache, solleva_errori=solleva_errori
+        )
 
-        # Recupera il contesto delle note precedenti (esclusa quella corrente)
-        contesto_precedente = _recupera_contesto_note_precedenti(paziente, limite=5, escludi_nota_id=nota_id)
+    except Exception as e:
+        logger.error(f"Errore nella generazione clinica: {e}")
+        if solleva_errori:
+            raise
+        return f"Errore durante la generazione: {e}"
 
-        if tipo_nota:
-            # Nota strutturata
-            parametri_strutturati = "\n".join(
-                [f"{tipo}: {txt}" for tipo, txt in zip(tipo_parametri, testo_parametri)]
-            )
-            if lunghezza_nota:
-                # Strutturata + Lunga
-                prompt = _genera_prompt_strutturato_lungo(testo, parametri_strutturati, tipo_parametri, max_chars, contesto_precedente, paziente)
-            else:
-                # Strutturata + Breve
-                prompt = _genera_prompt_strutturato_breve(testo, parametri_strutturati, tipo_parametri, max_chars, contesto_precedente, paziente)
-        else:
-            # Nota non strutturata
-            if lunghezza_nota:
-                # Non Strutturata + Lunga
-                prompt = _genera_prompt_non_strutturato_lungo(testo, max_chars, contesto_precedente, paziente)
-            else:
-                # Non Strutturata + Breve
-                prompt = _genera_prompt_non_strutturato_breve(testo, max_chars, contesto_precedente, paziente)
 
-        return genera_con_ollama(prompt, max_chars=max_chars, temperature=0.6)
+async def agenera_frasi_cliniche(testo, medico, paziente, nota_id=None, usa_cache=True, solleva_errori=False):
+    """
+    Versione asincrona di genera_frasi_cliniche: il prompt (che legge le note
+    precedenti dal database) viene costruito in un thread, la generazione è async.
+    """
+    try:
+        prompt, max_chars = await sync_to_async(_costruisci_prompt_clinico)(testo, medico, paziente, nota_id=nota_id)
+        return await agenera_con_ollama(
+            prompt, max_chars=max_chars, temperature=0.6, usa_cache=usa_cache, solleva_errori=solleva_errori
+        )
 
     except Exception as e:
         logger.error(f"Errore nella generazione clinica: {e}")
+        if solleva_errori:
+            raise
         return f"Errore durante la generazione: {e}"
 
 
+def _schema_analisi_combinata():
+    """JSON schema che vincola l'output dell'analisi combinata."""
+    return {
+        "type": "object",
+        "properties": {
+            "nota_clinica": {"type": "string"},
+            "emozione": {"type": "string", "enum": list(EMOZIONI_EMOJI.keys())},
+            "spiegazione_emozione": {"type": "string"},
+            "contesto": {"type": "string", "enum": list(CONTESTI_EMOJI.keys())},
+            "spiegazione_contesto": {"type": "string"},
+        },
+        "required": ["nota_clinica", "emozione", "spiegazione_emozione", "contesto", "spiegazione_contesto"],
+    }
+
+
+def analizza_nota_combinata(testo, medico, paziente, nota_id=None):
+    """
+    Genera nota clinica, emozione predominante e contesto sociale con una sola chiamata
+    al modello, vincolando l'output a un JSON schema.
+
+    Args:
+        testo: Testo della nota del paziente
+        medico: Oggetto Medico
+        paziente: Oggetto Paziente
+        nota_id: ID della nota corrente da escludere dal contesto (opzionale)
+
+    Returns:
+        tuple: (testo_clinico, emozione, spiegazione_emozione, contesto, spiegazione_contesto)
+               oppure None se la risposta non è valida (il chiamante usa le tre chiamate separate)
+
+    Raises:
+        llm_backends.ErroreGenerazione: se la generazione non riesce (es. backend non raggiungibile)
+    """
+    print("Analisi combinata con Ollama")
+
+    prompt_clinico, max_chars = _costruisci_prompt_clinico(testo, medico, paziente, nota_id=nota_id)
+    emozioni_lista = ', '.join(EMOZIONI_EMOJI.keys())
+    contesti_lista = ', '.join(CONTESTI_EMOJI.keys())
+
+    prompt = f"""{prompt_clinico}
+
+    OLTRE ALLA NOTA CLINICA, identifica nello stesso testo:
+    - EMOZIONE PREDOMINANTE: una sola parola scelta SOLO tra: {emozioni_lista}
+      USA "confusione" SOLO se il testo esprime esplicitamente incertezza, dubbi o disorientamento.
+    - CONTESTO SOCIALE principale: scelto SOLO tra: {contesti_lista}
+      L'attività fisica va classificata come "palestra" o "sport", MAI come "tempo libero".
+      "famiglia" SOLO se sono menzionati esplicitamente familiari; "relazione" per partner sentimentali; "amicizia" per amici e conoscenti.
+      Se il testo non indica chiaramente un contesto, usa "altro".
+    - Per emozione e contesto scrivi una spiegazione breve (max 2 frasi) che cita tra virgolette parole SPECIFICHE del testo.
+
+    FORMATO RISPOSTA (OBBLIGATORIO): rispondi SOLO con un oggetto JSON con i campi
+    "nota_clinica", "emozione", "spiegazione_emozione", "contesto", "spiegazione_contesto"."""
+
+    risposta = genera_con_ollama(
+        prompt,
+        max_chars=max_chars + 700,  # nota clinica + le due spiegazioni
+        temperature=0.4,
+        formato=_schema_analisi_combinata(),
+        solleva_errori=True,
+    )
+
+    try:
+        dati = json.loads(risposta)
+    except (TypeError, ValueError):
+        logger.warning("Analisi combinata: risposta non in formato JSON, uso le chiamate separate")
+        return None
+
+    if not isinstance(dati, dict):
+        return None
+
+    testo_clinico = _normalizza_risposta(dati.get('nota_clinica'))
+    emozione = str(dati.get('emozione') or '').strip().lower().rstrip('.!?,;:')
+    contesto = str(dati.get('contesto') or '').strip().lower().rstrip('.!?,;:')
+    if not testo_clinico or not emozione or not contesto:
+        logger.warning("Analisi combinata: campi mancanti nella risposta, uso le chiamate separate")
+        return None
+
+    emozione_validata = _valida_emozione(emozione)
+    contesto_validato = _valida_contesto(contesto)
+
+    spiegazione_emozione = str(dati.get('spiegazione_emozione') or '').strip()
+    if len(spiegazione_emozione) < 10:
+        spiegazione_emozione = f"Il testo esprime un vissuto emotivo riconducibile a {emozione_validata}."
+
+    spiegazione_contesto = str(dati.get('spiegazione_contesto') or '').strip()
+    if not spiegazione_contesto:
+        spiegazione_contesto = "Contesto rilevato in base al contenuto generale del testo."
+
+    print(f"Analisi combinata - Emozione: {emozione_validata}, Contesto: {contesto_validato}")
+
+    return testo_clinico, emozione_validata, spiegazione_emozione, contesto_validato, spiegazione_contesto
+
+
 def genera_analisi_in_background(nota_id, testo_paziente, medico, paziente):
     """
-    Funzione che viene eseguita in un thread separato per generare
-    l'analisi clinica, sentiment e contesto sociale in background.
+    Funzione eseguita dai worker della coda di analisi (vedi jobs.py) e dal comando
+    reanalyze_notes per generare l'analisi clinica, sentiment e contesto sociale in background.
+    L'esito viene salvato in stato_analisi ed errore_analisi della nota; se la
+    generazione fallisce la nota resta senza analisi clinica.
+
+    Returns:
+        bool: True se l'analisi è stata completata, False in caso di errore
     """
     try:
-        # Genera le analisi (passa nota_id per escludere la nota corrente dal contesto)
-        testo_clinico = genera_frasi_cliniche(testo_paziente, medico, paziente, nota_id=nota_id)
-        emozione_predominante, spiegazione_emozione = analizza_sentiment(testo_paziente, paziente)
-        contesto_sociale, spiegazione_contesto = analizza_contesto_sociale(testo_paziente, paziente)
-
-        # Aggiorna la nota nel database
-        nota = NotaDiario.objects.get(id=nota_id)
-        nota.testo_clinico = testo_clinico
-        nota.emozione_predominante = emozione_predominante
-        nota.spiegazione_emozione = spiegazione_emozione
-        nota.contesto_sociale = contesto_sociale
-        nota.spiegazione_contesto = spiegazione_contesto
-        nota.generazione_in_corso = False
-        nota.save()
+        try:
+            # Modalità combinata: una sola generazione per nota clinica, sentiment e contesto
+            risultato = None
+            if getattr(settings, 'ANALISI_COMBINATA', False):
+                risultato = analizza_nota_combinata(testo_paziente, medico, paziente, nota_id=nota_id)
+
+            if risultato:
+                testo_clinico, emozione_predominante, spiegazione_emozione, contesto_sociale, spiegazione_contesto = risultato
+            else:
+                # Genera le analisi (passa nota_id per escludere la nota corrente dal contesto)
+                testo_clinico = genera_frasi_cliniche(testo_paziente, medico, paziente, nota_id=nota_id, solleva_errori=True)
+                emozione_predominante, spiegazione_emozione = analizza_sentiment(testo_paziente, paziente)
+                contesto_sociale, spiegazione_contesto = analizza_contesto_sociale(testo_paziente, paziente)
+            errore = None if emozione_predominante else "Emozione predominante non rilevata."
+        except llm_backends.ErroreGenerazione as e:
+            testo_clinico = emozione_predominante = spiegazione_emozione = contesto_sociale = spiegazione_contesto = None
+            errore = f"Nota clinica non generata: {e}"
+
+        # Aggiorna la nota nel database e sposta il suo contributo negli aggregati emotivi
+        with transaction.atomic():
+            nota = NotaDiario.objects.get(id=nota_id)
+            chiave_aggregato = aggregati.chiave_nota(nota)
+            nota.testo_clinico = testo_clinico
+            nota.emozione_predominante = emozione_predominante
+            nota.spiegazione_emozione = spiegazione_emozione
+            nota.contesto_sociale = contesto_sociale
+            nota.spiegazione_contesto = spiegazione_contesto
+            nota.generazione_in_corso = False
+            nota.stato_analisi = 'fallita' if errore else 'completata'
+            nota.errore_analisi = errore
+            nota.save()
+            aggregati.sposta_nota(nota.paz_id, chiave_aggregato, aggregati.chiave_nota(nota))
+            contesto_note.aggiorna_nota(nota)
+        eventi.pubblica_nota_aggiornata(nota_id, paziente.pk, medico.pk)
 
+        if errore:
+            logger.warning(f"Analisi della nota {nota_id} non riuscita: {errore}")
+            return False
         logger.info(f"Generazione in background completata per nota {nota_id}")
+        return True
     except Exception as e:
         logger.error(f"Errore nella generazione in background per nota {nota_id}: {e}")
         # Imposta comunque generazione_in_corso a False per evitare blocchi
         try:
             nota = NotaDiario.objects.get(id=nota_id)
             nota.generazione_in_corso = False
-            nota.testo_clinico = "Errore durante la generazione dell'analisi clinica."
+            nota.testo_clinico = None
+            nota.stato_analisi = 'fallita'
+            nota.errore_analisi = str(e)
             nota.save()
+            eventi.pubblica_nota_aggiornata(nota_id, paziente.pk, medico.pk)
         except:
             pass
+        return False
     finally:
         connection.close()
 
 
+# Note mostrate per pagina nella home del paziente (le successive con note_paziente)
+NOTE_PER_PAGINA_PAZIENTE = 20
+
+
+def _note_paziente(paziente_id, cursore=None):
+    """Pagina di note del paziente dalla più recente, con le sole colonne visibili al paziente."""
+    note_query = NotaDiario.objects.filter(paz_id=paziente_id).per_paziente()
+    return pagina_note(note_query, cursore, NOTE_PER_PAGINA_PAZIENTE)
+
+
 def paziente_home(request):
     if request.session.get('user_type') != 'paziente':
         return redirect('/login/')
@@ -1398,8 +1972,10 @@ def paziente_home(request):
                 testo_supporto = ""  # Non generare supporto LLM in emergenza
                 logger.warning(f"EMERGENZA RILEVATA per paziente {paziente.codice_fiscale} - Tipo: {tipo_emergenza}")
             else:
-                # Situazione normale: genera supporto se richiesto
-                if generate_response_flag:
+                # Situazione normale: genera supporto se richiesto.
+                # In modalità streaming la frase viene generata dopo il redirect,
+                # mostrando i token man mano che arrivano (vedi stream_frase_supporto)
+                if generate_response_flag and not getattr(settings, 'SUPPORTO_STREAMING', False):
                     testo_supporto = genera_frasi_di_supporto(testo_paziente, paziente)
 
             # Crea la nota immediatamente con il supporto generato
@@ -1417,36 +1993,125 @@ def paziente_home(request):
                 is_emergency=is_emergency,
                 tipo_emergenza=tipo_emergenza,
                 messaggio_emergenza=messaggio_emergenza,
-                generazione_in_corso=True  # Flag per indicare che la generazione è in corso
+                generazione_in_corso=True,  # Flag per indicare che la generazione è in corso
+                stato_analisi='in_attesa',
             )
+            aggregati.registra_nota(nota)
+            contesto_note.aggiorna_nota(nota, paziente)
 
-            # Avvia la generazione dell'analisi clinica in background
-            thread = threading.Thread(
-                target=genera_analisi_in_background,
-                args=(nota.id, testo_paziente, medico, paziente)
-            )
-            thread.daemon = True
-            thread.start()
+            # Accoda la generazione dell'analisi clinica: la eseguono i worker
+            # avviati con "python manage.py run_analysis_workers"
+            accoda_analisi(nota)
+
+            if generate_response_flag and not is_emergency and getattr(settings, 'SUPPORTO_STREAMING', False):
+                request.session['nota_supporto_stream'] = nota.id
 
         # PRG Pattern: Redirect dopo POST per evitare duplicazione note al refresh
         return redirect('paziente_home')
 
-    note_diario = NotaDiario.objects.filter(paz=paziente).order_by('-data_nota')
+    # Solo la prima pagina: le note precedenti arrivano scorrendo (vedi note_paziente)
+    note_diario, cursore_successivo = _note_paziente(paziente.pk)
 
     return render(request, 'SoulDiaryConnectApp/paziente_home.html', {
         'paziente': paziente,
         'note_diario': note_diario,
+        'cursore_successivo': cursore_successivo,
         'medico': medico,
+        # Nota appena salvata di cui generare la frase di supporto in streaming
+        'nota_supporto_stream': request.session.pop('nota_supporto_stream', None),
+    })
+
+
+def note_paziente(request):
+    """
+    View AJAX dello scorrimento infinito della home del paziente: restituisce la
+    pagina di note che segue il cursore, con i soli campi mostrati al paziente.
+
+    Parametri GET:
+        cursore: cursore restituito dalla pagina precedente (vedi paginazione.py)
+    """
+    if request.session.get('user_type') != 'paziente':
+        return JsonResponse({'error': 'Non autorizzato'}, status=403)
+
+    cursore = request.GET.get('cursore')
+    if cursore and decodifica_cursore(cursore) is None:
+        return JsonResponse({'error': 'Parametro cursore non valido'}, status=400)
+
+    note, cursore_successivo = _note_paziente(request.session.get('user_id'), cursore)
+    return JsonResponse({
+        'note': [
+            {
+                'id': nota.id,
+                'data_nota': timezone.localtime(nota.data_nota).strftime('%d/%m/%Y alle ore %H:%M'),
+                'testo_paziente': nota.testo_paziente,
+                'testo_supporto': nota.testo_supporto,
+                'testo_medico': nota.testo_medico,
+                'is_emergency': nota.is_emergency,
+                'messaggio_emergenza': nota.messaggio_emergenza if nota.is_emergency else None,
+            }
+            for nota in note
+        ],
+        'cursore': cursore_successivo,
     })
 
 
+def _evento_sse(dati, evento=None):
+    """Formatta un evento Server-Sent Events con dati JSON."""
+    messaggio = f"event: {evento}\n" if evento else ""
+    return messaggio + f"data: {json.dumps(dati)}\n\n"
+
+
+def stream_frase_supporto(request, nota_id):
+    """
+    Endpoint Server-Sent Events che genera la frase di supporto di una nota e invia
+    i token al browser man mano che Ollama li produce. Al termine la frase viene
+    salvata in NotaDiario.testo_supporto.
+
+    Eventi inviati:
+        (default): {"token": "..."} per ogni frammento generato
+        fine: {"testo": "..."} con la frase completa e normalizzata
+        errore: {"errore": "..."} se la generazione non è riuscita
+    """
+    if request.session.get('user_type') != 'paziente':
+        return JsonResponse({'error': 'Non autorizzato'}, status=403)
+
+    nota = get_object_or_404(NotaDiario.objects.select_related('paz'), id=nota_id)
+
+    # Sicurezza: solo il proprietario può generare la frase di supporto
+    if nota.paz.codice_fiscale != request.session.get('user_id'):
+        return JsonResponse({'error': 'Non autorizzato'}, status=403)
+
+    def eventi():
+        if nota.is_emergency:
+            yield _evento_sse({'errore': 'Frase di supporto non disponibile per questa nota.'}, 'errore')
+            return
+
+        if nota.testo_supporto and nota.testo_supporto.strip():
+            yield _evento_sse({'testo': nota.testo_supporto}, 'fine')
+            return
+
+        for tipo, testo in genera_frasi_di_supporto_stream(nota.testo_paziente, nota.paz):
+            if tipo == 'token':
+                yield _evento_sse({'token': testo})
+            elif tipo == 'fine':
+                NotaDiario.objects.filter(id=nota.id).update(testo_supporto=testo, data_modifica=timezone.now())
+                yield _evento_sse({'testo': testo}, 'fine')
+            else:
+                yield _evento_sse({'errore': testo}, 'errore')
+
+    response = StreamingHttpResponse(eventi(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disabilita il buffering dei reverse proxy (nginx)
+    return response
+
+
 def controlla_stato_generazione(request, nota_id):
     """
     View AJAX per controllare lo stato di generazione di una nota.
     Usata dal lato medico per aggiornare la UI quando la generazione è completata.
     """
     try:
-        nota = NotaDiario.objects.get(id=nota_id)
+        nota = NotaDiario.objects.per_stato().get(id=nota_id)
         return JsonResponse({
             'generazione_in_corso': nota.generazione_in_corso,
             'testo_clinico': nota.testo_clinico if not nota.generazione_in_corso else None,
@@ -1459,6 +2124,149 @@ def controlla_stato_generazione(request, nota_id):
         return JsonResponse({'error': 'Nota non trovata'}, status=404)
 
 
+def _stato_note(medico_id, parametri):
+    """
+    Legge in una sola query lo stato delle note richieste (vedi stato_note).
+
+    Il cursore restituito è la posizione (data_modifica, id) dell'ultima nota
+    modificata tra quelle lette, o il cursore ricevuto se non ne è stata letta
+    nessuna: dipende solo dai dati salvati, non dall'orologio del server web.
+
+    Returns:
+        tuple: (dizionario della risposta, status HTTP)
+    """
+    query = NotaDiario.objects.filter(paz__med_id=medico_id)
+    cursore = None
+    ids = parametri.get('ids')
+    paziente_id = parametri.get('paziente_id')
+
+    if ids:
+        try:
+            lista_ids = [int(i) for i in ids.split(',') if i.strip()][:200]
+        except ValueError:
+            return {'error': 'Parametro ids non valido'}, 400
+        query = query.filter(id__in=lista_ids)
+    elif paziente_id:
+        query = query.filter(paz_id=paziente_id)
+        dopo = parametri.get('dopo')
+        if dopo:
+            posizione = decodifica_cursore(dopo)
+            if posizione is not None:
+                data_dopo, nota_id = posizione
+                query = query.filter(Q(data_modifica__gt=data_dopo) | Q(data_modifica=data_dopo, id__gt=nota_id))
+            else:
+                # Solo data ISO 8601: note modificate dopo quell'istante
+                data_dopo = parse_datetime(dopo)
+                if data_dopo is None:
+                    return {'error': 'Parametro dopo non valido'}, 400
+                query = query.filter(data_modifica__gt=data_dopo)
+            cursore = dopo
+    else:
+        return {'error': 'Specificare ids oppure paziente_id'}, 400
+
+    in_corso = []
+    note = []
+    ultima = None
+    for nota in query.per_stato():
+        if ultima is None or (nota.data_modifica, nota.id) > ultima:
+            ultima = (nota.data_modifica, nota.id)
+        if nota.generazione_in_corso:
+            in_corso.append(nota.id)
+            continue
+        note.append({
+            'id': nota.id,
+            'is_emergency': nota.is_emergency,
+            'testo_clinico': nota.testo_clinico,
+            'stato_analisi': nota.stato_analisi,
+            'emozione_predominante': nota.emozione_predominante,
+            'spiegazione_emozione': nota.spiegazione_emozione,
+            'emoji': get_emoji_for_emotion(nota.emozione_predominante),
+            'emotion_category': get_emotion_category(nota.emozione_predominante),
+            'contesto_sociale': nota.contesto_sociale,
+            'spiegazione_contesto': nota.spiegazione_contesto,
+            'context_emoji': get_emoji_for_context(nota.contesto_sociale),
+        })
+
+    if ultima is not None:
+        cursore = f"{ultima[0].isoformat()}_{ultima[1]}"
+    elif cursore is None:
+        # Nessuna nota letta e nessun cursore ricevuto: si parte da adesso
+        cursore = f"{timezone.now().isoformat()}_0"
+
+    return {
+        'cursore': cursore,
+        'in_corso': in_corso,
+        'note': note,
+    }, 200
+
+
+def stato_note(request):
+    """
+    View AJAX che restituisce in una sola query lo stato di più note.
+    Usata dal lato medico per aggiornare le card senza ricaricare la pagina.
+
+    Parametri GET (in alternativa):
+        ids: lista di ID separati da virgola (es. le note ancora in generazione)
+        paziente_id + dopo: note del paziente modificate dopo il cursore ISO 8601
+
+    Per le note ancora in generazione restituisce solo l'ID (in "in_corso"),
+    per le altre i campi dell'analisi da mostrare nella card.
+    """
+    if request.session.get('user_type') != 'medico':
+        return JsonResponse({'error': 'Non autorizzato'}, status=403)
+
+    dati, status = _stato_note(request.session.get('user_id'), request.GET)
+    return JsonResponse(dati, status=status)
+
+
+async def attendi_note(request):
+    """
+    Long-poll asincrono sullo stato delle note (stessi parametri di stato_note).
+
+    Parametri GET aggiuntivi:
+        seguite: ID (separati da virgola) delle note in generazione mostrate dal
+                 client: si risponde prima del timeout solo quando una di queste è
+                 completata. Senza il parametro basta una qualsiasi nota letta.
+
+    Se ci sono già note seguite completate risponde subito; altrimenti resta in
+    attesa degli eventi pubblicati dai worker al termine dell'analisi (vedi
+    eventi.py), per al più EVENTI_LONG_POLL_TIMEOUT secondi, rileggendo lo stato
+    a ogni evento. Il cursore restituito avanza oltre le note lette, così la
+    richiesta successiva non risponde di nuovo per le stesse note.
+    """
+    if await request.session.aget('user_type') != 'medico':
+        return JsonResponse({'error': 'Non autorizzato'}, status=403)
+
+    seguite = None
+    if request.GET.get('seguite'):
+        try:
+            seguite = {int(i) for i in request.GET['seguite'].split(',') if i.strip()}
+        except ValueError:
+            return JsonResponse({'error': 'Parametro seguite non valido'}, status=400)
+
+    medico_id = await request.session.aget('user_id')
+    timeout = getattr(settings, 'EVENTI_LONG_POLL_TIMEOUT', 25)
+    loop = asyncio.get_running_loop()
+    scadenza = loop.time() + timeout
+    parametri = request.GET.copy()
+
+    # L'iscrizione precede la lettura dal database, così un evento pubblicato
+    # nel frattempo sveglia comunque l'attesa
+    with eventi.get_broker().iscrivi(eventi.canale_medico(medico_id)) as iscrizione:
+        while True:
+            dati, status = await sync_to_async(_stato_note)(medico_id, parametri)
+            if status != 200 or any(seguite is None or nota['id'] in seguite for nota in dati['note']):
+                return JsonResponse(dati, status=status)
+
+            rimanente = scadenza - loop.time()
+            if rimanente <= 0:
+                return JsonResponse(dati, status=status)
+            if parametri.get('dopo'):
+                # Le note già lette (non seguite) non vengono riconsiderate
+                parametri['dopo'] = dati['cursore']
+            await iscrizione.attendi(rimanente)
+
+
 def modifica_testo_medico(request, nota_id):
     if request.method == 'POST':
         nota = get_object_or_404(NotaDiario, id=nota_id)
@@ -1511,14 +2319,18 @@ def elimina_nota(request, nota_id):
     if nota.paz.codice_fiscale != request.session.get('user_id'):
         return redirect('/paziente/home/')
     if request.method == 'POST':
-        nota.delete()
+        with transaction.atomic():
+            aggregati.rimuovi_nota(nota)
+            contesto_note.rimuovi_nota(nota)
+            nota.delete()
         return redirect('/paziente/home/')
     return render(request, 'SoulDiaryConnectApp/conferma_eliminazione.html', {'nota': nota})
 
 
-def rigenera_frase_clinica(request):
+async def rigenera_frase_clinica(request):
     """
     View per rigenerare la frase clinica di una nota specifica (AJAX).
+    Asincrona: l'attesa della generazione non occupa un thread del server.
     """
     is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
     if request.method == 'POST' and is_ajax:
@@ -1526,46 +2338,153 @@ def rigenera_frase_clinica(request):
         if not nota_id:
             return JsonResponse({'error': 'ID nota mancante.'}, status=400)
         try:
-            nota = NotaDiario.objects.get(id=nota_id)
+            nota = await NotaDiario.objects.select_related('paz__med').aget(id=nota_id)
             medico = nota.paz.med
             paziente = nota.paz
             testo_paziente = nota.testo_paziente
-            # Passa nota_id per escludere la nota corrente dal contesto
-            nuova_frase = genera_frasi_cliniche(testo_paziente, medico, paziente, nota_id=nota.id)
+            # Passa nota_id per escludere la nota corrente dal contesto.
+            # La rigenerazione è voluta dal medico: non riusa la risposta in cache
+            with llm_scheduler.priorita('rigenerazione', medico.pk):
+                try:
+                    nuova_frase = await agenera_frasi_cliniche(
+                        testo_paziente, medico, paziente, nota_id=nota.id, usa_cache=False, solleva_errori=True
+                    )
+                except llm_backends.ErroreGenerazione as e:
+                    # L'analisi precedente resta invariata
+                    return JsonResponse({'error': _messaggio_errore_llm(e)}, status=503)
             # Sostituisci la frase clinica precedente
             nota.testo_clinico = nuova_frase
-            nota.save(update_fields=["testo_clinico"])
+            campi = ["testo_clinico", "data_modifica"]
+            if nota.stato_analisi == 'fallita' and nota.emozione_predominante:
+                # Mancava solo la nota clinica: l'analisi ora è completa
+                nota.stato_analisi = 'completata'
+                nota.errore_analisi = None
+                campi += ["stato_analisi", "errore_analisi"]
+            await nota.asave(update_fields=campi)
             return JsonResponse({'testo_clinico': nuova_frase})
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
     return JsonResponse({'error': 'Richiesta non valida.'}, status=400)
 
 
-def genera_frase_supporto_nota(request, nota_id):
+async def genera_frase_supporto_nota(request, nota_id):
     """
     View per generare la frase di supporto per una nota specifica che non ce l'ha.
+    Asincrona: l'attesa della generazione non occupa un thread del server.
     """
-    if request.session.get('user_type') != 'paziente':
+    if await request.session.aget('user_type') != 'paziente':
         return redirect('/login/')
 
-    nota = get_object_or_404(NotaDiario, id=nota_id)
+    nota = await aget_object_or_404(NotaDiario.objects.select_related('paz'), id=nota_id)
 
     # Sicurezza: solo il proprietario può generare la frase di supporto
-    if nota.paz.codice_fiscale != request.session.get('user_id'):
+    if nota.paz.codice_fiscale != await request.session.aget('user_id'):
         return redirect('/paziente/home/')
 
     if request.method == 'POST':
         # Genera la frase di supporto se non esiste già
         if not nota.testo_supporto or nota.testo_supporto.strip() == '':
-            testo_supporto = genera_frasi_di_supporto(nota.testo_paziente, nota.paz)
+            testo_supporto = await agenera_frasi_di_supporto(nota.testo_paziente, nota.paz)
             nota.testo_supporto = testo_supporto
-            nota.save(update_fields=["testo_supporto"])
+            await nota.asave(update_fields=["testo_supporto", "data_modifica"])
 
         return redirect('/paziente/home/')
 
     return redirect('/paziente/home/')
 
 
+# Periodi rapidi della pagina di analisi (giorni a ritroso da oggi)
+GIORNI_PERIODI_ANALISI = {
+    '7days': 7,
+    '30days': 30,
+    '3months': 90,
+    'year': 365,
+}
+
+# Granularità del grafico emotivo: funzione di troncamento della data e formato dell'etichetta
+GRANULARITA_ANALISI = {
+    'giorno': TruncDay,
+    'settimana': TruncWeek,
+    'mese': TruncMonth,
+}
+FORMATO_DATE_GRANULARITA = {
+    'giorno': '%d/%m/%Y',
+    'settimana': '%d/%m/%Y',
+    'mese': '%m/%Y',
+}
+
+
+def _data_iso(valore):
+    """Data ISO (YYYY-MM-DD) dai parametri GET, None se assente o non valida."""
+    try:
+        return parse_date(valore or '')
+    except ValueError:
+        # Formato corretto ma data inesistente (es. 2024-02-30)
+        return None
+
+
+def _intervallo_analisi(parametri, primo_giorno=None):
+    """
+    Interpreta i parametri GET della pagina di analisi.
+    primo_giorno (data della prima nota) serve a scegliere la granularità per 'all'.
+
+    Parametri (tutti opzionali):
+        periodo: '7days', '30days', '3months', 'year' oppure 'all' (default)
+        anno, mese: periodo specifico (mese richiede anno)
+        dal, al: date ISO (YYYY-MM-DD) che delimitano l'intervallo
+        granularita: 'giorno', 'settimana' o 'mese' (default: in base all'ampiezza)
+
+    Returns:
+        tuple: (dal, al, granularita, periodo); dal e al possono essere None
+    """
+    oggi = timezone.localdate()
+    periodo = parametri.get('periodo', 'all')
+    dal = al = None
+
+    if periodo in GIORNI_PERIODI_ANALISI:
+        dal = oggi - timedelta(days=GIORNI_PERIODI_ANALISI[periodo])
+    else:
+        periodo = 'all'
+
+    anno = parametri.get('anno', '')
+    mese = parametri.get('mese', '')
+    if anno.isdigit():
+        try:
+            if mese.isdigit() and 1 <= int(mese) <= 12:
+                inizio_anno = date(int(anno), int(mese), 1)
+                fine_anno = (inizio_anno + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+            else:
+                inizio_anno = date(int(anno), 1, 1)
+                fine_anno = date(int(anno), 12, 31)
+        except (ValueError, OverflowError):
+            # Anno fuori dall'intervallo delle date: resta il periodo predefinito
+            pass
+        else:
+            periodo = 'specifico'
+            dal, al = inizio_anno, fine_anno
+
+    dal_richiesto = _data_iso(parametri.get('dal'))
+    al_richiesto = _data_iso(parametri.get('al'))
+    if dal_richiesto or al_richiesto:
+        periodo = 'specifico'
+        dal = dal_richiesto or dal
+        al = al_richiesto or al
+
+    granularita = parametri.get('granularita')
+    if granularita not in GRANULARITA_ANALISI:
+        # Senza scelta esplicita si mantiene il numero di punti del grafico contenuto
+        inizio = dal or primo_giorno
+        ampiezza = ((al or oggi) - inizio).days if inizio else None
+        if ampiezza is not None and ampiezza <= 120:
+            granularita = 'giorno'
+        elif ampiezza is not None and ampiezza <= 730:
+            granularita = 'settimana'
+        else:
+            granularita = 'mese'
+
+    return dal, al, granularita, periodo
+
+
 def analisi_paziente(request):
     """
     Pagina dedicata alle analisi del paziente selezionato
@@ -1589,164 +2508,251 @@ def analisi_paziente(request):
         messages.error(request, 'Non hai i permessi per visualizzare questo paziente.')
         return redirect('medico_home')
 
-    # Note del paziente
-    note_diario = NotaDiario.objects.filter(paz=paziente_selezionato).order_by('-data_nota')
+    # Tutte le statistiche vengono calcolate dal database sugli aggregati giornalieri
+    # (vedi aggregati.py): a Python arrivano solo le serie già aggregate
+    aggregati_paziente = AggregatoEmotivo.objects.filter(paz=paziente_selezionato, num_note__gt=0)
+    anni_disponibili = list(
+        aggregati_paziente.annotate(anno=ExtractYear('giorno'))
+        .values_list('anno', flat=True).distinct().order_by('-anno')
+    )
+    primo_giorno = aggregati_paziente.aggregate(primo=Min('giorno'))['primo']
+
+    # Intervallo di date e granularità del grafico scelti dal medico
+    dal, al, granularita, periodo = _intervallo_analisi(request.GET, primo_giorno)
+
+    if dal:
+        aggregati_paziente = aggregati_paziente.filter(giorno__gte=dal)
+    if al:
+        aggregati_paziente = aggregati_paziente.filter(giorno__lte=al)
+    con_emozione = aggregati_paziente.exclude(emozione='')
 
     # Prepara i dati per il grafico delle emozioni
     emotion_chart_data = None
     statistiche = None
 
-    if note_diario.exists():
-        # Ordina le note per data (dalla più vecchia alla più recente per il grafico)
-        note_ordinate = note_diario.order_by('data_nota')
-
-        # Prepara le liste per il grafico
-        dates = []
-        emotions = []
-        emotion_values = []
-
-        # Mappa le categorie a valori numerici per il grafico
-        # Usa le stesse categorie di EMOZIONI_CATEGORIE per coerenza
-        category_score_map = {
-            'positive': 4,   # Emozioni positive (verde)
-            'neutral': 3,    # Emozioni neutre (lilla)
-            'anxious': 2,    # Emozioni ansiose (giallo)
-            'negative': 1,   # Emozioni negative (rosso)
+    totali = con_emozione.aggregate(note=Sum('num_note'), somma=Sum('somma_punteggi'))
+    if totali['note']:
+        # Un punto per intervallo (giorno, settimana o mese): media dei punteggi ed emozione più frequente
+        tronca = GRANULARITA_ANALISI[granularita]
+        serie = list(
+            con_emozione.annotate(intervallo=tronca('giorno', output_field=DateField()))
+            .values('intervallo')
+            .annotate(note=Sum('num_note'), somma=Sum('somma_punteggi'))
+            .order_by('intervallo')
+        )
+        emozione_per_intervallo = {}
+        for riga in (
+            con_emozione.annotate(intervallo=tronca('giorno', output_field=DateField()))
+            .values('intervallo', 'emozione')
+            .annotate(note=Sum('num_note'))
+            .order_by('intervallo', '-note', 'emozione')
+        ):
+            emozione_per_intervallo.setdefault(riga['intervallo'], riga['emozione'])
+
+        formato = FORMATO_DATE_GRANULARITA[granularita]
+        emotion_chart_data = {
+            'dates': json.dumps([riga['intervallo'].strftime(formato) for riga in serie]),
+            'emotions': json.dumps([emozione_per_intervallo[riga['intervallo']] for riga in serie]),
+            'values': json.dumps([round(riga['somma'] / riga['note'], 2) for riga in serie]),
         }
 
-        # Contatore per le statistiche
-        contatore_emozioni = {}
-        somma_valori = 0
-
-        for nota in note_ordinate:
-            if nota.emozione_predominante:
-                emozione_lower = nota.emozione_predominante.lower()
-                dates.append(nota.data_nota.strftime('%d/%m/%Y'))
-                emotions.append(emozione_lower)
-
-                # Ottieni la categoria dell'emozione e il valore corrispondente
-                categoria = get_emotion_category(emozione_lower)
-                score = category_score_map.get(categoria, 2)  # default: neutral
-                emotion_values.append(score)
-                somma_valori += score
-
-                # Conta le emozioni
-                contatore_emozioni[emozione_lower] = contatore_emozioni.get(emozione_lower, 0) + 1
-
-        if dates:
-            emotion_chart_data = {
-                'dates': json.dumps(dates),
-                'emotions': json.dumps(emotions),
-                'values': json.dumps(emotion_values),
-            }
-
-            # Calcola statistiche
-            media_emotiva = somma_valori / len(emotion_values) if emotion_values else 0
-            emozione_piu_frequente = max(contatore_emozioni.items(), key=lambda x: x[1]) if contatore_emozioni else (None, 0)
-
-            statistiche = {
-                'totale_note': note_diario.count(),
-                'media_emotiva': round(media_emotiva, 2),
-                'emozione_frequente': emozione_piu_frequente[0],
-                'emozione_frequente_count': emozione_piu_frequente[1],
-                'emozione_frequente_emoji': get_emoji_for_emotion(emozione_piu_frequente[0]),
-            }
+        # Calcola statistiche
+        emozione_piu_frequente = (
+            con_emozione.values('emozione')
+            .annotate(note=Sum('num_note'))
+            .order_by('-note', 'emozione')
+            .first()
+        )
+        statistiche = {
+            'totale_note': aggregati_paziente.aggregate(note=Sum('num_note'))['note'],
+            'media_emotiva': round(totali['somma'] / totali['note'], 2),
+            'emozione_frequente': emozione_piu_frequente['emozione'],
+            'emozione_frequente_count': emozione_piu_frequente['note'],
+            'emozione_frequente_emoji': get_emoji_for_emotion(emozione_piu_frequente['emozione']),
+        }
 
-    # Prepara i dati per le correlazioni umore-contesto sociale
+    # Prepara i dati per le correlazioni umore-contesto sociale (GROUP BY contesto, categoria)
     correlazione_contesto_data = None
-    if note_diario.exists():
-        # Raccogli dati per correlazione
-        contesto_emozioni = {}  # {contesto: {'positive': n, 'neutral': n, 'anxious': n, 'negative': n, 'total': n, 'sum': n}}
-
-        for nota in note_diario:
-            contesto = nota.contesto_sociale
-            emozione = nota.emozione_predominante
-
-            if contesto and emozione:
-                contesto_lower = contesto.lower().strip()
-                emozione_lower = emozione.lower().strip()
-                categoria_emozione = get_emotion_category(emozione_lower)
-
-                if contesto_lower not in contesto_emozioni:
-                    contesto_emozioni[contesto_lower] = {
-                        'positive': 0,
-                        'neutral': 0,
-                        'anxious': 0,
-                        'negative': 0,
-                        'total': 0,
-                        'sum': 0,
-                        'emoji': get_emoji_for_context(contesto_lower),
-                    }
-
-                contesto_emozioni[contesto_lower][categoria_emozione] += 1
-                contesto_emozioni[contesto_lower]['total'] += 1
-                # Calcola il valore numerico per la media
-                category_score_map = {'positive': 4, 'neutral': 3, 'anxious': 2, 'negative': 1}
-                contesto_emozioni[contesto_lower]['sum'] += category_score_map.get(categoria_emozione, 2)
-
-        if contesto_emozioni:
-            # Ordina per numero totale di occorrenze (decrescente)
-            contesti_ordinati = sorted(contesto_emozioni.items(), key=lambda x: x[1]['total'], reverse=True)
-
-            # Prepara i dati per il grafico a barre raggruppate
-            labels = []
-            positive_data = []
-            neutral_data = []
-            anxious_data = []
-            negative_data = []
-            medie_contesto = []
-            emojis = []
-
-            for contesto, dati in contesti_ordinati:
-                labels.append(contesto.title())
-                positive_data.append(dati['positive'])
-                neutral_data.append(dati['neutral'])
-                anxious_data.append(dati['anxious'])
-                negative_data.append(dati['negative'])
-                media = round(dati['sum'] / dati['total'], 2) if dati['total'] > 0 else 0
-                medie_contesto.append(media)
-                emojis.append(dati['emoji'])
-
-            # Trova contesto più positivo e più negativo
-            contesto_migliore = max(contesti_ordinati, key=lambda x: x[1]['sum'] / x[1]['total'] if x[1]['total'] > 0 else 0)
-            contesto_peggiore = min(contesti_ordinati, key=lambda x: x[1]['sum'] / x[1]['total'] if x[1]['total'] > 0 else 0)
-
-            correlazione_contesto_data = {
-                'labels': json.dumps(labels),
-                'positive': json.dumps(positive_data),
-                'neutral': json.dumps(neutral_data),
-                'anxious': json.dumps(anxious_data),
-                'negative': json.dumps(negative_data),
-                'medie': json.dumps(medie_contesto),
-                'emojis': json.dumps(emojis),
-                'contesto_migliore': contesto_migliore[0].title(),
-                'contesto_migliore_emoji': contesto_migliore[1]['emoji'],
-                'contesto_migliore_media': round(contesto_migliore[1]['sum'] / contesto_migliore[1]['total'], 2) if contesto_migliore[1]['total'] > 0 else 0,
-                'contesto_peggiore': contesto_peggiore[0].title(),
-                'contesto_peggiore_emoji': contesto_peggiore[1]['emoji'],
-                'contesto_peggiore_media': round(contesto_peggiore[1]['sum'] / contesto_peggiore[1]['total'], 2) if contesto_peggiore[1]['total'] > 0 else 0,
-            }
+    contesto_emozioni = {}  # {contesto: {'positive': n, 'neutral': n, 'anxious': n, 'negative': n, 'total': n, 'sum': n}}
+    for riga in (
+        con_emozione.exclude(contesto='')
+        .values('contesto', 'categoria')
+        .annotate(note=Sum('num_note'), somma=Sum('somma_punteggi'))
+        .order_by()
+    ):
+        dati = contesto_emozioni.setdefault(riga['contesto'], {
+            'positive': 0,
+            'neutral': 0,
+            'anxious': 0,
+            'negative': 0,
+            'total': 0,
+            'sum': 0,
+            'emoji': get_emoji_for_context(riga['contesto']),
+        })
+        dati[riga['categoria']] += riga['note']
+        dati['total'] += riga['note']
+        dati['sum'] += riga['somma']
+
+    if contesto_emozioni:
+        # Ordina per numero totale di occorrenze (decrescente)
+        contesti_ordinati = sorted(contesto_emozioni.items(), key=lambda x: x[1]['total'], reverse=True)
+
+        # Prepara i dati per il grafico a barre raggruppate
+        labels = []
+        positive_data = []
+        neutral_data = []
+        anxious_data = []
+        negative_data = []
+        medie_contesto = []
+        emojis = []
+
+        for contesto, dati in contesti_ordinati:
+            labels.append(contesto.title())
+            positive_data.append(dati['positive'])
+            neutral_data.append(dati['neutral'])
+            anxious_data.append(dati['anxious'])
+            negative_data.append(dati['negative'])
+            media = round(dati['sum'] / dati['total'], 2) if dati['total'] > 0 else 0
+            medie_contesto.append(media)
+            emojis.append(dati['emoji'])
+
+        # Trova contesto più positivo e più negativo
+        contesto_migliore = max(contesti_ordinati, key=lambda x: x[1]['sum'] / x[1]['total'] if x[1]['total'] > 0 else 0)
+        contesto_peggiore = min(contesti_ordinati, key=lambda x: x[1]['sum'] / x[1]['total'] if x[1]['total'] > 0 else 0)
+
+        correlazione_contesto_data = {
+            'labels': json.dumps(labels),
+            'positive': json.dumps(positive_data),
+            'neutral': json.dumps(neutral_data),
+            'anxious': json.dumps(anxious_data),
+            'negative': json.dumps(negative_data),
+            'medie': json.dumps(medie_contesto),
+            'emojis': json.dumps(emojis),
+            'contesto_migliore': contesto_migliore[0].title(),
+            'contesto_migliore_emoji': contesto_migliore[1]['emoji'],
+            'contesto_migliore_media': round(contesto_migliore[1]['sum'] / contesto_migliore[1]['total'], 2) if contesto_migliore[1]['total'] > 0 else 0,
+            'contesto_peggiore': contesto_peggiore[0].title(),
+            'contesto_peggiore_emoji': contesto_peggiore[1]['emoji'],
+            'contesto_peggiore_media': round(contesto_peggiore[1]['sum'] / contesto_peggiore[1]['total'], 2) if contesto_peggiore[1]['total'] > 0 else 0,
+        }
 
     return render(request, 'SoulDiaryConnectApp/analisi_paziente.html', {
         'medico': medico,
         'paziente': paziente_selezionato,
         'emotion_chart_data': emotion_chart_data,
         'statistiche': statistiche,
-        'note_diario': note_diario,
         'correlazione_contesto_data': correlazione_contesto_data,
+        'ha_dati': bool(anni_disponibili),
+        'anni_disponibili': anni_disponibili,
+        'periodo': periodo,
+        'granularita': granularita,
+        'dal': dal,
+        'al': al,
+        'anno': request.GET.get('anno', ''),
+        'mese': request.GET.get('mese', ''),
     })
 
 
-def riassunto_caso_clinico(request):
+def formatta_note_per_riassunto(note, max_token=None):
+    """
+    Restituisce il testo delle note (data, emozione, nota e analisi clinica)
+    da inserire nei prompt di riassunto, separate da "---". Con max_token
+    vengono tenute solo le note più recenti che rientrano nel budget.
+    """
+    note_testo = []
+    for nota in note:
+        nota_info = f"Data: {nota.data_nota.strftime('%d/%m/%Y')}"
+        if nota.emozione_predominante:
+            nota_info += f" | Emozione: {nota.emozione_predominante}"
+        nota_info += f"\nNota paziente: {nota.testo_paziente}"
+        if nota.testo_clinico:
+            nota_info += f"\nAnalisi clinica: {nota.testo_clinico}"
+        note_testo.append(nota_info)
+
+    if max_token is not None:
+        note_testo = prompt_budget.seleziona_recenti(note_testo, max_token, separatore="\n\n---\n\n")
+    return "\n\n---\n\n".join(note_testo)
+
+
+def _prompt_riassunto_caso_clinico(paziente, periodo_label, note, max_chars=2000, voci_correlate=None):
+    """
+    Costruisce il prompt del riassunto del caso clinico a partire dalle note del periodo.
+
+    Args:
+        paziente: Oggetto Paziente
+        periodo_label: Descrizione del periodo (es. "Ultimo mese")
+        note: Lista delle note del periodo, in ordine cronologico
+        max_chars: Lunghezza massima del riassunto (riserva i token della risposta)
+        voci_correlate: Voci delle note precedenti al periodo più simili (opzionale)
+    """
+    # Le note più vecchie vengono scartate se il prompt supera la finestra di contesto
+    budget_note = prompt_budget.token_disponibili(prompt_budget.token_risposta(max_chars)) - prompt_budget.stima_token(
+        _testo_prompt_riassunto_caso_clinico(paziente, periodo_label, note, "", voci_correlate)
+    )
+    contesto_note = formatta_note_per_riassunto(note, max_token=budget_note)
+    return _testo_prompt_riassunto_caso_clinico(paziente, periodo_label, note, contesto_note, voci_correlate)
+
+
+def _recupera_voci_correlate_periodo(paziente, data_inizio):
+    """Voci delle note precedenti al periodo più simili alle note del periodo (vedi embeddings.py)."""
+    if getattr(settings, 'NOTE_SIMILI_K', 3) <= 0:
+        return []
+    try:
+        simili = embeddings.note_simili_al_periodo(paziente.pk, data_inizio)
+    except Exception as e:
+        logger.warning(f"Ricerca delle note correlate non disponibile: {e}")
+        return []
+    return _voci_da_ids([nota_id for nota_id, _ in simili]) if simili else []
+
+
+def _testo_prompt_riassunto_caso_clinico(paziente, periodo_label, note, contesto_note, voci_correlate=None):
+    # Le note correlate compaiono solo se presenti: senza, il prompt resta invariato
+    sezione_correlate = ""
+    if voci_correlate:
+        note_correlate = "\n\n".join(voci_correlate)
+        sezione_correlate = f"""
+
+    NOTE PRECEDENTI AL PERIODO SU TEMI SIMILI (solo come contesto, non fanno parte del periodo):
+    {note_correlate}"""
+
+    prompt = f"""Sei uno psicologo clinico esperto. Il tuo compito è generare un riassunto clinico professionale dello stato del paziente basandoti sulle note del diario raccolte nel periodo specificato.
+
+    ISTRUZIONI:
+    1. Fornisci un riassunto clinico strutturato che includa:
+       - Panoramica generale dello stato emotivo nel periodo
+       - Pattern emotivi ricorrenti identificati
+       - Eventuali miglioramenti o peggioramenti osservati
+       - Aree di attenzione o preoccupazione
+       - Raccomandazioni per il follow-up
+
+    2. Usa un linguaggio professionale e clinico
+    3. Sii obiettivo e basati solo sui dati forniti
+    4. Evidenzia eventuali trend significativi
+
+    INFORMAZIONI PAZIENTE:
+    Nome: {paziente.nome} {paziente.cognome}
+    Periodo analizzato: {periodo_label}
+    Numero di note: {len(note)}
+
+    NOTE DEL DIARIO:
+    {contesto_note}{sezione_correlate}
+
+    Genera il riassunto clinico:"""
+
+    return prompt
+
+
+async def riassunto_caso_clinico(request):
     """
     View per generare un riassunto del caso clinico di un paziente
     basato sulle note di un periodo selezionato.
+    Asincrona: l'attesa della generazione non occupa un thread del server.
     """
-    if request.session.get('user_type') != 'medico':
+    if await request.session.aget('user_type') != 'medico':
         return redirect('/login/')
 
-    medico_id = request.session.get('user_id')
-    medico = get_object_or_404(Medico, codice_identificativo=medico_id)
+    medico_id = await request.session.aget('user_id')
+    medico = await aget_object_or_404(Medico, codice_identificativo=medico_id)
 
     paziente_id = request.GET.get('paziente_id')
     periodo = request.GET.get('periodo', '7days')  # Default: ultimi 7 giorni
@@ -1755,10 +2761,10 @@ def riassunto_caso_clinico(request):
         messages.error(request, 'Seleziona un paziente.')
         return redirect('medico_home')
 
-    paziente_selezionato = get_object_or_404(Paziente, codice_fiscale=paziente_id)
+    paziente_selezionato = await aget_object_or_404(Paziente, codice_fiscale=paziente_id)
 
     # Verifica che il paziente sia del medico loggato
-    if paziente_selezionato.med != medico:
+    if paziente_selezionato.med_id != medico.pk:
         messages.error(request, 'Non hai i permessi per visualizzare questo paziente.')
         return redirect('medico_home')
 
@@ -1781,60 +2787,40 @@ def riassunto_caso_clinico(request):
         data_inizio = oggi - timedelta(days=7)
         periodo_label = 'Ultimi 7 giorni'
 
-    # Recupera le note del periodo selezionato
-    note_periodo = NotaDiario.objects.filter(
-        paz=paziente_selezionato,
-        data_nota__gte=data_inizio
-    ).order_by('data_nota')
+    # Recupera le note del periodo selezionato (materializzate: il template
+    # viene renderizzato in modo sincrono e non può eseguire query)
+    note_periodo = [
+        nota async for nota in NotaDiario.objects.filter(
+            paz=paziente_selezionato,
+            data_nota__gte=data_inizio
+        ).per_riassunto().order_by('data_nota')
+    ]
 
     riassunto = None
     data_generazione = None
 
     # Controlla se è stata richiesta una nuova generazione
     if request.method == 'POST' or request.GET.get('genera') == '1':
-        if note_periodo.exists():
-            # Costruisci il contesto per il riassunto
-            note_testo = []
-            for nota in note_periodo:
-                nota_info = f"Data: {nota.data_nota.strftime('%d/%m/%Y')}"
-                if nota.emozione_predominante:
-                    nota_info += f" | Emozione: {nota.emozione_predominante}"
-                nota_info += f"\nNota paziente: {nota.testo_paziente}"
-                if nota.testo_clinico:
-                    nota_info += f"\nAnalisi clinica: {nota.testo_clinico}"
-                note_testo.append(nota_info)
-
-            contesto_note = "\n\n---\n\n".join(note_testo)
-
-            prompt = f"""Sei uno psicologo clinico esperto. Il tuo compito è generare un riassunto clinico professionale dello stato del paziente basandoti sulle note del diario raccolte nel periodo specificato.
-
-            INFORMAZIONI PAZIENTE:
-            Nome: {paziente_selezionato.nome} {paziente_selezionato.cognome}
-            Periodo analizzato: {periodo_label}
-            Numero di note: {note_periodo.count()}
-            
-            NOTE DEL DIARIO:
-            {contesto_note}
-            
-            ISTRUZIONI:
-            1. Fornisci un riassunto clinico strutturato che includa:
-               - Panoramica generale dello stato emotivo nel periodo
-               - Pattern emotivi ricorrenti identificati
-               - Eventuali miglioramenti o peggioramenti osservati
-               - Aree di attenzione o preoccupazione
-               - Raccomandazioni per il follow-up
-            
-            2. Usa un linguaggio professionale e clinico
-            3. Sii obiettivo e basati solo sui dati forniti
-            4. Evidenzia eventuali trend significativi
-            
-            Genera il riassunto clinico:"""
-
-            riassunto = genera_con_ollama(prompt, max_chars=2000, temperature=0.5)
+        if note_periodo:
+            # I riassunti cedono il passo alle frasi di supporto e alle rigenerazioni
+            with llm_scheduler.priorita('riassunto', medico.pk):
+                if periodo in riassunti.PERIODI_GERARCHICI:
+                    # Periodi lunghi: sintesi settimanali e mensili salvate, rigenerate solo se cambiano le note
+                    riassunto = await riassunti.ariassunto_periodo(
+                        paziente_selezionato, periodo, periodo_label, data_inizio
+                    )
+                else:
+                    voci_correlate = await sync_to_async(_recupera_voci_correlate_periodo)(
+                        paziente_selezionato, data_inizio
+                    )
+                    prompt = _prompt_riassunto_caso_clinico(
+                        paziente_selezionato, periodo_label, note_periodo, voci_correlate=voci_correlate
+                    )
+                    riassunto = await agenera_con_ollama(prompt, max_chars=2000, temperature=0.5)
             data_generazione = timezone.now()
 
             # Salva o aggiorna il riassunto nel database
-            riassunto_obj, created = RiassuntoCasoClinico.objects.update_or_create(
+            riassunto_obj, created = await RiassuntoCasoClinico.objects.aupdate_or_create(
                 paz=paziente_selezionato,
                 med=medico,
                 periodo=periodo,
@@ -1848,11 +2834,11 @@ def riassunto_caso_clinico(request):
             data_generazione = timezone.now()
     else:
         # Cerca un riassunto esistente nel database
-        riassunto_esistente = RiassuntoCasoClinico.objects.filter(
+        riassunto_esistente = await RiassuntoCasoClinico.objects.filter(
             paz=paziente_selezionato,
             med=medico,
             periodo=periodo
-        ).first()
+        ).afirst()
 
         if riassunto_esistente:
             riassunto = riassunto_esistente.testo_riassunto
@@ -1864,8 +2850,7 @@ def riassunto_caso_clinico(request):
         'periodo': periodo,
         'periodo_label': periodo_label,
         'note_periodo': note_periodo,
-        'num_note': note_periodo.count(),
+        'num_note': len(note_periodo),
         'riassunto': riassunto,
         'data_generazione': data_generazione,
     })
-